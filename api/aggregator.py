@@ -19,10 +19,13 @@
 """
 
 import logging
+import threading
+import time
 import collectors
 import rulesengine
-from pymongo import MongoClient
-import json
+from metric_cache import CACHE
+from windows import WINDOWS, parse_window
+from context import LazyDatabase, LazyMetrics
 
 LOG = logging.getLogger(__name__)
 # create console handler with a higher log level
@@ -36,8 +39,13 @@ formatter = logging.Formatter(
 ch.setFormatter(formatter)
 # add the handlers to the logger
 LOG.addHandler(ch)
-METRICS = json.load(file("configs/metrics.json"))
-DB = MongoClient().sla
+METRICS = LazyMetrics()
+DB = LazyDatabase()
+
+# Notification events are batched for up to BATCH_WINDOW seconds or
+# BATCH_SIZE samples.
+BATCH_WINDOW = 1.0
+BATCH_SIZE = 100
 
 
 class Aggregator(object):
@@ -96,11 +104,10 @@ class Aggregator(object):
                             margin_value = None
                             if 'limiter_value' in metric:
                                 margin_value = metric['limiter_value']
-                            collector.subscribe_metric(device,
-                                                       metric_key,
-                                                       metric['value'],
-                                                       metric['limiter_type'],
-                                                       margin_value)
+                            collector.subscribe_metric(
+                                device, metric_key, metric['value'],
+                                metric['limiter_type'], margin_value,
+                                'window' in metric or 'exit_value' in metric)
                         except AttributeError:
                             LOG.error('Collector class {} missing'
                                       .format(c_api))
@@ -112,69 +119,123 @@ class Aggregator(object):
         """
                A notification event carrying the metric from the monitoring infra.
         """
+        self.notification_events(device_id, {metric_name: metric_value})
+
+    def notification_events(self, device_id, metric_values, samples=None):
+        """
+            Notification events carrying the latest values of several metrics
+            of a device. Every agreement of the device is reasoned once.
+            samples are the (metric, value, time) samples notified, every one
+            of them, by default the latest values.
+        """
+        if samples is None:
+            now = time.time()
+            samples = [(metric, value, now)
+                       for metric, value in metric_values.iteritems()]
+
+        for metric, value in metric_values.iteritems():
+            CACHE.record(device_id, metric, value)
 
         # from device and metric get agreement_id
         db_records = DB.policies.find({'devices': device_id}, {'policy': 0})
         if db_records.count() > 0:
             for policy in db_records:
-                metrics = []
+                metrics = set()
                 for term_key, term in policy['terms'].iteritems():
-                    for metric in term['metrics']:
-                        metrics.append(metric)
+                    metrics.update(term['metrics'])
 
-                if metric_name in metrics:
-                    metrics.remove(metric_name)
-                else:
+                notified = dict((metric, value) for metric, value
+                                in metric_values.iteritems()
+                                if metric in metrics)
+                if not notified:
                     LOG.error('Metric {} could not be found in policy record '
-                              '{}.'.format(metric_name, policy['_id']))
+                              '{}.'.format(', '.join(metric_values),
+                                           policy['_id']))
                     raise AttributeError('Metric {} could not be found in the '
                                          'policy record {}.'
-                                         .format(metric_name, policy['_id']))
-
-                metric_values = {metric_name: metric_value}
-                for metric in metrics:
-                    try:
-                        c_api = self.get_collector_class(device_id, metric)
-                    except AttributeError as e:
-                        LOG.error(
-                            'Failed to get collector class for device {}.'
-                                .format(device_id))
-                        LOG.warn('Loading default collector')
-                        c_api = 'DummyCollector'
-
-                    if c_api:
-                        try:
-                            c_class = getattr(collectors, c_api)
-                            collector = c_class()
-                            metric_values[metric] = collector. \
-                                pull_metric(device_id, metric)
-                        except AttributeError:
-                            LOG.error('Collector class {} missing'
-                                      .format(c_api))
-                            raise RuntimeWarning('Collector class {} missing'
-                                                 .format(c_api))
+                                         .format(', '.join(metric_values),
+                                                 policy['_id']))
 
-                LOG.debug("agreement ID is {}.".format(policy['agreement_id']))
-                LOG.debug(
-                    "Metric(s) {} with value(s) {}.".format(
-                        metric_values.keys(), metric_values.values()
-                    )
-                )
-
-                
-                myrulesengine = rulesengine.RulesEngine()
-                myrulesengine.reason_agreement(policy['agreement_id'],
-                                               metric_values, device_id)
+                self.observe_windows(policy, device_id, samples)
+                self._reason_device(policy, device_id, notified,
+                                    metrics.difference(notified))
         else:
             LOG.error(
                 'Policy record for device {} and metric {} could not be '
-                'found.'.format(device_id, metric_name)
+                'found.'.format(device_id, ', '.join(metric_values))
             )
             raise AttributeError(
                 'Policy record for device {} and metric {} '
-                'could not be found.'.format(device_id, metric_name)
+                'could not be found.'.format(device_id,
+                                             ', '.join(metric_values))
+            )
+
+    def observe_windows(self, policy, device_id, samples):
+        """
+            Adds the notified (metric, value, time) samples of a device to
+            the windows of the policy terms evaluated over a window. Only
+            notified samples are added, never cached or pulled values, so
+            that each sample is counted once.
+        """
+        for term, term_info in policy['terms'].iteritems():
+            for metric, term_mtrc in term_info['metrics'].iteritems():
+                if 'window' not in term_mtrc:
+                    continue
+                key = (policy['agreement_id'], term, device_id, metric)
+                spec = parse_window(term_mtrc['window'])
+                for sampled, value, when in samples:
+                    if sampled != metric:
+                        continue
+                    try:
+                        WINDOWS.observe(key, value, spec, when)
+                    except (TypeError, ValueError):
+                        LOG.warn("Value {} of metric {} is not numeric"
+                                 .format(value, metric))
+
+    def _reason_device(self, policy, device_id, metric_values, missing):
+        """
+            Pulls the missing metrics of a device, unless they were
+            sampled recently, and reasons the agreement of the policy on
+            them.
+        """
+        metric_values = dict(metric_values)
+        for metric in missing:
+            cached = CACHE.latest(device_id, metric)
+            if cached is not None:
+                metric_values[metric] = cached
+                continue
+            try:
+                c_api = self.get_collector_class(device_id, metric)
+            except AttributeError as e:
+                LOG.error(
+                    'Failed to get collector class for device {}.'
+                        .format(device_id))
+                LOG.warn('Loading default collector')
+                c_api = 'DummyCollector'
+
+            if c_api:
+                try:
+                    c_class = getattr(collectors, c_api)
+                    collector = c_class()
+                    metric_values[metric] = collector. \
+                        pull_metric(device_id, metric)
+                    CACHE.record(device_id, metric, metric_values[metric])
+                except AttributeError:
+                    LOG.error('Collector class {} missing'
+                              .format(c_api))
+                    raise RuntimeWarning('Collector class {} missing'
+                                         .format(c_api))
+
+        LOG.debug("agreement ID is {}.".format(policy['agreement_id']))
+        LOG.debug(
+            "Metric(s) {} with value(s) {}.".format(
+                metric_values.keys(), metric_values.values()
             )
+        )
 
+        myrulesengine = rulesengine.RulesEngine()
+        myrulesengine.reason_agreement(policy['agreement_id'],
+                                       metric_values, device_id)
 
     def get_collector_class(self, device_id, metric):
         """
@@ -282,9 +343,75 @@ class Aggregator(object):
 
                     metric_value = collector.pull_metric(device_id, metric_key)
                     metrics_values[metric_key] = metric_value
+                    CACHE.record(device_id, metric_key, metric_value)
 
                 except AttributeError:
                     LOG.error('Collector class {} missing'.format(c_api))
                     raise RuntimeWarning('Collector class {} missing'
                                          .format(c_api))
         return metrics_values
+
+
+class NotificationBatcher(object):
+    """
+    Collects notification events for up to a window of seconds, or a number
+    of samples, and then passes the latest value of every metric of a device
+    to the Aggregator at once, so that a burst of samples reasons each
+    agreement of a device once. Every sample is passed on too, with the time
+    it was added, for the windows of the terms.
+    """
+
+    def __init__(self, window=BATCH_WINDOW, size=BATCH_SIZE, gator=None):
+        self.window = window
+        self.size = size
+        self.gator = gator or Aggregator()
+        self._pending = {}
+        self._samples = {}
+        self._count = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+
+    def add(self, device_id, metric_name, metric_value):
+        """
+            Adds a sample to the current batch.
+        """
+        with self._lock:
+            self._pending.setdefault(device_id, {})[metric_name] = \
+                metric_value
+            self._samples.setdefault(device_id, []).append(
+                (metric_name, metric_value, time.time()))
+            self._count += 1
+            full = self._count >= self.size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+            Reasons the agreements of the devices in the current batch.
+            Returns the number of devices.
+        """
+        with self._flushing:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                samples, self._samples = self._samples, {}
+                self._count = 0
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+            for device_id, metric_values in pending.iteritems():
+                try:
+                    self.gator.notification_events(device_id, metric_values,
+                                                   samples[device_id])
+                except Exception:
+                    LOG.exception('Notification events for device {} failed.'
+                                  .format(device_id))
+            return len(pending)
+
+
+BATCHER = NotificationBatcher()
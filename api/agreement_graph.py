@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Graph of the SLA federation: the agreements every agreement is linked to by
+its agreement links, and those linked to it, as adjacency sets. It is kept
+by the entity dictionary as links are stored and removed.
+
+An agreement can be enforced when it is valid and every agreement it is
+linked to, transitively, can be enforced too. Agreements linked in a cycle
+never can. This is precomputed when the validity of agreements changes, for
+the changed agreements and those depending on them only.
+"""
+
+import threading
+
+
+class AgreementGraph(object):
+    """
+        Agreement to agreement links, by link key, with the adjacency sets
+        of the agreements they join.
+    """
+
+    def __init__(self):
+        self._links = {}       # link key -> (agreement, linked agreement)
+        self._linked = {}      # agreement -> {linked agreement: link keys}
+        self._dependents = {}  # agreement -> {agreement linked to it: keys}
+        self._valid = set()    # agreements valid on their own
+        self._usable = set()   # valid ones whose linked agreements are too
+        self._cyclic = set()   # agreements on a cycle of links
+        self._dirty = set()    # agreements whose links changed
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._links)
+
+    def add_link(self, key, source, target):
+        """
+            Registers the link key from the agreement source to the
+            agreement target.
+        """
+        with self._lock:
+            if self._links.get(key) == (source, target):
+                return
+            self.remove_link(key)
+            self._links[key] = (source, target)
+            self._linked.setdefault(source, {}) \
+                .setdefault(target, set()).add(key)
+            self._dependents.setdefault(target, {}) \
+                .setdefault(source, set()).add(key)
+            self._dirty.add(source)
+
+    def remove_link(self, key):
+        """
+            Forgets the link key, if it joins two agreements.
+        """
+        with self._lock:
+            if key not in self._links:
+                return
+            source, target = self._links.pop(key)
+            for adjacency, node, other in ((self._linked, source, target),
+                                           (self._dependents, target,
+                                            source)):
+                keys = adjacency[node][other]
+                keys.discard(key)
+                if not keys:
+                    del adjacency[node][other]
+                    if not adjacency[node]:
+                        del adjacency[node]
+            self._dirty.add(source)
+
+    def clear(self):
+        with self._lock:
+            self.__init__()
+
+    def linked(self, agreement):
+        """
+            Returns the agreements the agreement is linked to.
+        """
+        with self._lock:
+            return set(self._linked.get(agreement, ()))
+
+    def dependents(self, agreement):
+        """
+            Returns the agreements linked to the agreement.
+        """
+        with self._lock:
+            return set(self._dependents.get(agreement, ()))
+
+    def affected(self, agreements):
+        """
+            Returns the agreements, with those depending on them directly
+            or through other agreements.
+        """
+        with self._lock:
+            affected = set(agreements)
+            pending = list(affected)
+            while pending:
+                for dependent in self._dependents.get(pending.pop(), ()):
+                    if dependent not in affected:
+                        affected.add(dependent)
+                        pending.append(dependent)
+            return affected
+
+    def cycles(self):
+        """
+            Returns the agreements found on a cycle of links, as of the
+            last update.
+        """
+        with self._lock:
+            return set(self._cyclic)
+
+    def usable(self, agreement):
+        """
+            Returns True if the agreement and every agreement it is linked
+            to, transitively, are valid, as of the last update.
+        """
+        return agreement in self._usable
+
+    def update(self, valid):
+        """
+            Takes the agreements now valid on their own and works out again
+            which of the changed agreements, and of those depending on them,
+            can be enforced. Returns the agreements worked out.
+        """
+        valid = set(valid)
+        with self._lock:
+            changed = (valid ^ self._valid) | self._dirty
+            self._valid = valid
+            self._dirty = set()
+            affected = self.affected(changed)
+            self._evaluate(affected)
+            return affected
+
+    def _evaluate(self, affected):
+        """
+            Works out the affected agreements, linked ones first, by their
+            strongly connected components (Tarjan's, iteratively) restricted
+            to them. Agreements in a component of more than one, or linked
+            to themselves, are on a cycle.
+        """
+        self._usable -= affected
+        self._cyclic -= affected
+        index, low = {}, {}
+        stack, on_stack = [], set()
+        for start in affected:
+            if start in index:
+                continue
+            index[start] = low[start] = len(index)
+            stack.append(start)
+            on_stack.add(start)
+            walk = [(start, iter(self._linked.get(start, ())))]
+            while walk:
+                node, targets = walk[-1]
+                for target in targets:
+                    if target not in affected:
+                        continue
+                    if target not in index:
+                        index[target] = low[target] = len(index)
+                        stack.append(target)
+                        on_stack.add(target)
+                        walk.append((target,
+                                     iter(self._linked.get(target, ()))))
+                        break
+                    if target in on_stack:
+                        low[node] = min(low[node], index[target])
+                else:
+                    walk.pop()
+                    if walk:
+                        parent = walk[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        component = [stack.pop()]
+                        while component[-1] != node:
+                            component.append(stack.pop())
+                        on_stack.difference_update(component)
+                        self._component(component)
+
+    def _component(self, component):
+        """
+            Works out a strongly connected component of the affected
+            agreements, once those it is linked to are worked out.
+        """
+        node = component[0]
+        if len(component) > 1 or node in self._linked.get(node, ()):
+            self._cyclic.update(component)
+        elif node in self._valid and \
+                all(target in self._usable
+                    for target in self._linked.get(node, ())):
+            self._usable.add(node)
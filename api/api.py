@@ -19,25 +19,33 @@
 """
 
 
+import copy
+
 from registry import PersistentReg
+from coordination import ChangeLog
 from occi.core_model import Mixin
 from wsgi import Application
-from pymongo import MongoClient
+from context import LazyDatabase
 import occi_sla
 import occi_violation
 import backends
 import violations_backend
 
-DB = MongoClient().sla
+DB = LazyDatabase()
 NORTH_BND_API = None
+# (terms scheme, term): (term definition, mixin)
+TERM_MIXINS = {}
 
 
-def build():
+def build(shared=False):
     """
-        Construct API as an OCCI Application
+        Construct API as an OCCI Application. A shared API logs the changes
+        to its resources, so that other processes serving the same database
+        can pick them up with registry.sync().
     """
     global NORTH_BND_API
-    NORTH_BND_API = Application(registry=PersistentReg())
+    changes = ChangeLog() if shared else None
+    NORTH_BND_API = Application(registry=PersistentReg(changes))
 
     # Register Agreement
     agreement = backends.Agreement()
@@ -81,11 +89,40 @@ def create_provider_mixins_2(agreement_template):
         add templates and terms as mixins
     """
     mixins = []
+    # read from the primary, as the template lists were just loaded
     for template_list in DB.templates.find({}):
         add_provider_mixins(template_list, agreement_template)
     return mixins
 
 
+def apply_template_diff(application, diff):
+    """
+        Registers the mixins of the templates added or changed by loading a
+        template list, in place of their previous definitions, and removes
+        the mixins of the terms no template of the scheme has any more.
+    """
+    registry = application.registry
+    agreement_template = registry.get_backend(occi_sla.AGREEMENT_TEMPLATE,
+                                              None)
+    updated = {"scheme": diff.scheme,
+               "templates": dict((name, diff.templates[name])
+                                 for name in diff.updated)}
+    templates, terms = build_template_lst_mixins(updated)
+    for mixin in templates + terms:
+        if mixin in registry.backends:
+            registry.delete_mixin(mixin, None)
+        application.register_backend(mixin, agreement_template)
+
+    kept = set()
+    for template in diff.templates.itervalues():
+        kept.update(template["terms"])
+    terms_scheme = str(diff.scheme)[:-1] + "/terms#"
+    for term in diff.removed_terms() - kept:
+        mixin = Mixin(terms_scheme, term)
+        if mixin in registry.backends:
+            registry.delete_mixin(mixin, None)
+
+
 def add_provider_mixins(template_lst, agreement_template):
     """
         Registers mixins with the OCCI model
@@ -98,38 +135,27 @@ def add_provider_mixins(template_lst, agreement_template):
 
 def build_template_lst_mixins(template_list):
     """
-        Takes a list of templates and returns all template and term mixins
+        Takes a list of templates and returns all template and term mixins.
+        A term shared by several templates has a single mixin.
     """
     scheme = str(template_list["scheme"])
     terms_scheme = scheme[:-1] + "/terms#"
-    
+
     temp_mxns = []
-    term_mxns = []
+    term_mxns = {}
 
     for temp_key, template in template_list["templates"].iteritems():
         related = [occi_sla.AGREEMENT_TEMPLATE]
-
+        related.extend(terms_scheme + term_key
+                       for term_key in template["terms"])
         for term_key, term in template["terms"].iteritems():
-            term_scheme = terms_scheme + term_key
-            if term_scheme not in related:
-                related.append(term_scheme)
-        term_mxns += build_term_mixins2(temp_key, template["terms"], scheme)
+            if term_key not in term_mxns:
+                term_mxns[term_key] = term_mixin(terms_scheme, term_key, term)
         mxn = Mixin(scheme, temp_key, related=related, title=temp_key,
                     attributes={})
 
         temp_mxns.append(mxn)
-    return temp_mxns, flatten(term_mxns)
-
-
-def flatten(mxns):
-    """
-        removes any duplicate mixins
-    """
-    flattened_mxns = []
-    for mxn in mxns:
-        if mxn not in flattened_mxns:
-            flattened_mxns.append(mxn)
-    return flattened_mxns
+    return temp_mxns, term_mxns.values()
 
 
 def build_term_mixins(template_terms, scheme):
@@ -156,25 +182,31 @@ def build_term_mixins2(template_name, template_terms, scheme):
         new template format
     """
     scheme = scheme[:-1] + "/terms#"
-    related = [occi_sla.AGREEMENT_TERM]
-    terms = []
-
-    for term_key, term in template_terms.iteritems():
-        attrs = {}
+    return [term_mixin(scheme, term_key, term)
+            for term_key, term in template_terms.iteritems()]
 
-        term_metrics = term['metrics']
-
-        attrs[term_key+'.term.desc'] = "immutable"
-        attrs[term_key+'.term.state'] = "immutable"
-        attrs[term_key+'.term.type'] = "immutable"
-        if 'remedy' in term:
-            attrs[term_key+'.term.remedy'] = "immutable"
-
-        for metric_key in term_metrics:
-            attrs[str(metric_key)] = "immutable"
 
-        term = Mixin(scheme, term_key, related=related, title=term_key,
-                     attributes=attrs)
-        terms.append(term)
-
-    return terms
+def term_mixin(terms_scheme, term_key, term):
+    """
+        Returns the mixin of a term, built once per definition of the term:
+        templates sharing the term, and template lists loaded again without
+        changing it, get the same mixin.
+    """
+    cached = TERM_MIXINS.get((terms_scheme, term_key))
+    if cached is not None and cached[0] == term:
+        return cached[1]
+
+    attrs = {}
+    attrs[term_key+'.term.desc'] = "immutable"
+    attrs[term_key+'.term.state'] = "immutable"
+    attrs[term_key+'.term.type'] = "immutable"
+    if 'remedy' in term:
+        attrs[term_key+'.term.remedy'] = "immutable"
+
+    for metric_key in term['metrics']:
+        attrs[str(metric_key)] = "immutable"
+
+    mixin = Mixin(terms_scheme, term_key, related=[occi_sla.AGREEMENT_TERM],
+                  title=term_key, attributes=attrs)
+    TERM_MIXINS[(terms_scheme, term_key)] = (copy.deepcopy(term), mixin)
+    return mixin
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compact in-memory representation of entity attributes.
+
+Agreements created from the same template carry the same long, dotted
+attribute keys. Rather than one dictionary per entity, the keys are interned
+and held once in a layout shared by every entity with the same key set, while
+each entity only keeps a list of its values.
+
+The AttributeCodec translates attributes to and from their database form, an
+array of {"k": key, "v": value} pairs, so that keys need no escaping. Metric
+thresholds are stored with the native type declared in the metrics
+catalogue, along with their original text ("t") when the typed value would
+render differently.
+"""
+
+import collections
+import copy
+from context import current
+from utils import METRIC_TYPES, typed_metric_value
+
+# Short string values (states, limiter types, ...) are interned as well.
+MAX_INTERNED_VALUE = 32
+
+
+def intern_key(key):
+    """
+        Returns the interned version of an attribute key.
+    """
+    if type(key) is unicode:
+        try:
+            key = str(key)
+        except UnicodeEncodeError:
+            return key
+    if type(key) is str:
+        return intern(key)
+    return key
+
+
+def text_value(value):
+    """
+        Returns the text form in which attribute values are kept in memory,
+        as OCCI renders attributes as strings.
+    """
+    if type(value) is str:
+        return value
+    if type(value) is float:
+        return repr(value)
+    return str(value)
+
+
+def compact_value(value):
+    """
+        Interns short string values, which repeat across agreements.
+    """
+    if type(value) is str and len(value) <= MAX_INTERNED_VALUE:
+        return intern(value)
+    return value
+
+
+class AttributeLayout(object):
+    """
+        An immutable, ordered tuple of interned attribute keys with their
+        positions. Layouts are shared: adding or removing a key moves an
+        entity to another (cached) layout instead of copying its keys.
+    """
+
+    __slots__ = ('keys', 'positions', '_transitions')
+
+    _layouts = {}
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.positions = dict((key, pos) for pos, key in enumerate(keys))
+        self._transitions = {}
+
+    @classmethod
+    def get(cls, keys):
+        """
+            Returns the shared layout for the given ordered keys.
+        """
+        keys = tuple(intern_key(key) for key in keys)
+        layout = cls._layouts.get(keys)
+        if layout is None:
+            layout = cls._layouts.setdefault(keys, cls(keys))
+        return layout
+
+    @classmethod
+    def count(cls):
+        """
+            Returns the number of distinct layouts in use.
+        """
+        return len(cls._layouts)
+
+    def with_key(self, key):
+        """
+            Returns the layout extending this one by a key.
+        """
+        layout = self._transitions.get(key)
+        if layout is None:
+            layout = self.get(self.keys + (key,))
+            self._transitions[key] = layout
+        return layout
+
+    def without_key(self, key):
+        """
+            Returns the layout of this one minus a key.
+        """
+        return self.get(tuple(k for k in self.keys if k != key))
+
+
+class CompactAttributes(object):
+    """
+        Dictionary view over a shared AttributeLayout and a list of values.
+        Behaves as a normal dict for the backends and the pyssf renderers.
+    """
+
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, attributes=None):
+        attributes = attributes or {}
+        keys = sorted(attributes)
+        self._layout = AttributeLayout.get(keys)
+        self._values = [compact_value(attributes[key]) for key in keys]
+
+    def __getitem__(self, key):
+        return self._values[self._layout.positions[key]]
+
+    def __setitem__(self, key, value):
+        pos = self._layout.positions.get(key)
+        if pos is None:
+            self._layout = self._layout.with_key(intern_key(key))
+            self._values.append(compact_value(value))
+        else:
+            self._values[pos] = compact_value(value)
+
+    def __delitem__(self, key):
+        pos = self._layout.positions[key]
+        self._layout = self._layout.without_key(key)
+        del self._values[pos]
+
+    def __contains__(self, key):
+        return key in self._layout.positions
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __copy__(self):
+        duplicate = CompactAttributes.__new__(CompactAttributes)
+        duplicate._layout = self._layout
+        duplicate._values = list(self._values)
+        return duplicate
+
+    def __deepcopy__(self, memo):
+        duplicate = CompactAttributes.__new__(CompactAttributes)
+        duplicate._layout = self._layout
+        duplicate._values = copy.deepcopy(self._values, memo)
+        return duplicate
+
+    def keys(self):
+        return list(self._layout.keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._layout.keys, self._values)
+
+    def iterkeys(self):
+        return iter(self._layout.keys)
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return iter(zip(self._layout.keys, self._values))
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        pos = self._layout.positions.get(key)
+        if pos is None:
+            return default
+        return self._values[pos]
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self and default:
+            return default[0]
+        value = self[key]
+        del self[key]
+        return value
+
+    def update(self, other=(), **kwargs):
+        if hasattr(other, 'keys'):
+            for key in other.keys():
+                self[key] = other[key]
+        else:
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def clear(self):
+        self._layout = AttributeLayout.get(())
+        self._values = []
+
+    def copy(self):
+        return self.__copy__()
+
+
+collections.MutableMapping.register(CompactAttributes)
+
+
+class AttributeCodec(object):
+    """
+        Encodes attributes as an array of {"k": key, "v": value} pairs, see
+        encode_pair, and
+        decodes them back, also accepting the legacy subdocument where the
+        '.' in keys was replaced by '^'. Decoded keys and the value type of
+        each key are cached, as the key space is small and fixed per template.
+    """
+
+    def __init__(self, metrics=None):
+        self._keys = {}
+        self._legacy_keys = {}
+        self._value_types = {}
+        self._metrics = metrics
+
+    @property
+    def metrics(self):
+        """
+            The metrics catalogue, the one of the application context
+            unless given.
+        """
+        if self._metrics is None:
+            return current().metrics
+        return self._metrics
+
+    def encode(self, attributes):
+        """
+            Returns the database representation of the attributes.
+        """
+        return [self.encode_pair(key, value)
+                for key, value in attributes.iteritems()]
+
+    def encode_pair(self, key, value):
+        """
+            Returns the {"k": key, "v": value} pair of an attribute. The
+            original text of a threshold is kept as "t" when its typed value
+            renders differently, e.g. "98" of a real metric.
+        """
+        stored = self.typed_value(key, value)
+        pair = {"k": key, "v": stored}
+        if type(stored) is not str and text_value(stored) != text_value(value):
+            pair["t"] = text_value(value)
+        return pair
+
+    def decode(self, stored):
+        """
+            Returns the CompactAttributes of a database representation.
+        """
+        if isinstance(stored, dict):
+            return self._decode_pairs(stored.iteritems(), self._legacy_keys,
+                                      "^")
+        return self._decode_pairs(((pair["k"], pair.get("t", pair["v"]))
+                                   for pair in stored), self._keys)
+
+    def typed_value(self, key, value):
+        """
+            Returns the attribute value with the native type of the metric
+            it belongs to, or as a string for any other attribute.
+        """
+        value_type = self._value_types.get(key)
+        if value_type is None:
+            value_type = self._value_types.setdefault(key,
+                                                      self._value_type(key))
+        if value_type:
+            try:
+                return typed_metric_value(value_type, value)
+            except (TypeError, ValueError):
+                pass
+        return str(value)
+
+    def _value_type(self, key):
+        """
+            Returns the metric value type of an attribute key, or '' for
+            attributes which are not metric thresholds. Thresholds are
+            <template>.<term>.<metric>, with its limiter_value and exit_value,
+            and the <term>.term.min_hold hold time.
+        """
+        parts = key.split(".")
+        if len(parts) == 3 and parts[1] == "term":
+            return "real" if parts[2] == "min_hold" else ""
+        if parts[0] == "occi" or parts[2:3] == ["term"]:
+            return ""
+        if len(parts) == 4 and \
+                parts[3] in ("limiter_value", "exit_value") and \
+                parts[2] in self.metrics:
+            # margins and exit thresholds of numeric metrics
+            return "real"
+        if len(parts) == 3 and parts[2] in self.metrics:
+            value_type = self.metrics[parts[2]]["value"]
+            if value_type in METRIC_TYPES:
+                return value_type
+        return ""
+
+    @staticmethod
+    def is_legacy(stored):
+        """
+            Returns True if the attributes are in the legacy '^' format.
+        """
+        return isinstance(stored, dict)
+
+    @staticmethod
+    def _decode_pairs(pairs, keys, separator=None):
+        """
+            Builds the attributes from (key, value) pairs, translating keys
+            through the given cache.
+        """
+        attrs_d = {}
+        for a_key, a_val in pairs:
+            key = keys.get(a_key)
+            if key is None:
+                key = a_key.replace(separator, ".") if separator else a_key
+                key = keys.setdefault(a_key, intern_key(key))
+            attrs_d[key] = text_value(a_val)
+        return CompactAttributes(attrs_d)
+
+
+CODEC = AttributeCodec()
@@ -19,14 +19,15 @@
 """
 
 from occi.backend import ActionBackend, KindBackend, MixinBackend
-from pymongo import MongoClient
 from api import occi_sla
 import logging
 import arrow
-import copy
 import api
+from windows import window_spec, window_text
+from context import LazyDatabase
+from entity_dictionary import update_links
 
-DB = MongoClient().sla
+DB = LazyDatabase()
 
 
 class Agreement(KindBackend, ActionBackend):
@@ -40,7 +41,14 @@ class Agreement(KindBackend, ActionBackend):
         self.verify_provider(extras)
         self.validate(entity)
 
-        # Init Agreement
+        self.init_agreement(entity, extras, template_catalogue())
+
+    def init_agreement(self, entity, extras, catalogue):
+        """
+            Initialises a validated agreement of the provider in extras: its
+            state, and the mixins and attributes of the terms of its
+            templates, looked up in catalogue (see template_catalogue).
+        """
         entity.provider = self._get_provider(extras)
         entity.customer = self.get_customer(extras)
         entity.attributes["occi.agreement.state"] = "pending"
@@ -51,20 +59,16 @@ class Agreement(KindBackend, ActionBackend):
         attrs = {}
         for mxn in entity.mixins:
             if occi_sla.AGREEMENT_TEMPLATE in mxn.related:
-                for tmp_lst in DB.templates.find({}):
-                    if mxn.scheme == tmp_lst["scheme"] \
-                            and mxn.term in tmp_lst["templates"]:
-                        template = tmp_lst["templates"][mxn.term]['terms']
-
-                        for term_name in template:
-                            mxns.append(self._get_term(term_name))
-                            attrs.update(self._get_term_metrics
-                                         (mxn.term, template, term_name))
-                            # ToDo check in needed
-                            # attrs.update(self._get_term_type_attrs(
-                            # term_name))
-
-                        break
+                template = catalogue.get((mxn.scheme, mxn.term))
+                if template is None:
+                    continue
+                for term_name in template:
+                    mxns.append(self._get_term(term_name))
+                    attrs.update(self._get_term_metrics
+                                 (mxn.term, template, term_name))
+                    # ToDo check in needed
+                    # attrs.update(self._get_term_type_attrs(
+                    # term_name))
         entity.mixins.extend(mxns)
         entity.attributes.update(attrs)
 
@@ -96,12 +100,7 @@ class Agreement(KindBackend, ActionBackend):
             raise AttributeError("Provider Denied")
 
         if action == occi_sla.ACCEPT_ACTION:
-            if not self._agreement_expired(entity):
-                self._set_state(entity, "accepted", "pending")
-                now_iso = arrow.utcnow().isoformat()
-                entity.attributes["occi.agreement.agreedAt"] = now_iso
-            else:
-                raise AttributeError("Expired. re-negotiate duration")
+            self.accept(entity)
         elif action == occi_sla.REJECT_ACTION:
             self._set_state(entity, "rejected", "pending")
         elif action == occi_sla.SUSPEND_ACTION:
@@ -109,6 +108,17 @@ class Agreement(KindBackend, ActionBackend):
         elif action == occi_sla.UNSUSPEND_ACTION:
             self._set_state(entity, "accepted", "suspended")
 
+    def accept(self, entity):
+        """
+            Accepts a pending agreement which has not expired.
+        """
+        if not self._agreement_expired(entity):
+            self._set_state(entity, "accepted", "pending")
+            now_iso = arrow.utcnow().isoformat()
+            entity.attributes["occi.agreement.agreedAt"] = now_iso
+        else:
+            raise AttributeError("Expired. re-negotiate duration")
+
     @classmethod
     def _get_template_attributes(cls, template, template_name):
         """
@@ -146,17 +156,13 @@ class Agreement(KindBackend, ActionBackend):
             Returns True if an attribute is not belonging to the agreement
             or a mixin
         """
-        posted_attributes = copy.deepcopy(entity.attributes)
+        posted_attributes = set(entity.attributes)
         # check agreement attributes
-        for a_attr_k in entity.kind.attributes:
-            if a_attr_k in posted_attributes:
-                del posted_attributes[a_attr_k]
+        posted_attributes.difference_update(entity.kind.attributes)
 
         # check mixin types
         for mixin in entity.mixins:
-            for m_attr_k in mixin.attributes:
-                if m_attr_k in posted_attributes:
-                    del posted_attributes[m_attr_k]
+            posted_attributes.difference_update(mixin.attributes)
 
         if len(posted_attributes) > 0:
             return True
@@ -250,11 +256,23 @@ class Agreement(KindBackend, ActionBackend):
                     key = "{}.{}.{}.{}".format(
                         template_name, term, metric, 'limiter_value')
                     attrs[key] = term_metrics[metric]['limiter_value']
+                if 'window' in term_metrics[metric]:
+                    key = "{}.{}.{}.{}".format(
+                        template_name, term, metric, 'window')
+                    attrs[key] = window_text(
+                        window_spec(term_metrics[metric]['window']))
+                if 'exit_value' in term_metrics[metric]:
+                    key = "{}.{}.{}.{}".format(
+                        template_name, term, metric, 'exit_value')
+                    attrs[key] = term_metrics[metric]['exit_value']
 
                 if 'remedy' in template[term]:
                     term_remedy = template[term]['remedy']
                     key = "{}.{}.{}".format(term, 'term', 'remedy')
                     attrs[key] = term_remedy
+                if 'min_hold' in template[term]:
+                    key = "{}.{}.{}".format(term, 'term', 'min_hold')
+                    attrs[key] = template[term]['min_hold']
 
         return attrs
 
@@ -434,19 +452,9 @@ class AgreementLink(KindBackend):
         if target_id == '':
             raise AttributeError('Target endpoint is empty!')
 
-        link_id = entity.identifier
-
-        db_agreements = DB.entities.find({'_id': agreement_id})
-        if db_agreements.count() > 0:
-            for agreement in db_agreements:
-                # checking if the target link in the link is of the kind
-                # allowed in the accosiated templates of the source agreement
-                # self._check_target_link_kind(agreement, target_id)
-
-                if agreement['kind'] == '/agreement/' and link_id \
-                        not in agreement['links']:
-                    agreement['links'].append(link_id)
-                    DB.entities.update({'_id': agreement_id}, agreement)
+        # ToDo: check that the target is of a kind allowed by the templates
+        # of the source agreement, see _check_target_link_kind
+        attach_links({agreement_id: [entity.identifier]})
 
         # Init Agreement
         entity.provider = Agreement()._get_provider(extras)
@@ -462,15 +470,7 @@ class AgreementLink(KindBackend):
             raise AttributeError("Provider Denied")
 
         agreement_id = entity.attributes['occi.core.source']
-        link_id = entity.identifier
-
-        db_agreements = DB.entities.find({'_id': agreement_id})
-        if db_agreements.count() > 0:
-            for agreement in db_agreements:
-                if agreement['kind'] == '/agreement/' and link_id \
-                        in agreement['links']:
-                    agreement['links'].remove(link_id)
-                    DB.entities.update({'_id': agreement_id}, agreement)
+        detach_links({agreement_id: [entity.identifier]})
 
     # Still under development
     def _check_target_link_kind(self, source_agreement, target_id):
@@ -562,6 +562,41 @@ class AgreementTemplate(MixinBackend):
     pass
 
 
+def attach_links(attachments):
+    """
+    Adds links to agreements, given as {agreement id: [link ids]}, with atomic
+    updates of the agreement records. Goes through the entities of the API
+    once it is built, so that their versions follow.
+    """
+    if api.NORTH_BND_API is None:
+        update_links(DB.entities, attachments)
+    else:
+        api.NORTH_BND_API.registry.resources.attach_links(attachments)
+
+
+def detach_links(detachments):
+    """
+    Removes links from agreements, given as {agreement id: [link ids]}, see
+    attach_links.
+    """
+    if api.NORTH_BND_API is None:
+        update_links(DB.entities, detachments, attach=False)
+    else:
+        api.NORTH_BND_API.registry.resources.detach_links(detachments)
+
+
+def template_catalogue():
+    """
+    Returns the terms of the provider templates by (scheme, template name),
+    read in one query.
+    """
+    catalogue = {}
+    for tmp_lst in DB.templates.find({}):
+        for name, template in tmp_lst["templates"].iteritems():
+            catalogue.setdefault((tmp_lst["scheme"], name), template["terms"])
+    return catalogue
+
+
 def clean_dictionary(attr_dict):
     """
     Removes unicode strings from the dictionary.
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Bulk creation of agreements. A provider POSTs a batch of agreements of one
+customer to /bulk/agreements, as JSON:
+
+    {"accept": true,
+     "agreements": [
+        {"templates": ["http://sla.dss.org/agreements#dss_gold"],
+         "attributes": {"occi.agreement.effectiveFrom": "...",
+                        "occi.agreement.effectiveUntil": "..."},
+         "links": ["/compute/vm1"]}]}
+
+The credentials are checked and the templates read once for the whole batch,
+and the agreements, with their agreement links to the given devices, are
+written with one bulk of inserts. The reply has the result of every
+agreement, in order: its location and links, or the error refusing it.
+
+Existing agreements are linked to devices by POSTing to /bulk/links:
+
+    {"links": [{"agreement": "/agreement/...", "devices": ["/compute/vm2"]}]}
+
+The links are inserted in one bulk, and attached to their agreements with
+one bulk of atomic updates.
+"""
+
+import json
+
+from occi import core_model
+from occi.workflow import create_id
+
+import occi_sla
+from context import LazyDatabase
+from utils import authorised_provider, wsgi_reply
+
+DB = LazyDatabase()
+
+PATH = "/bulk/agreements"
+LINKS_PATH = "/bulk/links"
+
+
+def create_agreements(registry, items, extras, accept=False):
+    """
+        Creates the agreements described by items, and their links to
+        devices, for the provider and customer in extras. Accepts them too if
+        accept is True. Returns the result of every item.
+        Imported here, as the backends import the API module, which builds
+        the application serving this.
+    """
+    import backends
+
+    backend = backends.Agreement()
+    backend.verify_provider(extras)
+    provider = backend._get_provider(extras)
+    customer = backend.get_customer(extras)
+
+    catalogue = backends.template_catalogue()
+    template_mixins = dict(
+        (category.scheme + category.term, category)
+        for category in registry.backends
+        if isinstance(category, core_model.Mixin) and
+        occi_sla.AGREEMENT_TEMPLATE in category.related)
+
+    results = []
+    entities = []
+    for index, item in enumerate(items):
+        try:
+            agreement = _new_agreement(backend, item, template_mixins,
+                                       catalogue, extras, accept)
+            links = [_new_link(agreement, target, provider, customer)
+                     for target in item.get("links", [])]
+        except (AttributeError, KeyError, TypeError, ValueError) as err:
+            results.append({"index": index, "error": str(err)})
+            continue
+        agreement.links.extend(links)
+        for entity in [agreement] + links:
+            entity.extras = registry.get_extras(extras)
+            entities.append((entity.identifier, entity))
+        results.append({"index": index,
+                        "location": agreement.identifier,
+                        "state": agreement.attributes["occi.agreement.state"],
+                        "links": [link.identifier for link in links]})
+
+    failed = registry.resources.store_many(entities)
+    for position, result in enumerate(results):
+        if result.get("location") in failed:
+            # its links should not outlive it
+            for link in result["links"]:
+                if link not in failed:
+                    del registry.resources[link]
+            results[position] = {"index": result["index"],
+                                 "error": failed[result["location"]]}
+    return results
+
+
+def link_agreements(registry, items, extras):
+    """
+        Links agreements of the provider in extras to devices, every item
+        giving an agreement and its devices. Returns the result of every
+        item.
+    """
+    import backends
+
+    backend = backends.Agreement()
+    backend.verify_provider(extras)
+    provider = backend._get_provider(extras)
+    customer = backend.get_customer(extras)
+    resources = registry.resources
+
+    results = []
+    entities = []
+    linked = []
+    for index, item in enumerate(items):
+        try:
+            key = str(item["agreement"])
+            agreement = resources.get(key)
+            if agreement is None or agreement.kind != occi_sla.AGREEMENT or \
+                    getattr(agreement, "provider", None) != provider:
+                raise AttributeError("Unknown agreement {0}".format(key))
+            links = [_new_link(agreement, target, provider, customer)
+                     for target in item["devices"]]
+        except (AttributeError, KeyError, TypeError, ValueError) as err:
+            results.append({"index": index, "error": str(err)})
+            continue
+        for link in links:
+            link.extras = registry.get_extras(extras)
+            entities.append((link.identifier, link))
+        linked.append((key, agreement, links))
+        results.append({"index": index, "location": key,
+                        "links": [link.identifier for link in links]})
+
+    failed = resources.store_many(entities)
+    attachments = {}
+    for key, agreement, links in linked:
+        links = [link for link in links if link.identifier not in failed]
+        with resources.lock(key):
+            agreement.links.extend(links)
+        attachments.setdefault(key, []).extend(link.identifier
+                                               for link in links)
+    resources.attach_links(attachments)
+    for result in results:
+        errors = [failed[link] for link in result.get("links", ())
+                  if link in failed]
+        if errors:
+            result["links"] = [link for link in result["links"]
+                               if link not in failed]
+            result["errors"] = errors
+    return results
+
+
+def _new_agreement(backend, item, template_mixins, catalogue, extras,
+                   accept):
+    """
+        Builds, validates and initialises an agreement, as Agreement.create
+        does, from the templates and attributes of a batch item.
+    """
+    mixins = []
+    for template in item["templates"]:
+        if template not in template_mixins:
+            raise AttributeError("Unknown template {0}".format(template))
+        mixins.append(template_mixins[template])
+
+    agreement = core_model.Resource(create_id(occi_sla.AGREEMENT),
+                                    occi_sla.AGREEMENT, mixins)
+    agreement.attributes = dict((str(name), value) for name, value
+                                in item.get("attributes", {}).iteritems())
+    backend.validate(agreement)
+    backend.init_agreement(agreement, extras, catalogue)
+    if accept:
+        backend.accept(agreement)
+    return agreement
+
+
+def _new_link(agreement, target, provider, customer):
+    """
+        Builds the agreement link of an agreement to a device.
+    """
+    if not target:
+        raise AttributeError('Target endpoint is empty!')
+    target = str(target)
+    link = core_model.Link(create_id(occi_sla.AGREEMENT_LINK),
+                           occi_sla.AGREEMENT_LINK, [], agreement, target)
+    link.attributes = {'occi.core.source': agreement.identifier,
+                       'occi.core.target': target}
+    link.provider = provider
+    link.customer = customer
+    return link
+
+
+def serve(environ, response, registry):
+    """
+    Creates a batch of agreements, or of links, POSTed by a provider, see
+    the module documentation.
+    :param environ: Environment Dictionary of the request
+    :param response: WSGI start_response
+    :param registry: Registry of the application
+    :return: Body
+    """
+    if environ.get("REQUEST_METHOD") != "POST":
+        return wsgi_reply(response, "405 Method Not Allowed", "text/plain",
+                          "Batches are POSTed", [("Allow", "POST")])
+    provider = authorised_provider(environ, DB.providers)
+    if provider is None:
+        return wsgi_reply(response, "403 Forbidden", "text/plain",
+                          "Incorrect Provider Credentials")
+
+    extras = {"security": {provider: environ.get("HTTP_PROVIDER_PASS")},
+              "customer": environ.get("HTTP_CUSTOMER")}
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        batch = json.loads(environ["wsgi.input"].read(length))
+        items = "links" if environ.get("PATH_INFO") == LINKS_PATH \
+            else "agreements"
+        if not isinstance(batch, dict) or \
+                not isinstance(batch.get(items), list):
+            raise ValueError("Expected a list of {0}".format(items))
+        if items == "links":
+            results = link_agreements(registry, batch["links"], extras)
+        else:
+            results = create_agreements(registry, batch["agreements"],
+                                        extras, bool(batch.get("accept")))
+    except (ValueError, AttributeError) as err:
+        return wsgi_reply(response, "400 Bad Request", "text/plain", str(err))
+
+    return wsgi_reply(response, "200 OK", "application/json",
+                      json.dumps({"results": results}))
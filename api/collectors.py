@@ -22,9 +22,10 @@ import logging
 import abc
 import threading
 import time
-import json
 import ConfigParser
 import aggregator
+from context import LazyMetrics
+from utils import METRIC_TYPES, typed_metric_value
 
 LOG = logging.getLogger(__name__)
 fh = logging.FileHandler('logs/collectors.log')
@@ -36,7 +37,7 @@ fh.setFormatter(formatter)
 # add the handlers to the logger
 LOG.addHandler(fh)
 
-METRICS = json.load(file("configs/metrics.json"))
+METRICS = LazyMetrics()
 
 
 class Collector(object):
@@ -44,7 +45,7 @@ class Collector(object):
 
     @abc.abstractmethod
     def subscribe_metric(self, device_id, metric, metric_value,
-                         limiter_type, limiter_value):
+                         limiter_type, limiter_value, every_sample=False):
         """
             This is an abstract method for subscribing a metric
             to the collector.
@@ -56,6 +57,8 @@ class Collector(object):
              min, marginal or enum
             limiter value: if the type of monitoring is marginal, this value
             gives the percentage of the accepted marginal variation.
+            every_sample: pass on every sample, not only violating ones, as
+            the metric is evaluated over a window or has an exit value.
             It returns True is the subscription is successful or False if there
              is some failure.
         """
@@ -88,7 +91,8 @@ class Collector(object):
         metric_value = self.format_metric_value(metric_name, metric_value)
 
         if limiter_type == 'margin':
-            margin_percentage = float(margin_value) / 100.0
+            margin_percentage = typed_metric_value('real',
+                                                   margin_value) / 100.0
             low_margin = slo_metric_value - \
                          slo_metric_value * margin_percentage
             high_margin = slo_metric_value + \
@@ -124,12 +128,9 @@ class Collector(object):
         """
 
         if metric_name in METRICS:
-            if METRICS[metric_name]['value'] == 'integer':
-                metric_value = int(metric_value)
-            elif METRICS[metric_name]['value'] == 'real':
-                metric_value = float(metric_value)
-            elif METRICS[metric_name]['value'] == 'string':
-                metric_value = str(metric_value)
+            value_type = METRICS[metric_name]['value']
+            if value_type in METRIC_TYPES:
+                metric_value = typed_metric_value(value_type, metric_value)
 
             return metric_value
 
@@ -147,9 +148,10 @@ class DummyCollector(Collector):
     _subscriptions = {}
 
     def __init__(self):
+        pass
 
     def subscribe_metric(self, device_id, metric, slo_value,
-                         limiter_type, margin_value):
+                         limiter_type, margin_value, every_sample=False):
         """
             Public Subscription method for a metric
         """
@@ -158,7 +160,7 @@ class DummyCollector(Collector):
             subscription_thread = threading. \
                 Thread(target=self.__metric_subscription,
                        args=(device_id, metric, slo_value, limiter_type,
-                             margin_value,))
+                             margin_value, every_sample,))
 
             DummyCollector._subscriptions[device_id + "#" + metric] = \
                 subscription_thread
@@ -193,7 +195,7 @@ class DummyCollector(Collector):
             return False
 
     def __metric_subscription(self, device_id, metric, slo_value,
-                              limiter_type, margin_value):
+                              limiter_type, margin_value, every_sample):
         """
             Private method for implementing the thread loop
         """
@@ -201,10 +203,11 @@ class DummyCollector(Collector):
         while device_id + "#" + metric in DummyCollector._subscriptions:
             LOG.debug('Checking {}#{}'.format(device_id, metric))
             value = self.pull_metric(device_id, metric)
-            if self.metric_violated(metric, slo_value, value,
-                                    limiter_type, margin_value):
-                gator = aggregator.Aggregator()
-                gator.notification_event(device_id, metric, value)
+            # windows aggregate every sample, and violations are exited on
+            # fulfilling ones; other metrics only need violating samples
+            if value is not None and (every_sample or self.metric_violated(
+                    metric, slo_value, value, limiter_type, margin_value)):
+                aggregator.BATCHER.add(device_id, metric, value)
             time.sleep(15)
 
     def pull_metric(self, device_id, metric_name):
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+The application context: one MongoDB client shared by all the modules, the
+metrics catalogue and the RabbitMQ settings. Nothing is connected to or read
+until first used, so importing the API costs no I/O, e.g. in every process
+forked by the server. Modules keep their DB and METRICS names, which stand
+for the database and catalogue of the current context. Tests can install a
+context of their own.
+
+The client is configured by configs/mongo.cfg: pool size and timeouts in
+the mongo section, the read preference of kinds of reads (listing, history)
+in the reads section, and the write concern of kinds of writes (term_state,
+agreement) in the writes section, as w[:wtimeout_ms]. Commands slower than
+slow_query_ms of the mongo section are logged.
+"""
+
+import ConfigParser
+import collections
+import json
+import logging
+import threading
+
+from pymongo import MongoClient, ReadPreference, WriteConcern, monitoring
+
+LOG = logging.getLogger(__name__)
+# create console handler with a higher log level
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+# create formatter and add it to the handlers
+formatter = logging.Formatter('%(asctime)s - %(name)s - ' +
+                              '%(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+# add the handlers to the logger
+LOG.addHandler(ch)
+
+METRICS_FILE = "configs/metrics.json"
+RABBIT_FILE = "configs/rabbit.cfg"
+MONGO_FILE = "configs/mongo.cfg"
+
+# Options of the mongo section: (option, type, default, MongoClient keyword)
+CLIENT_OPTIONS = (
+    ("host", str, "localhost", "host"),
+    ("port", int, 27017, "port"),
+    ("max_pool_size", int, 100, "maxPoolSize"),
+    ("server_selection_timeout_ms", int, 5000, "serverSelectionTimeoutMS"),
+    ("connect_timeout_ms", int, 5000, "connectTimeoutMS"),
+    ("socket_timeout_ms", int, 30000, "socketTimeoutMS"),
+    ("wait_queue_timeout_ms", int, 5000, "waitQueueTimeoutMS"))
+# Database commands taking longer are logged, in milliseconds.
+SLOW_QUERY_MS = 100
+
+READ_PREFERENCES = {"primary": ReadPreference.PRIMARY,
+                    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+                    "secondary": ReadPreference.SECONDARY,
+                    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+                    "nearest": ReadPreference.NEAREST}
+
+TIMEOUT = monitoring.ConnectionCheckOutFailedReason.TIMEOUT
+
+
+def mongo_settings(config_file=MONGO_FILE):
+    """
+    Reads the MongoDB settings, see the module documentation. Returns a dict
+    of the MongoClient keywords, the read preferences and write concerns.
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(config_file)
+    client = {}
+    for option, option_type, default, keyword in CLIENT_OPTIONS:
+        value = default
+        if config.has_option("mongo", option):
+            value = option_type(config.get("mongo", option))
+        client[keyword] = value
+    slow_query_ms = SLOW_QUERY_MS
+    if config.has_option("mongo", "slow_query_ms"):
+        slow_query_ms = config.getint("mongo", "slow_query_ms")
+
+    reads = {}
+    if config.has_section("reads"):
+        for kind, mode in config.items("reads"):
+            if mode not in READ_PREFERENCES:
+                raise AttributeError("Unknown read preference {0} for {1}"
+                                     .format(mode, kind))
+            reads[kind] = READ_PREFERENCES[mode]
+
+    writes = {}
+    if config.has_section("writes"):
+        for kind, concern in config.items("writes"):
+            w, _, wtimeout = concern.partition(":")
+            writes[kind] = WriteConcern(
+                w=int(w) if w.isdigit() else w,
+                wtimeout=int(wtimeout) if wtimeout else None)
+    return {"client": client, "reads": reads, "writes": writes,
+            "slow_query_ms": slow_query_ms}
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+        Counts the connections of the pool in use and the operations
+        waiting for one, to tell how saturated the pool is.
+    """
+
+    def __init__(self, max_pool_size=None):
+        self.max_pool_size = max_pool_size
+        self.open = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.waiting = 0
+        self.check_outs = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """
+            Returns the counters, and the share of the pool in use.
+        """
+        with self._lock:
+            stats = {"open": self.open,
+                     "in_use": self.in_use,
+                     "peak_in_use": self.peak_in_use,
+                     "waiting": self.waiting,
+                     "check_outs": self.check_outs,
+                     "timeouts": self.timeouts,
+                     "max_pool_size": self.max_pool_size}
+        stats["saturation"] = float(self.in_use) / self.max_pool_size \
+            if self.max_pool_size else 0.0
+        return stats
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self.waiting += 1
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.waiting -= 1
+            if event.reason == TIMEOUT:
+                self.timeouts += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.waiting -= 1
+            self.in_use += 1
+            self.check_outs += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+class SlowQueries(monitoring.CommandListener):
+    """
+        Logs the database commands taking longer than slow_ms milliseconds.
+    """
+
+    def __init__(self, slow_ms=SLOW_QUERY_MS):
+        self.slow_ms = slow_ms
+        self.slow = 0
+        self._commands = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._commands[event.request_id] = (
+            collection, event.command.get("filter", event.command.get("q")))
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        collection, query = self._commands.pop(event.request_id,
+                                               (None, None))
+        elapsed = event.duration_micros / 1000.0
+        if elapsed > self.slow_ms:
+            self.slow += 1
+            LOG.warn("Slow {0} on {1} ({2} ms): {3}"
+                     .format(event.command_name, collection, elapsed, query))
+
+
+class AppContext(object):
+    """
+        Shared client and configuration, loaded on first use.
+    """
+
+    def __init__(self, client=None, metrics=None, rabbit=None, mongo=None,
+                 metrics_file=METRICS_FILE, rabbit_file=RABBIT_FILE,
+                 mongo_file=MONGO_FILE):
+        self.metrics_file = metrics_file
+        self.rabbit_file = rabbit_file
+        self.mongo_file = mongo_file
+        self._client = client
+        self._metrics = metrics
+        self._rabbit = rabbit
+        self._mongo = mongo
+        self._collections = {}
+        self._lock = threading.Lock()
+        self.pool = PoolStats()
+        self.slow_queries = SlowQueries()
+
+    @property
+    def mongo(self):
+        """
+            The MongoDB settings, see mongo_settings.
+        """
+        if self._mongo is None:
+            self._mongo = mongo_settings(self.mongo_file)
+        return self._mongo
+
+    @property
+    def client(self):
+        """
+            The MongoClient, whose connection pool every module shares.
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    options = self.mongo["client"]
+                    self.pool = PoolStats(options["maxPoolSize"])
+                    self.slow_queries = SlowQueries(
+                        self.mongo["slow_query_ms"])
+                    self._client = MongoClient(
+                        event_listeners=[self.pool, self.slow_queries],
+                        **options)
+        return self._client
+
+    @property
+    def db(self):
+        """
+            The sla database.
+        """
+        return self.client.sla
+
+    def options(self, reads=None, writes=None):
+        """
+            Returns the read preference and write concern configured for a
+            kind of reads and of writes, as collection options.
+        """
+        options = {}
+        if reads in self.mongo["reads"]:
+            options["read_preference"] = self.mongo["reads"][reads]
+        if writes in self.mongo["writes"]:
+            options["write_concern"] = self.mongo["writes"][writes]
+        return options
+
+    def collection(self, name, reads=None, writes=None):
+        """
+            Returns a collection of the sla database, with the read
+            preference and write concern of the given kinds of operations.
+        """
+        key = (name, reads, writes)
+        collection = self._collections.get(key)
+        if collection is None:
+            collection = self._collections[key] = self.db.get_collection(
+                name, **self.options(reads, writes))
+        return collection
+
+    @property
+    def metrics(self):
+        """
+            The metrics catalogue.
+        """
+        if self._metrics is None:
+            with open(self.metrics_file) as metrics:
+                self._metrics = json.load(metrics)
+        return self._metrics
+
+    @property
+    def rabbit(self):
+        """
+            The options of the rabbit section of the RabbitMQ config.
+        """
+        if self._rabbit is None:
+            config = ConfigParser.ConfigParser()
+            config.read(self.rabbit_file)
+            self._rabbit = dict(config.items("rabbit")) \
+                if config.has_section("rabbit") else {}
+        return self._rabbit
+
+    def loaded(self):
+        """
+            Returns the names of what has been loaded so far.
+        """
+        return [name for name, value in (("client", self._client),
+                                         ("metrics", self._metrics),
+                                         ("rabbit", self._rabbit),
+                                         ("mongo", self._mongo))
+                if value is not None]
+
+    def after_fork(self):
+        """
+            Forgets the client inherited from the parent process, MongoClient
+            not being fork-safe. The child connects on first use.
+        """
+        self._client = None
+        self._collections = {}
+        self._lock = threading.Lock()
+
+
+_CURRENT = AppContext()
+
+
+def current():
+    """
+    Returns the current application context.
+    """
+    return _CURRENT
+
+
+def install(context):
+    """
+    Makes context the current application context, returns the previous one.
+    """
+    global _CURRENT
+    previous, _CURRENT = _CURRENT, context
+    return previous
+
+
+class LazyDatabase(object):
+    """
+        The sla database of the current context, or one of its collections
+        with the options of the given kinds of reads and writes, looked up
+        when used.
+    """
+
+    def __init__(self, collection=None, reads=None, writes=None):
+        self._collection = collection
+        self._reads = reads
+        self._writes = writes
+
+    def _target(self):
+        if self._collection is None:
+            return current().db
+        return current().collection(self._collection, self._reads,
+                                    self._writes)
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __getitem__(self, name):
+        return self._target()[name]
+
+
+class LazyMetrics(collections.Mapping):
+    """
+        The metrics catalogue of the current context, read when used.
+    """
+
+    def __getitem__(self, name):
+        return current().metrics[name]
+
+    def __iter__(self):
+        return iter(current().metrics)
+
+    def __len__(self):
+        return len(current().metrics)
+
+    def __contains__(self, name):
+        return name in current().metrics
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Coordination between the processes sharing the same database: a lease to
+elect a single holder of a role, and a log of changed entities so that the
+in-memory registries of the processes can be kept up to date.
+"""
+
+import os
+import socket
+import time
+
+from pymongo.errors import DuplicateKeyError
+from context import LazyDatabase
+
+DB = LazyDatabase()
+
+# Seconds a sequence number not read is looked for again, as a writer takes
+# its number before it records the change, so a change can show up after a
+# later one.
+CHANGE_WAIT = 30
+
+
+class Lease(object):
+    """
+        A named, expiring lease in the leases collection. Only one holder
+        at a time can acquire it; it has to be renewed (acquired again)
+        before it expires.
+    """
+
+    def __init__(self, name, ttl=45, holder=None, leases=None):
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or "{0}:{1}".format(socket.gethostname(),
+                                                 os.getpid())
+        self.leases = leases if leases is not None else DB.leases
+
+    def acquire(self):
+        """
+            Acquires or renews the lease. Returns True if it is held by this
+            holder, False if another holder has it.
+        """
+        now = time.time()
+        try:
+            record = self.leases.find_and_modify(
+                query={"_id": self.name,
+                       "$or": [{"holder": self.holder},
+                               {"expires": {"$lt": now}}]},
+                update={"$set": {"holder": self.holder,
+                                 "expires": now + self.ttl}},
+                upsert=True, new=True)
+        except DuplicateKeyError:
+            # The lease exists, is not expired and belongs to someone else.
+            return False
+        return record is not None and record["holder"] == self.holder
+
+    def release(self):
+        """
+            Gives the lease up, if held by this holder.
+        """
+        self.leases.remove({"_id": self.name, "holder": self.holder})
+
+
+class SequenceGaps(object):
+    """
+        The sequence numbers a reader found missing: taken by a writer but
+        not read written yet. Each is looked for again for wait seconds, as
+        its writer may still be writing it. A number may never show up,
+        when a later write replaced its record, or its writer failed.
+    """
+
+    def __init__(self, wait):
+        self.wait = wait
+        self._since = {}  # sequence number -> time first found missing
+
+    def __len__(self):
+        return len(self._since)
+
+    def missing(self):
+        """
+            Returns the sequence numbers still looked for.
+        """
+        return sorted(self._since)
+
+    def query(self, field, seen):
+        """
+            Returns the query of the records numbered after seen, or still
+            missing, by their sequence number field.
+        """
+        query = {field: {"$gt": seen}}
+        if not self._since:
+            return query
+        return {"$or": [query, {field: {"$in": self.missing()}}]}
+
+    def update(self, seen, read, now=None):
+        """
+            Takes the sequence numbers read by the query, and returns the
+            new seen number: the highest one read, or seen. The numbers up
+            to it not read are missing from now on.
+        """
+        now = time.time() if now is None else now
+        top = max([seen] + list(read))
+        for seq in xrange(seen + 1, top + 1):
+            if seq not in read:
+                self._since.setdefault(seq, now)
+        for seq in read:
+            self._since.pop(seq, None)
+        for seq, since in self._since.items():
+            if now - since > self.wait:
+                del self._since[seq]
+        return top
+
+
+class ChangeLog(object):
+    """
+        Records which entities were changed, under an increasing sequence
+        number, so that other processes can reload just those entities.
+    """
+
+    def __init__(self, db=None):
+        db = db if db is not None else DB
+        self.changes = db.entity_changes
+        self.counters = db.counters
+        self.seen = self.latest()
+        self.gaps = SequenceGaps(CHANGE_WAIT)
+        # sequence numbers recorded here, not read back yet
+        self._applied = set()
+
+    def latest(self):
+        """
+            Returns the sequence number of the latest change.
+        """
+        counter = self.counters.find_one({"_id": "entity_changes"})
+        return counter["seq"] if counter else 0
+
+    def record(self, key, deleted=False):
+        """
+            Records a change (or deletion) of the entity with the given key.
+        """
+        counter = self.counters.find_and_modify(
+            {"_id": "entity_changes"}, {"$inc": {"seq": 1}},
+            upsert=True, new=True)
+        seq = counter["seq"]
+        self.changes.update({"_id": key},
+                            {"_id": key, "seq": seq, "deleted": deleted},
+                            upsert=True)
+        # Own changes need no reloading.
+        self._applied.add(seq)
+        return seq
+
+    def record_many(self, keys):
+        """
+            Records changes of the entities with the given keys, taking their
+            sequence numbers at once and writing them in one bulk.
+        """
+        counter = self.counters.find_and_modify(
+            {"_id": "entity_changes"}, {"$inc": {"seq": len(keys)}},
+            upsert=True, new=True)
+        first = counter["seq"] - len(keys) + 1
+        bulk = self.changes.initialize_unordered_bulk_op()
+        for seq, key in enumerate(keys, first):
+            bulk.find({"_id": key}).upsert().replace_one(
+                {"_id": key, "seq": seq, "deleted": False})
+        bulk.execute()
+        self._applied.update(range(first, counter["seq"] + 1))
+        return counter["seq"]
+
+    def pending(self):
+        """
+            Returns the (key, deleted) pairs changed since the last call.
+            The sequence numbers missing after the last call, taken by a
+            writer but not read written yet, are looked for again for
+            CHANGE_WAIT seconds, so a change written after a later one is
+            not missed.
+        """
+        records = list(self.changes.find(self.gaps.query("seq", self.seen)))
+        changed = [(record["_id"], record["deleted"]) for record in records
+                   if record["seq"] not in self._applied]
+
+        self.seen = self.gaps.update(
+            self.seen, set(record["seq"] for record in records))
+        self._applied.difference_update(record["seq"] for record in records)
+        missing = set(self.gaps.missing())
+        self._applied = set(seq for seq in self._applied
+                            if seq > self.seen or seq in missing)
+        return changed
@@ -14,12 +14,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from pymongo import MongoClient
 import ConfigParser
-import json
+from context import LazyDatabase, LazyMetrics
 
-DB = MongoClient().sla
-METRICS = json.load(file("configs/metrics.json"))
+DB = LazyDatabase()
+METRICS = LazyMetrics()
 
 
 def load_monitoring_capabilities():
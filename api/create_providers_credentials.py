@@ -14,9 +14,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from pymongo import MongoClient
+from context import LazyDatabase
 
-DB = MongoClient().sla
+DB = LazyDatabase()
 
 
 def load_providers():
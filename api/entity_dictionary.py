@@ -20,11 +20,47 @@ store occi core model entities.
 """
 
 import copy
+import threading
 
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 from occi import core_model
+from agreement_graph import AgreementGraph
+from attributes import CODEC, CompactAttributes, intern_key
+from context import current
 import occi_sla
 
+# Number of locks the entity keys are spread over.
+LOCK_STRIPES = 64
+
+
+def update_links(entities, changes, attach=True):
+    """
+    Adds (or removes) link ids to (or from) the links of agreement records,
+    given as {agreement key: [link ids]}, with one bulk of atomic $addToSet
+    (or $pull) updates of the entities collection rather than rewriting the
+    agreements. Returns the number of agreements matched.
+    """
+    if not changes:
+        return 0
+    bulk = entities.initialize_unordered_bulk_op()
+    for key, link_ids in changes.iteritems():
+        link_ids = list(link_ids)
+        if attach:
+            update = {"$addToSet": {"links": {"$each": link_ids}}}
+        else:
+            update = {"$pull": {"links": {"$in": link_ids}}}
+        update["$inc"] = {"version": 1}
+        bulk.find({"_id": key,
+                   "kind": occi_sla.AGREEMENT.location}).update_one(update)
+    return bulk.execute()["nMatched"]
+
+
+class VersionConflict(AttributeError):
+    """
+        Raised when an entity was changed by someone else since it was read.
+    """
+
 
 class EntityDictionary(dict):
     """
@@ -39,34 +75,70 @@ class EntityDictionary(dict):
         occi core model entities.
     """
 
-    def __init__(self, registry, host=None, port=None):
+    def __init__(self, registry, host=None, port=None, changes=None):
         super(EntityDictionary, self).__init__()
 
-        # Get the Database collection
-        client = MongoClient(host, port)
-        sla_db = client.sla
-        self.entities = sla_db.entities
+        # Get the Database collection, through the client shared by the
+        # application unless another server is given. Term states are
+        # written with a write concern of their own.
+        if host is None and port is None:
+            self.entities = current().collection("entities",
+                                                 writes="agreement")
+            self.term_states = current().collection("entities",
+                                                    writes="term_state")
+        else:
+            self.entities = MongoClient(host, port).sla.entities
+            self.term_states = self.entities
 
         # Registry needed to determine mixin types
         self.registry = registry
 
+        # Secondary indexes (value -> set of keys) so that provider, customer
+        # and kind scoped lookups only touch the entities they are about.
+        self.provider_index = {}
+        self.customer_index = {}
+        self.kind_index = {}
+        # Guards the index sets, which keys_for reads while other threads
+        # store and remove entities.
+        self._index_lock = threading.RLock()
+        # Links between agreements, for the SLA federation.
+        self.graph = AgreementGraph()
+        # Agreement links stored before the agreement they target, by the
+        # key of the target.
+        self._pending_links = {}
+
+        # Optional ChangeLog shared with other processes using the same db.
+        self.changes = changes
+        self._sync_lock = threading.Lock()
+
+        # Writes to an entity are serialised by the lock of its stripe, and
+        # checked against the version of its db record (key -> version).
+        self._locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self._versions = {}
+        # Keys of the entities whose db record still has its attributes in
+        # the legacy '^' format, which set_attributes migrates.
+        self._legacy = set()
+
     def __setitem__(self, key, val):
         """
             Stores the entity as both an in-memory dictionary and db record.
         """
-        if isinstance(val, core_model.Resource):
-            self._persist_resource(key, val)
-        else:
-            self._persist_link(key, val)
-
-        super(EntityDictionary, self).__setitem__(key, val)
+        with self.lock(key):
+            version = self._persist(key, val)
+            self._store(key, val, version)
+        self._record_change(key)
 
     def __delitem__(self, key):
         """
             Removes the in-memory dictionary and the db record
         """
-        self.entities.remove(key)
-        super(EntityDictionary, self).__delitem__(key)
+        with self.lock(key):
+            self.entities.remove(key)
+            self._unindex(key)
+            self._versions.pop(key, None)
+            self._legacy.discard(key)
+            super(EntityDictionary, self).__delitem__(key)
+        self._record_change(key, deleted=True)
 
     def __del__(self):
         """
@@ -78,42 +150,443 @@ class EntityDictionary(dict):
         """
             Returns a list of mixin objects from a list of mixin locations.
         """
-        entity = copy.deepcopy(entity)
-        mixins = []
-        if entity.mixins is not None:
-            for mxn_loc in entity.mixins:
-                mxn = self.registry.get_category(mxn_loc, None)
-                mixins.append(mxn)
-
-        if not mixins == []:
-            entity.mixins = mixins
-
-        return entity.mixins
+        if not entity.mixins:
+            return entity.mixins
+        return [self.registry.get_category(mxn_loc, None)
+                for mxn_loc in entity.mixins]
 
     def clear(self):
         """
             Overide clear to delete all db records.
         """
         self.entities.remove({})
+        with self._index_lock:
+            self.provider_index.clear()
+            self.customer_index.clear()
+            self.kind_index.clear()
+            self.graph.clear()
+            self._pending_links.clear()
+        self._versions.clear()
+        self._legacy.clear()
         super(EntityDictionary, self).clear()
 
     def pop(self, key):
-        self.entities.remove(key)
-        super(EntityDictionary, self).pop(key)
+        with self.lock(key):
+            self.entities.remove(key)
+            self._unindex(key)
+            self._versions.pop(key, None)
+            self._legacy.discard(key)
+            value = super(EntityDictionary, self).pop(key)
+        self._record_change(key, deleted=True)
+        return value
+
+    def lock(self, key):
+        """
+            Returns the (re-entrant) lock guarding writes to an entity. Locks
+            are striped over the keys, so unrelated entities rarely contend.
+        """
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    def version(self, key):
+        """
+            Returns the version of the db record of an entity, which is
+            incremented on every save.
+        """
+        return self._versions.get(key, 0)
+
+    def compare_and_set(self, key, val, version):
+        """
+            Stores the entity only if its db record still has the given
+            version. Returns False, leaving it untouched, if it changed since.
+        """
+        with self.lock(key):
+            new_version = self._persist(key, val, version)
+            if new_version is None:
+                return False
+            self._store(key, val, new_version)
+        self._record_change(key)
+        return True
+
+    def modify(self, key, mutate, retries=5):
+        """
+            Applies mutate to a copy of an entity and saves it. If another
+            process saved the entity in the meantime, it is reloaded and
+            mutate applied again. The entity in memory only takes the
+            changes once they are saved. Returns the saved entity.
+        """
+        for _ in range(retries):
+            with self.lock(key):
+                changed = self.working_copy(key)
+                mutate(changed)
+                if self.commit(key, changed, self.version(key)):
+                    return self[key]
+            self.reload(key)
+        raise VersionConflict("{0} is being modified concurrently"
+                              .format(key))
+
+    def working_copy(self, key):
+        """
+            Returns a copy of an entity to be changed and then saved with
+            commit, so that readers never see unsaved changes.
+        """
+        return self._working_copy(self[key])
+
+    def commit(self, key, changed, version):
+        """
+            Saves the working copy of an entity only if its db record still
+            has the given version, and only then updates the entity in
+            memory with it. Returns False, leaving both untouched, if the
+            record changed since.
+        """
+        with self.lock(key):
+            new_version = self._persist(key, changed, version)
+            if new_version is None:
+                return False
+            entity = self.get(key)
+            if entity is None:
+                entity = changed
+            else:
+                self._unindex(key)
+                entity.__dict__.update(changed.__dict__)
+            self._store(key, entity, new_version)
+        self._record_change(key)
+        return True
+
+    @staticmethod
+    def _working_copy(entity):
+        """
+            Returns a copy of an entity whose attributes, links and mixins
+            can be changed without touching the entity.
+        """
+        changed = copy.copy(entity)
+        changed.attributes = copy.copy(entity.attributes)
+        for name in ("links", "mixins"):
+            if isinstance(getattr(entity, name, None), list):
+                setattr(changed, name, list(getattr(entity, name)))
+        return changed
+
+    def set_attribute(self, key, name, value):
+        """
+            Sets a single attribute of an entity, see set_attributes.
+        """
+        self.set_attributes([(key, name, value)])
+
+    def set_attributes(self, updates):
+        """
+            Sets attributes given as (key, name, value) triples. Only the
+            attributes are written to the db, as one bulk of $set (or $push
+            for new attributes) updates, instead of rewriting the entities.
+            An attribute given more than once takes its last value, as the
+            updates of the bulk are applied in no particular order. Records
+            still in the legacy format are migrated, rewriting all their
+            attributes if unchanged since read. The entities in memory take
+            the values once the db matched every update, otherwise they are
+            reloaded.
+        """
+        latest = {}
+        for key, name, value in updates:
+            latest.setdefault(key, {})[name] = value
+
+        bulk = None
+        writes = {}
+        for key, values in latest.iteritems():
+            with self.lock(key):
+                if key not in self:
+                    # deleted meanwhile
+                    continue
+                if bulk is None:
+                    bulk = self.term_states.initialize_unordered_bulk_op()
+                attributes = self[key].attributes
+                if key in self._legacy:
+                    migrated = dict(attributes.iteritems())
+                    migrated.update(values)
+                    bulk.find(self._version_query(key, self.version(key))) \
+                        .update_one({"$set": {"attributes":
+                                              CODEC.encode(migrated)},
+                                     "$inc": {"version": 1}})
+                    writes[key] = 1
+                    continue
+                for name, value in values.iteritems():
+                    pair = CODEC.encode_pair(intern_key(name), value)
+                    if name in attributes:
+                        bulk.find({"_id": key, "attributes.k": name}) \
+                            .update_one({"$set": {"attributes.$": pair},
+                                         "$inc": {"version": 1}})
+                    else:
+                        bulk.find({"_id": key}).update_one(
+                            {"$push": {"attributes": pair},
+                             "$inc": {"version": 1}})
+                writes[key] = len(values)
+
+        if bulk is None:
+            return
+        try:
+            matched = bulk.execute()["nMatched"]
+        except BulkWriteError as err:
+            matched = err.details.get("nMatched", 0)
+
+        complete = matched == sum(writes.itervalues())
+        for key in writes:
+            if not complete:
+                # some record was not as expected, take what the db has
+                self.reload(key)
+            else:
+                with self.lock(key):
+                    if key in self:
+                        self[key].attributes.update(latest[key])
+                        self._versions[key] = self.version(key) + writes[key]
+                        self._legacy.discard(key)
+            self._record_change(key)
+
+    def attach_links(self, attachments):
+        """
+            Adds link ids to the links of agreements, given as {agreement
+            key: [link ids]}, see update_links. The links of the agreements
+            in memory are left to the caller.
+        """
+        self._update_links(attachments, True)
+
+    def detach_links(self, detachments):
+        """
+            Removes link ids from the links of agreements, given as
+            {agreement key: [link ids]}, see update_links.
+        """
+        self._update_links(detachments, False)
+
+    def _update_links(self, changes, attach):
+        update_links(self.entities, changes, attach)
+        for key in changes:
+            with self.lock(key):
+                if key in self and self[key].kind == occi_sla.AGREEMENT:
+                    self._versions[key] = self.version(key) + 1
+            self._record_change(key)
+
+    def store_many(self, entities):
+        """
+            Stores new entities, given as a list of (key, entity) pairs, with
+            one bulk of inserts. Returns the errors of the entities that could
+            not be inserted, by key. The others are stored in memory too.
+        """
+        if not entities:
+            return {}
+        bulk = self.entities.initialize_unordered_bulk_op()
+        for key, entity in entities:
+            if isinstance(entity, core_model.Resource):
+                document = self._resource_document(key, entity)
+            else:
+                document = self._link_document(key, entity)
+            document["version"] = 1
+            bulk.insert(document)
+
+        failed = {}
+        try:
+            bulk.execute()
+        except BulkWriteError as err:
+            for error in err.details.get("writeErrors", []):
+                failed[entities[error["index"]][0]] = error.get("errmsg")
+
+        stored = []
+        for key, entity in entities:
+            if key not in failed:
+                self._store(key, entity, 1)
+                stored.append(key)
+        if self.changes is not None and stored:
+            self.changes.record_many(stored)
+        return failed
+
+    def sync(self):
+        """
+            Reloads the entities other processes changed in the database since
+            the last sync. Does nothing without a shared ChangeLog, or while
+            another thread is already syncing.
+        """
+        if self.changes is None or not self._sync_lock.acquire(False):
+            return
+        try:
+            for key, deleted in self.changes.pending():
+                if deleted:
+                    self._forget(key)
+                else:
+                    self.reload(key)
+        finally:
+            self._sync_lock.release()
+
+    def reload(self, key):
+        """
+            Replaces the in-memory entity with its current db record.
+        """
+        record = self.entities.find_one(key)
+        if record is None:
+            self._forget(key)
+            return
+
+        record = self._clean_record(record)
+        if self.is_link(record):
+            self._add_link(record)
+        else:
+            self._add_resource(record)
+
+    def _forget(self, key):
+        """
+            Removes an entity from memory only, as its record is already gone.
+        """
+        with self.lock(key):
+            if key in self:
+                self._unindex(key)
+                self._versions.pop(key, None)
+                self._legacy.discard(key)
+                super(EntityDictionary, self).__delitem__(key)
+
+    def _record_change(self, key, deleted=False):
+        """
+            Tells the other processes sharing the db about a change.
+        """
+        if self.changes is not None:
+            self.changes.record(key, deleted)
+
+    def keys_for(self, provider=None, customer=None, kind=None):
+        """
+            Returns the keys of the entities matching all the given criteria,
+            using the secondary indexes rather than scanning every entity.
+            kind can be either a Kind or its location.
+        """
+        if isinstance(kind, core_model.Category):
+            kind = kind.location
+
+        selected = None
+        with self._index_lock:
+            for index, value in ((self.provider_index, provider),
+                                 (self.customer_index, customer),
+                                 (self.kind_index, kind)):
+                if value is None:
+                    continue
+                keys = index.get(value, set())
+                selected = set(keys) if selected is None else selected & keys
+
+        if selected is None:
+            return self.keys()
+        return list(selected)
+
+    def provided_by(self, key, provider):
+        """
+            Returns True if the entity of the key belongs to the provider.
+        """
+        with self._index_lock:
+            return key in self.provider_index.get(provider, ())
+
+    def _store(self, key, entity, version=None):
+        """
+            Adds the entity to the in-memory dictionary and its indexes. The
+            attributes are kept in their compact, layout-sharing form.
+        """
+        if not isinstance(entity.attributes, CompactAttributes):
+            entity.attributes = CompactAttributes(entity.attributes)
+        with self.lock(key):
+            if key in self:
+                self._unindex(key)
+            super(EntityDictionary, self).__setitem__(key, entity)
+            self._index(key, entity)
+            if version is not None:
+                self._versions[key] = version
+
+    def _index(self, key, entity):
+        """
+            Registers the key of the entity in the secondary indexes.
+        """
+        with self._index_lock:
+            for index, value in self._index_values(entity):
+                if value is not None:
+                    index.setdefault(value, set()).add(key)
+            federated = self._federated(entity)
+            if federated is not None:
+                self.graph.add_link(key, *federated)
+            elif self._targets_key(entity):
+                self._pending_links.setdefault(entity.target, set()).add(key)
+                if entity.target in self:
+                    self._link_pending(entity.target)
+            if entity.kind == occi_sla.AGREEMENT:
+                self._link_pending(key)
+
+    def _link_pending(self, agreement):
+        """
+            Registers the agreement links stored before the agreement they
+            target, now that it is stored.
+        """
+        for key in self._pending_links.pop(agreement, ()):
+            link = self.get(key)
+            federated = self._federated(link) if link is not None else None
+            if federated is not None:
+                self.graph.add_link(key, *federated)
+
+    def _unindex(self, key):
+        """
+            Removes the key of an in-memory entity from the secondary indexes.
+        """
+        with self._index_lock:
+            entity = self.get(key)
+            if entity is None:
+                return
+            self.graph.remove_link(key)
+            pending = self._pending_links.get(entity.target) \
+                if self._targets_key(entity) else None
+            if pending is not None:
+                pending.discard(key)
+                if not pending:
+                    del self._pending_links[entity.target]
+            for index, value in self._index_values(entity):
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+
+    def _index_values(self, entity):
+        """
+            Returns the (index, value) pairs an entity is indexed under.
+        """
+        kind = entity.kind
+        if isinstance(kind, core_model.Category):
+            kind = kind.location
+        return ((self.provider_index, getattr(entity, "provider", None)),
+                (self.customer_index, getattr(entity, "customer", None)),
+                (self.kind_index, kind))
+
+    @staticmethod
+    def _targets_key(entity):
+        """
+            Returns True if the entity is an agreement link whose target is
+            still a key.
+        """
+        return isinstance(entity, core_model.Link) and \
+            entity.kind == occi_sla.AGREEMENT_LINK and \
+            isinstance(entity.target, basestring)
+
+    def _federated(self, entity):
+        """
+            Returns the (agreement, linked agreement) keys an agreement link
+            joins, None if the entity is not a link between agreements. The
+            target may still be the key of the agreement.
+        """
+        if not isinstance(entity, core_model.Link) or \
+                entity.kind != occi_sla.AGREEMENT_LINK:
+            return None
+        source, target = entity.source, entity.target
+        if not isinstance(target, core_model.Resource):
+            target = self.get(target)
+        if not isinstance(source, core_model.Resource) or \
+                not isinstance(target, core_model.Resource) or \
+                target.kind != occi_sla.AGREEMENT:
+            return None
+        return source.identifier, target.identifier
 
     @staticmethod
     def _encode_attributes(attributes):
         """
             Modifys the attributes from an entity so that they can be stored in
-            a database.  (This was neccasary as mongodb was disallowing key
-            names that used a '.')
+            a database, as an array of key/value pairs.  (This is neccasary as
+            mongodb disallows key names that use a '.')
         """
-        attrs_d = {}
-        for a_key, a_val in attributes.iteritems():
-            a_key = a_key.replace(".", "^")
-            attrs_d[a_key] = str(a_val)
-        attributes = attrs_d
-        return attributes
+        return CODEC.encode(attributes)
 
     @staticmethod
     def _decode_attributes(attributes):
@@ -121,12 +594,7 @@ class EntityDictionary(dict):
             Translate the attributes from DB representation to a representation
             that can be used with the OCCI PYSSF package.
         """
-        attrs_d = {}
-        for a_key, a_val in attributes.iteritems():
-            a_key = a_key.replace("^", ".")
-            attrs_d[a_key] = a_val
-        attributes = attrs_d
-        return attributes
+        return CODEC.decode(attributes)
 
     def _add_resource(self, entity_record, add_link=True):
         """
@@ -136,6 +604,7 @@ class EntityDictionary(dict):
         key = entity_record["_id"]
 
         del entity_record["_id"]
+        version = entity_record.pop("version", 0)
         entity = core_model.Resource("", None, None)
         entity.__dict__ = entity_record
 
@@ -155,8 +624,13 @@ class EntityDictionary(dict):
         if len(links) > 0:
             entity.links = links
 
+        legacy = CODEC.is_legacy(entity.attributes)
         entity.attributes = self._decode_attributes(entity.attributes)
-        super(EntityDictionary, self).__setitem__(key, entity)
+        self._store(key, entity, version)
+        if legacy:
+            self._legacy.add(key)
+        else:
+            self._legacy.discard(key)
 
     def _add_link(self, entity_record):
         """
@@ -167,6 +641,7 @@ class EntityDictionary(dict):
         """
         key = entity_record["_id"]
         del entity_record["_id"]
+        version = entity_record.pop("version", 0)
 
         entity = core_model.Link(None, None, None, None, None)
         entity.__dict__ = entity_record
@@ -189,8 +664,13 @@ class EntityDictionary(dict):
         else:
             entity.target = self.__getitem__(entity.target)
 
+        legacy = CODEC.is_legacy(entity.attributes)
         entity.attributes = self._decode_attributes(entity.attributes)
-        super(EntityDictionary, self).__setitem__(key, entity)
+        self._store(key, entity, version)
+        if legacy:
+            self._legacy.add(key)
+        else:
+            self._legacy.discard(key)
 
     @staticmethod
     def is_link(entity_record):
@@ -210,7 +690,7 @@ class EntityDictionary(dict):
         entity_records = self.sort_records(entity_records)
 
         for entity_record in entity_records:
-            entity_record = self._clean_dictionary(entity_record)
+            entity_record = self._clean_record(entity_record)
 
             if entity_record["_id"] not in self:
 
@@ -227,7 +707,7 @@ class EntityDictionary(dict):
         entity_records = self.entities.find({})
 
         for entity_record in entity_records:
-            entity_record = self._clean_dictionary(entity_record)
+            entity_record = self._clean_record(entity_record)
 
             if self.is_link(entity_record):
                 self._add_link(entity_record)
@@ -248,34 +728,62 @@ class EntityDictionary(dict):
                 sorted_list.insert(0, record)
         return sorted_list
 
-    def _persist_link(self, key, link):
+    def _persist(self, key, entity, version=None):
+        """
+            Saves a resource or link, see _persist_entity.
+        """
+        if isinstance(entity, core_model.Resource):
+            return self._persist_resource(key, entity, version)
+        return self._persist_link(key, entity, version)
+
+    def _persist_link(self, key, link, version=None):
         """
             Prepare a link entity and save to the database.
         """
-        entity = copy.deepcopy(link.__dict__)  # to localise dict manipulation
+        return self._persist_entity(self._link_document(key, link), key,
+                                    version)
+
+    def _persist_resource(self, key, resource, version=None):
+        """
+            Prepare a resource entity and save to the database.
+        """
+        return self._persist_entity(self._resource_document(key, resource),
+                                    key, version)
+
+    @classmethod
+    def _link_document(cls, key, link):
+        """
+            Builds the database document of a link. Only the top level of the
+            entity is copied, the objects it refers to are replaced by their
+            identifiers.
+        """
+        entity = dict(link.__dict__)
         entity["_id"] = key
 
-        self._flatten_kind(entity)
-        self._flatten_mixin(entity)
+        cls._flatten_kind(entity)
+        cls._flatten_mixin(entity)
         entity["source"] = link.source.identifier
         if isinstance(link.target, core_model.Resource):
             entity["target"] = link.target.identifier
         else:
             entity["target"] = link.target
 
-        entity["attributes"] = self._encode_attributes(entity["attributes"])
-        self._persist_entity(entity, key)
+        entity["attributes"] = cls._encode_attributes(entity["attributes"])
+        return entity
 
-    def _persist_resource(self, key, resource):
+    @classmethod
+    def _resource_document(cls, key, resource):
         """
-            Prepare a resource entity and save to the database.
+            Builds the database document of a resource. Kind, mixins and links
+            are flattened to their locations and identifiers rather than
+            copying the linked object graph.
         """
-        entity = copy.deepcopy(resource.__dict__)  # to localise dict
+        entity = dict(resource.__dict__)
         entity["_id"] = key
-        
+
         # templates entry in resource prep
         templates = []
- 
+
         if resource.mixins:
             for mixin in resource.mixins:
                 if occi_sla.AGREEMENT_TEMPLATE in mixin.related:
@@ -283,20 +791,42 @@ class EntityDictionary(dict):
         
         entity["templates"] = templates
 
-        self._flatten_kind(entity)
-        self._flatten_mixin(entity)  # by ref
-        self._flatten_links(entity)
-        entity["attributes"] = self._encode_attributes(entity["attributes"])
-        self._persist_entity(entity, key)
+        cls._flatten_kind(entity)
+        cls._flatten_mixin(entity)
+        cls._flatten_links(entity)
+        entity["attributes"] = cls._encode_attributes(entity["attributes"])
+        return entity
+
+    def _persist_entity(self, entity, key, version=None):
+        """
+            Saves an occi core model entity (Resource, Link) to the database,
+            incrementing the version of its record, and returns the new
+            version. If a version is given the record is only saved if it
+            still has that version, otherwise None is returned.
+        """
+        del entity["_id"]
+        record = self.entities.find_and_modify(
+            self._version_query(key, version),
+            {"$set": entity, "$inc": {"version": 1}},
+            upsert=version is None, new=True, fields={"version": 1})
+        if record is None:
+            return None
+        self._legacy.discard(key)
+        return record["version"]
 
-    def _persist_entity(self, entity, key):
+    @staticmethod
+    def _version_query(key, version=None):
         """
-            Saves an occi core model entity (Resource, Link) to the database.
+            Returns the query of the record of an entity, if it still has the
+            given version when one is given.
         """
-        if self.entities.find({"_id": key}).count() == 0:
-            self.entities.insert(entity)
-        else:
-            self.entities.update({"_id": key}, entity)
+        query = {"_id": key}
+        if version == 0:
+            # records saved before versioning have no version field
+            query["$or"] = [{"version": 0}, {"version": {"$exists": False}}]
+        elif version is not None:
+            query["version"] = version
+        return query
 
     @staticmethod
     def _flatten_kind(entity):
@@ -336,17 +866,19 @@ class EntityDictionary(dict):
         if not linked_resources == []:
             entity["links"] = linked_resources
 
-    @classmethod
-    def _clean_dictionary(cls, entity_dict):
-        """
-            Removes unicode strings from the dictionary.
-        """
-        if isinstance(entity_dict, dict):
-            return {cls._clean_dictionary(key): cls._clean_dictionary(value)
-                    for key, value in entity_dict.iteritems()}
-        elif isinstance(entity_dict, list):
-            return [cls._clean_dictionary(element) for element in entity_dict]
-        elif isinstance(entity_dict, unicode):
-            return str(entity_dict)
-        else:
-            return entity_dict
+    @staticmethod
+    def _clean_record(entity_record):
+        """
+            Removes unicode strings from the top level of a record and its
+            lists of identifiers. The attributes are left to the codec.
+        """
+        record = {}
+        for key, value in entity_record.iteritems():
+            key = intern_key(key)
+            if isinstance(value, unicode):
+                value = str(value)
+            elif isinstance(value, list) and key != "attributes":
+                value = [str(elem) if isinstance(elem, unicode) else elem
+                         for elem in value]
+            record[key] = value
+        return record
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Indexes of the queries made on every request or notification. They are
+created at startup, or with
+
+    $ python api/indexes.py
+
+which is idempotent, and the hot queries are explained to flag any that
+still scans its whole collection.
+"""
+
+import logging
+
+from pymongo.errors import OperationFailure
+
+from context import LazyDatabase
+from term_events import TermEventLog
+
+LOG = logging.getLogger(__name__)
+# create console handler with a higher log level
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+# create formatter and add it to the handlers
+formatter = logging.Formatter('%(asctime)s - %(name)s - ' +
+                              '%(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+# add the handlers to the logger
+LOG.addHandler(ch)
+
+DB = LazyDatabase()
+
+# Index keys by collection.
+INDEXES = {
+    "providers": [[("username", 1), ("password", 1)]],
+    "policies": [[("agreement_id", 1)], [("devices", 1)]],
+    "monitoring": [[("name", 1)]],
+    "entities": [[("kind", 1)]],
+    "entity_changes": [[("seq", 1)]],
+    "term_events": [[("provider", 1), ("_id", 1)],
+                    [("agreement", 1), ("_id", 1)]],
+}
+
+# A query of each hot path: (collection, filter).
+HOT_QUERIES = [
+    ("providers", {"username": "", "password": ""}),
+    ("policies", {"agreement_id": ""}),
+    ("policies", {"devices": ""}),
+    ("devices", {"_id": ""}),
+    ("monitoring", {"name": ""}),
+    ("entities", {"kind": ""}),
+    ("entity_changes", {"seq": {"$gt": 0}}),
+    ("term_events", {"provider": "", "_id": {"$gt": 0}}),
+]
+
+
+def index_name(keys):
+    """
+    Returns the name MongoDB gives an index of the given keys.
+    """
+    return "_".join("{0}_{1}".format(field, order) for field, order in keys)
+
+
+def ensure_indexes(db=None):
+    """
+    Creates the missing indexes and verifies they all exist. Returns the
+    (collection, index) names.
+    """
+    db = db if db is not None else DB
+    # Indexing term_events would create it as a plain collection, so the
+    # capped one is created first.
+    TermEventLog(db).events
+    ensured = []
+    for name, indexes in sorted(INDEXES.iteritems()):
+        collection = db[name]
+        for keys in indexes:
+            collection.create_index(keys)
+        existing = collection.index_information()
+        for keys in indexes:
+            if index_name(keys) not in existing:
+                raise AttributeError("Index {0} of {1} is missing"
+                                     .format(index_name(keys), name))
+            ensured.append((name, index_name(keys)))
+    return ensured
+
+
+def index_sizes(db=None):
+    """
+    Returns the size in bytes of the indexes, by collection and index name.
+    """
+    db = db if db is not None else DB
+    sizes = {}
+    for name in sorted(INDEXES):
+        try:
+            sizes[name] = db.command("collstats", name).get("indexSizes", {})
+        except OperationFailure as err:
+            LOG.warn("No index sizes of {0}: {1}".format(name, err))
+    return sizes
+
+
+def scans(plan):
+    """
+    Returns True if a query plan, as given by explain(), scans a whole
+    collection.
+    """
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(scans(value) for value in plan.itervalues())
+    if isinstance(plan, list):
+        return any(scans(value) for value in plan)
+    return False
+
+
+def audit_queries(db=None):
+    """
+    Explains the hot queries and logs those scanning their collection.
+    Returns the (collection, filter) of the scanning queries.
+    """
+    db = db if db is not None else DB
+    scanning = []
+    for name, query in HOT_QUERIES:
+        plan = db[name].find(query).explain()
+        if scans(plan.get("queryPlanner", {}).get("winningPlan", plan)):
+            LOG.warn("Query {0} on {1} scans the collection"
+                     .format(query, name))
+            scanning.append((name, query))
+    return scanning
+
+
+def init_indexes(db=None):
+    """
+    Ensures the indexes, and logs their sizes and any hot query that does
+    not use them.
+    """
+    ensured = ensure_indexes(db)
+    LOG.info("{0} indexes in place".format(len(ensured)))
+    for name, sizes in sorted(index_sizes(db).iteritems()):
+        for index, size in sorted(sizes.iteritems()):
+            LOG.info("Index {0} of {1}: {2} bytes".format(index, name, size))
+    return audit_queries(db)
+
+
+if __name__ == '__main__':
+    init_indexes()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Push-based metric ingestion. Monitoring systems POST batches of samples as
+newline-delimited JSON to /metrics, or publish them to the metrics queue of
+RabbitMQ, one sample per line:
+
+    {"device": "/compute/vm1", "metric": "System uptime", "value": 99.9}
+
+A provider can only POST samples of the devices its agreements cover. The
+samples are queued and handed to the notification batcher of the
+Aggregator by a worker thread. A batch that does not fit in the queue is
+refused (503 with Retry-After over HTTP, requeued over AMQP) so that the
+senders slow down.
+
+Pre-forked workers (see serving) do not run the Rules Engine. They queue
+the samples they accept in the metric_samples collection instead, which the
+process holding the Rules Engine lease drains into its own MetricIngestor.
+"""
+
+import json
+import logging
+import Queue
+import threading
+import time
+
+
+from attributes import CODEC
+from context import LazyDatabase, current
+from utils import authorised_provider, wsgi_reply
+
+LOG = logging.getLogger(__name__)
+# create console handler with a higher log level
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+# create formatter and add it to the handlers
+formatter = logging.Formatter('%(asctime)s - %(name)s - ' +
+                              '%(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+# add the handlers to the logger
+LOG.addHandler(ch)
+
+DB = LazyDatabase()
+
+PATH = "/metrics"
+
+# Most samples waiting to be evaluated.
+CAPACITY = 10000
+# Seconds a refused sender is asked to wait before retrying.
+RETRY_AFTER = 5
+# Most samples moved from the shared queue at once, and seconds between
+# looking for more.
+DRAIN_BATCH = 500
+DRAIN_INTERVAL = 0.5
+
+
+class MetricIngestor(object):
+    """
+        Bounded queue of (device_id, metric, value) samples, drained by a
+        worker thread into the notification path of the Aggregator.
+    """
+
+    def __init__(self, notify=None, capacity=CAPACITY):
+        self.notify = notify or _notification_event
+        self.capacity = capacity
+        self.samples = Queue.Queue(capacity)
+        self._admit = threading.Lock()
+        self._worker = None
+
+    def submit(self, samples):
+        """
+            Queues all the samples, or none of them if they don't fit.
+            Returns True if they were queued.
+        """
+        with self._admit:
+            # the samples being evaluated still take room
+            if self.samples.unfinished_tasks + len(samples) > self.capacity:
+                return False
+            # only this method adds samples, so they all fit
+            for sample in samples:
+                self.samples.put_nowait(sample)
+            if self._worker is None or not self._worker.is_alive():
+                # started on first use, i.e. in the process serving requests
+                self._worker = threading.Thread(target=self.run)
+                self._worker.daemon = True
+                self._worker.start()
+        return True
+
+    def run(self):
+        """
+            Evaluates the queued samples, one at a time.
+        """
+        while True:
+            device_id, metric, value = self.samples.get()
+            try:
+                self.notify(device_id, metric, value)
+            except Exception as err:
+                LOG.error("Sample of {0} on {1} dropped: {2}"
+                          .format(metric, device_id, err))
+            finally:
+                self.samples.task_done()
+
+
+def _notification_event(device_id, metric, value):
+    """
+    Passes a sample to the batcher of the Aggregator. Imported here, as the
+    Aggregator pulls in the Rules Engine, which needs the API built first.
+    """
+    import aggregator
+    aggregator.BATCHER.add(device_id, metric, value)
+
+
+class SampleQueue(object):
+    """
+        Queue of samples in the metric_samples collection, shared by the
+        processes using the same database. Workers submit to it, the process
+        running the Rules Engine drains it.
+    """
+
+    def __init__(self, samples=None, capacity=CAPACITY):
+        self.samples = samples if samples is not None else DB.metric_samples
+        self.capacity = capacity
+
+    def submit(self, samples):
+        """
+            Queues all the samples, or none of them if the queue is full.
+            Returns True if they were queued.
+        """
+        if self.samples.count() + len(samples) > self.capacity:
+            return False
+        if samples:
+            self.samples.insert([{"device": device_id, "metric": metric,
+                                  "value": value}
+                                 for device_id, metric, value in samples])
+        return True
+
+    def drain(self, ingestor, limit=DRAIN_BATCH):
+        """
+            Moves the oldest queued samples to ingestor, leaving them queued
+            if it has no room for them. Returns the number moved.
+        """
+        records = list(self.samples.find().sort("_id", 1).limit(limit))
+        if not records or not ingestor.submit(
+                [(record["device"], record["metric"], record["value"])
+                 for record in records]):
+            return 0
+        self.samples.remove({"_id": {"$in": [record["_id"]
+                                             for record in records]}})
+        return len(records)
+
+    def run(self, ingestor):
+        """
+            Drains the queue into ingestor, forever.
+        """
+        while True:
+            try:
+                moved = self.drain(ingestor)
+            except Exception as err:
+                LOG.error("Draining metric samples failed: {0}".format(err))
+                moved = 0
+            if not moved:
+                time.sleep(DRAIN_INTERVAL)
+
+
+INGESTOR = MetricIngestor()
+
+
+def forward_samples(queue=None):
+    """
+    Makes this process queue the samples it accepts in the shared queue,
+    for the process running the Rules Engine, instead of evaluating them.
+    """
+    global INGESTOR
+    INGESTOR = queue if queue is not None else SampleQueue()
+    return INGESTOR
+
+
+def parse_samples(body):
+    """
+    Parses newline-delimited JSON samples.
+    :param body: Request or message body
+    :return: List of (device_id, metric, value)
+    """
+    samples = []
+    for number, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            sample = json.loads(line)
+            device_id = sample["device"]
+            metric = sample["metric"]
+            value = sample["value"]
+        except (ValueError, KeyError, TypeError):
+            raise ValueError("Line {0}: expected an object with device, "
+                             "metric and value".format(number))
+        if metric not in CODEC.metrics:
+            raise ValueError("Line {0}: unknown metric {1}"
+                             .format(number, metric))
+        samples.append((device_id, metric, value))
+    return samples
+
+
+def uncovered_devices(samples, provider):
+    """
+    Returns the devices of the samples that no policy of an agreement of
+    the provider covers.
+    """
+    devices = set(device_id for device_id, _, _ in samples)
+    for policy in DB.policies.find({"devices": {"$in": list(devices)},
+                                    "provider": provider}, {"devices": 1}):
+        devices.difference_update(policy["devices"])
+    return devices
+
+
+def serve(environ, response, ingestor=None):
+    """
+    Accepts a batch of samples POSTed by a provider.
+    :param environ: Environment Dictionary of the request
+    :param response: WSGI start_response
+    :param ingestor: MetricIngestor to queue the samples on
+    :return: Body
+    """
+    ingestor = ingestor or INGESTOR
+    if environ.get("REQUEST_METHOD") != "POST":
+        return wsgi_reply(response, "405 Method Not Allowed", "text/plain",
+                          "Samples are POSTed", [("Allow", "POST")])
+    provider = authorised_provider(environ, DB.providers)
+    if provider is None:
+        return wsgi_reply(response, "403 Forbidden", "text/plain",
+                          "Incorrect Provider Credentials")
+
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        samples = parse_samples(environ["wsgi.input"].read(length))
+    except ValueError as err:
+        return wsgi_reply(response, "400 Bad Request", "text/plain", str(err))
+
+    uncovered = uncovered_devices(samples, provider)
+    if uncovered:
+        return wsgi_reply(response, "403 Forbidden", "text/plain",
+                          "No agreement of the provider covers {0}"
+                          .format(", ".join(sorted(uncovered))))
+
+    if not ingestor.submit(samples):
+        return wsgi_reply(response, "503 Service Unavailable", "text/plain",
+                          "Too many samples queued, retry later",
+                          [("Retry-After", str(RETRY_AFTER))])
+    return wsgi_reply(response, "202 Accepted", "application/json",
+                      json.dumps({"accepted": len(samples)}))
+
+
+def consume(ingestor=None):
+    """
+    Consumes samples published to the metrics queue of RabbitMQ (option
+    metrics_queue of the rabbit section, "metrics" by default). Blocks.
+    """
+    import pika
+
+    ingestor = ingestor or INGESTOR
+    rabbit = current().rabbit
+    queue = rabbit.get("metrics_queue", "metrics")
+
+    credentials = pika.PlainCredentials(rabbit["username"],
+                                        rabbit["password"])
+    parameters = pika.ConnectionParameters(
+        host=rabbit["host"], port=5672,
+        virtual_host=rabbit["virtual_host"], credentials=credentials)
+
+    def on_message(channel, method, properties, body):
+        try:
+            samples = parse_samples(body)
+        except ValueError as err:
+            LOG.error("Message dropped: {0}".format(err))
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        if ingestor.submit(samples):
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+        else:
+            # stop taking messages until the queue drained a bit
+            time.sleep(RETRY_AFTER)
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+
+    connection = pika.BlockingConnection(parameters)
+    channel = connection.channel()
+    channel.queue_declare(queue=queue, durable=True)
+    channel.basic_qos(prefetch_count=1)
+    channel.basic_consume(queue=queue, on_message_callback=on_message)
+    LOG.info("Consuming metric samples from queue {0}".format(queue))
+    channel.start_consuming()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Cache of the latest samples of the metrics of the devices, so that the
+Aggregator can take the values of sibling metrics it was recently notified
+of, or pulled, instead of pulling them from the collectors again. Numeric
+samples keep a short history in fixed size arrays of their own type, other
+values only the latest one. stats() reports the footprint of the cache
+and the hit rate of its lookups, which every server process logs.
+"""
+
+import array
+import threading
+import time
+
+# Samples kept per device and metric.
+HISTORY = 32
+# Seconds a sample is served from the cache.
+MAX_AGE = 30
+# Array typecodes of the numeric sample types.
+TYPECODES = {int: 'l', float: 'd'}
+
+
+class SampleRing(object):
+    """
+        Ring buffer of the last (time, value) samples of a numeric metric,
+        in an array of times and an array of values of the typecode.
+    """
+
+    def __init__(self, size=HISTORY, typecode='d'):
+        self.size = size
+        self.typecode = typecode
+        self._times = array.array('d', [0.0] * size)
+        self._values = array.array(typecode, [0] * size)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, when, value):
+        """
+            Adds a sample, overwriting the oldest one if the ring is full.
+        """
+        self._times[self._next] = when
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def latest(self):
+        """
+            Returns the latest (time, value) sample, None if there is none.
+        """
+        if not self._count:
+            return None
+        last = (self._next - 1) % self.size
+        return self._times[last], self._values[last]
+
+    def samples(self):
+        """
+            Returns the samples, oldest first.
+        """
+        first = (self._next - self._count) % self.size
+        return [(self._times[(first + i) % self.size],
+                 self._values[(first + i) % self.size])
+                for i in range(self._count)]
+
+    def footprint(self):
+        """
+            Returns the bytes taken by the samples.
+        """
+        return self.size * (self._times.itemsize + self._values.itemsize)
+
+
+class MetricCache(object):
+    """
+        The latest samples of the metrics, by (device_id, metric).
+    """
+
+    def __init__(self, history=HISTORY, max_age=MAX_AGE):
+        self.ring_size = history
+        self.max_age = max_age
+        self._rings = {}
+        self._latest = {}  # non-numeric values, (time, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, device_id, metric, value, now=None):
+        """
+            Records a sample of the metric of a device.
+        """
+        now = time.time() if now is None else now
+        key = (device_id, metric)
+        with self._lock:
+            typecode = TYPECODES.get(type(value))
+            if typecode is None:
+                self._rings.pop(key, None)
+                self._latest[key] = (now, value)
+                return
+            self._latest.pop(key, None)
+            ring = self._rings.get(key)
+            if ring is None or ring.typecode != typecode:
+                ring = self._rings[key] = SampleRing(self.ring_size, typecode)
+            ring.add(now, value)
+
+    def latest(self, device_id, metric, max_age=None, now=None):
+        """
+            Returns the latest value of the metric of a device, None if
+            there is none younger than max_age seconds.
+        """
+        max_age = self.max_age if max_age is None else max_age
+        now = time.time() if now is None else now
+        key = (device_id, metric)
+        with self._lock:
+            ring = self._rings.get(key)
+            sample = ring.latest() if ring is not None \
+                else self._latest.get(key)
+            if sample is None or now - sample[0] > max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return sample[1]
+
+    def history(self, device_id, metric):
+        """
+            Returns the (time, value) samples of a numeric metric of a
+            device, oldest first.
+        """
+        with self._lock:
+            ring = self._rings.get((device_id, metric))
+            return ring.samples() if ring is not None else []
+
+    def footprint(self):
+        """
+            Returns the bytes taken by the numeric samples.
+        """
+        with self._lock:
+            return sum(ring.footprint() for ring in self._rings.itervalues())
+
+    def stats(self):
+        """
+            Returns the number of cached metrics, their footprint in bytes
+            and the hit rate of lookups.
+        """
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            metrics = len(self._rings) + len(self._latest)
+        lookups = hits + misses
+        return {"metrics": metrics,
+                "bytes": self.footprint(),
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": float(hits) / lookups if lookups else 0.0}
+
+
+CACHE = MetricCache()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Rewrites the attributes of stored entities from the legacy '^' keyed
+subdocument to the array of {"k": key, "v": value} pairs.
+"""
+
+from attributes import CODEC
+from context import LazyDatabase
+
+DB = LazyDatabase()
+
+
+def migrate_attributes(entities=None):
+    """
+        Migrates every entity still in the legacy attribute format and
+        returns the number of migrated entities. Running it again is a no-op.
+    """
+    if entities is None:
+        entities = DB.entities
+
+    migrated = 0
+    for record in entities.find({"attributes": {"$type": "object"}},
+                                {"attributes": 1}):
+        if not CODEC.is_legacy(record["attributes"]):
+            continue
+        attributes = CODEC.decode(record["attributes"])
+        entities.update({"_id": record["_id"]},
+                        {"$set": {"attributes": CODEC.encode(attributes)}})
+        migrated += 1
+    return migrated
+
+
+if __name__ == '__main__':
+    print "Migrated {0} entities".format(migrate_attributes())
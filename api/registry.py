@@ -31,9 +31,9 @@ class PersistentReg(NonePersistentRegistry):
         Overriding OCCI 'NonePersistentRegistry' so that agreements are saved
         to a database which is defined in EntityDictionary.
     """
-    def __init__(self):
+    def __init__(self, changes=None):
         super(PersistentReg, self).__init__()
-        self.resources = EntityDictionary(self)
+        self.resources = EntityDictionary(self, changes=changes)
 
     def add_resource(self, key, resource, extras):
         """
@@ -41,6 +41,63 @@ class PersistentReg(NonePersistentRegistry):
         """
         super(PersistentReg, self).add_resource(key, resource, extras)
 
+    def get_resource(self, key, extras):
+        """
+            Returns a resource, scoped to the provider of the request so that
+            other providers' entities, and those of no provider, are never
+            handed to the backends. They are denied as the backends would
+            deny them. The working copy of the entity in extras, if any, is
+            returned in place of the entity.
+        """
+        provider = self._get_provider(extras)
+        if provider is not None and key in self.resources and \
+                not self.resources.provided_by(key, provider):
+            raise AttributeError("Provider Denied")
+        working = extras.get("working_copy") if extras else None
+        if working is not None and working.identifier == key:
+            return working
+        return super(PersistentReg, self).get_resource(key, extras)
+
+    def get_resource_keys(self, extras):
+        """
+            Returns the keys of the resources of the provider of the request,
+            looked up through the provider index. Unscoped when no provider
+            is given.
+        """
+        provider = self._get_provider(extras)
+        if provider is None:
+            return super(PersistentReg, self).get_resource_keys(extras)
+        return self.resources.keys_for(provider=provider)
+
+    def get_resources(self, extras):
+        """
+            Returns the resources of the provider of the request, looked up
+            through the provider index. Unscoped when no provider is given.
+        """
+        provider = self._get_provider(extras)
+        if provider is None:
+            return super(PersistentReg, self).get_resources(extras)
+
+        resources = (self.resources.get(key)
+                     for key in self.resources.keys_for(provider=provider))
+        return [resource for resource in resources if resource is not None]
+
+    @staticmethod
+    def _get_provider(extras):
+        """
+            Returns the provider id from the extras, None if not given.
+        """
+        if not extras or not isinstance(extras.get("security"), dict) or \
+                len(extras["security"]) == 0:
+            return None
+        return extras["security"].keys()[0]
+
+    def sync(self):
+        """
+            Picks up the changes other processes made to the resources.
+        """
+        self.resources.sync()
+
     def populate_resources(self):
         """
             Loads agreements from the database on instantiation
@@ -50,16 +107,19 @@ class PersistentReg(NonePersistentRegistry):
 
         return self
 
-    def get_active_agreement_resources(self):
+    def get_active_agreement_resources(self, provider=None):
         """
-            Loads active agreements from the database on instantiation
+            Loads active agreements from the database on instantiation.
+            Only agreement entities (of the provider, if given) are visited.
         """
         valid_resources = []
-        db_resources = self.resources.items()
+        keys = self.resources.keys_for(provider=provider,
+                                       kind=occi_sla.AGREEMENT)
 
-        for resource_key, resource in db_resources:
+        for resource_key in keys:
+            resource = self.resources.get(resource_key)
 
-            if resource.kind == occi_sla.AGREEMENT:
+            if resource is not None and resource.kind == occi_sla.AGREEMENT:
 
                 if resource.attributes["occi.agreement.state"] == 'accepted':
 
@@ -18,7 +18,6 @@
     Rules Engine class for the SLAaaS framework
 """
 import logging
-from pymongo import MongoClient
 import time
 from intellect.Intellect import Intellect
 from rulesenginehelper import RulesEngineHelper
@@ -26,6 +25,10 @@ import aggregator
 import occi_sla
 from occi import core_model
 from utils import build_attr
+from attributes import CODEC
+from term_events import TERM_EVENTS
+from windows import WINDOWS
+from context import LazyDatabase
 
 LOG = logging.getLogger(__name__)
 # create console handler with a higher log level
@@ -38,7 +41,7 @@ ch.setFormatter(formatter)
 # add the handlers to the logger
 LOG.addHandler(ch)
 
-DB = MongoClient().sla.policies
+DB = LazyDatabase("policies")
 
 
 class RulesEngine(Intellect):
@@ -54,6 +57,7 @@ class RulesEngine(Intellect):
         self.active_agreements = {}
         self.active_policies = {}
         self.subscribed_devices = {}
+        self._term_updates = None
         self.logger = logger or logging.getLogger(__name__)
         Intellect.__init__(self)
         if registry:
@@ -71,60 +75,90 @@ class RulesEngine(Intellect):
 
         loop_status = True
         while loop_status:
+            self.evaluate_agreements()
 
-            valid_agreements = self.__get_valid_agreements()
-
-            agreement_keys = self.__parse_valid_agreements(valid_agreements)
-
-            # REMOVE OLD POLICIES THAT HAVE EXPIRED FROM CACHE AND FROM DB
-            expired_policies = []
-            if len(self.active_policies.keys()) > len(agreement_keys):
-                expired_policies = list(set(self.active_policies.keys()) -
-                                        set(agreement_keys))
-
-            for key in expired_policies:
-                # Check if agreement is under reasoning
-                # Do not remove agreement until the reasoning is complete.
-                if key not in RulesEngine._agreements_under_reasoning:
-
-                    LOG.info("Removing Agreement and policy for "
-                             "Agreement ID: " + key)
-
-                    if key in RulesEngine._registry.resources.keys():
-                        # Get Agreement Entity
-                        agreement = RulesEngine._registry.resources[key]
-                        # agreement = self.registry.get_resource(key, None)
+            if refresh_period != 0:
+                time.sleep(refresh_period)
+            else:
+                loop_status = False
 
-                        # Change Terms state to "undefined"
-                        terms = self.__get_slo_terms(agreement.attributes)
-                        for term in terms:
-                            self.update_term(key, term + ".term.state",
-                                             "undefined")
+    def evaluate_agreements(self):
+        """
+            One pass of the Rules Engine: picks up the changes made to the
+            registry by other processes, subscribes the new valid agreements
+            and removes the policies of the expired ones.
+        """
+        RulesEngine._registry.sync()
 
-                            # Unsubscribe every term
-                            metricsinfos = DB.find({'agreement_id': key},
-                                                   {'_id': 0, 'terms': 1})
-                            mtrcs = metricsinfos[0]['terms'][term]
-                            aggrator = aggregator.Aggregator()
-                            if len(self.subscribed_devices[key]) > 0:
-                                device_ids = self.subscribed_devices[key]
-                                aggrator.unsubscribe_term(term, key,
-                                                          mtrcs,
-                                                          device_ids)
+        # The term states changed in this pass are saved in one go at its end
+        self._term_updates = []
+        try:
+            self.__evaluate_agreements()
+        finally:
+            updates, self._term_updates = self._term_updates, None
+            self.save_terms(updates)
 
-                    DB.remove({'agreement_id': key})
+    def __evaluate_agreements(self):
+        """
+            Evaluates the valid and expired agreements.
+        """
+        valid_agreements = self.__get_valid_agreements()
+
+        # Only the agreements whose validity changed, and those federating
+        # them, are worked out again.
+        affected = RulesEngine._registry.resources.graph.update(
+            agreement.identifier for agreement in valid_agreements)
+        if affected:
+            LOG.debug('Federation of {} agreements worked out again.'
+                      .format(len(affected)))
+
+        agreement_keys = self.__parse_valid_agreements(valid_agreements)
+
+        # REMOVE OLD POLICIES THAT HAVE EXPIRED FROM CACHE AND FROM DB
+        expired_policies = []
+        if len(self.active_policies.keys()) > len(agreement_keys):
+            expired_policies = list(set(self.active_policies.keys()) -
+                                    set(agreement_keys))
+
+        for key in expired_policies:
+            # Check if agreement is under reasoning
+            # Do not remove agreement until the reasoning is complete.
+            if key not in RulesEngine._agreements_under_reasoning:
+
+                LOG.info("Removing Agreement and policy for "
+                         "Agreement ID: " + key)
+
+                if key in RulesEngine._registry.resources.keys():
+                    # Get Agreement Entity
+                    agreement = RulesEngine._registry.resources[key]
+                    # agreement = self.registry.get_resource(key, None)
+
+                    # Change Terms state to "undefined"
+                    terms = self.__get_slo_terms(agreement.attributes)
+                    for term in terms:
+                        self.update_term(key, term + ".term.state",
+                                         "undefined")
+
+                        # Unsubscribe every term
+                        metricsinfos = DB.find({'agreement_id': key},
+                                               {'_id': 0, 'terms': 1})
+                        mtrcs = metricsinfos[0]['terms'][term]
+                        aggrator = aggregator.Aggregator()
+                        if len(self.subscribed_devices[key]) > 0:
+                            device_ids = self.subscribed_devices[key]
+                            aggrator.unsubscribe_term(term, key,
+                                                      mtrcs,
+                                                      device_ids)
 
-                    del self.active_policies[key]
+                DB.remove({'agreement_id': key})
+                WINDOWS.discard(key)
 
-            if self.active_policies.keys():
-                LOG.debug('Active agreements and policies are:')
-                for key in self.active_policies.keys():
-                    LOG.debug(key)
+                del self.active_policies[key]
 
-            if refresh_period != 0:
-                time.sleep(refresh_period)
-            else:
-                loop_status = False
+        if self.active_policies.keys():
+            LOG.debug('Active agreements and policies are:')
+            for key in self.active_policies.keys():
+                LOG.debug(key)
 
     def reason_agreement(self, agreement_id, metrics, device_id):
         """
@@ -176,7 +210,7 @@ class RulesEngine(Intellect):
             if len(links) > 0:
 
                 # parse links
-                rtrn_values = self.__get_devices(links, valid_agreements)
+                rtrn_values = self.__get_devices(agreement_id, links)
                 device_ids = rtrn_values['devices']
                 linked_agreements = rtrn_values['linked_agreements']
                 skip_agreement = rtrn_values['skip_agreement_flag']
@@ -198,8 +232,8 @@ class RulesEngine(Intellect):
                               % agreement_id)
                     # check if resources/devices have changed
                     current_links = self.active_agreements[agreement_id].links
-                    current_devices = self.__get_devices(current_links,
-                                                         valid_agreements)
+                    current_devices = self.__get_devices(agreement_id,
+                                                         current_links)
                     removed_devices = []
                     for device in self.subscribed_devices[agreement_id]:
                         if device not in current_devices['devices']:
@@ -244,47 +278,42 @@ class RulesEngine(Intellect):
                          .format(agreement_id))
         return agreement_keys
 
-    def __get_devices(self, links, valid_agreements):
+    def __get_devices(self, agreement_id, links):
         '''
         Returns the list of valid devices based on the links of an agreement,
         list of linked SLA agreements and if there is a fault in the linkage
-        of SLAs it returns a flag to break the loop.
+        of SLAs it returns a flag to break the loop. The linked agreements
+        are those of the agreement graph of the registry, which tells
+        whether they are all valid, transitively.
         '''
-        skip_agreement = False
         device_ids = []
-        linked_agreements = []
+        graph = RulesEngine._registry.resources.graph
+        linked = graph.linked(agreement_id)
+
+        if linked:
+            LOG.debug('SLA federation scenario triggered')
+            if not graph.usable(agreement_id):
+                # an agreement it is linked to is not valid, transitively
+                LOG.warn('Agreements linked to {} not valid!'
+                         .format(agreement_id))
+                return {'devices': device_ids, 'linked_agreements': [],
+                        'skip_agreement_flag': True}
 
         for link in links:
             if not isinstance(link, core_model.Link):
-                if link in RulesEngine._registry.resources.keys():
+                if link in RulesEngine._registry.resources:
                     link = RulesEngine._registry.resources[link]
                 else:
                     LOG.error("Link {} not in registry.".format(link))
             if link.kind == occi_sla.AGREEMENT_LINK:
-                temp_target = link.target
-                if isinstance(link.target, core_model.Resource) and \
-                   link.target.kind == occi_sla.AGREEMENT:
-                    LOG.debug('SLA federation scenario triggered')
-                    temp_res = RulesEngine._registry.resources
-                    if temp_res[temp_target.identifier] \
-                            not in valid_agreements:
-                        # check if is valid
-                        LOG.warn('Linked agreement {} not valid!'
-                                 .format(temp_target.identifier))
-                        # if its not valid break for loop
-                        skip_agreement = True
-                        break
-                    else:
-                        linked_agreements. \
-                            append(temp_target.identifier)
-                else:
-                    if isinstance(link.target, core_model.Resource):
-                        device_ids.append(link.target.identifier)
-                    else:
-                        device_ids.append(link.target)
+                target = link.target
+                if isinstance(target, core_model.Resource):
+                    target = target.identifier
+                if target not in linked:
+                    device_ids.append(target)
 
-        return {'devices': device_ids, 'linked_agreements': linked_agreements,
-                'skip_agreement_flag': skip_agreement}
+        return {'devices': device_ids, 'linked_agreements': sorted(linked),
+                'skip_agreement_flag': False}
 
     def __subscribe_term(self, agreement_id, attributes,
                          device_ids, template, term):
@@ -298,14 +327,19 @@ class RulesEngine(Intellect):
         term_remedy = attributes[build_attr(term, 'term.remedy')]
         attributes_keys = attributes.keys()
         attributes_keys.remove(build_attr(term, 'term.remedy'))
+        min_hold_key = build_attr(term, 'term.min_hold')
+        if min_hold_key in attributes_keys:
+            attributes_keys.remove(min_hold_key)
         for key in attributes_keys:
             if build_attr(template, term) in key:
                 mixed_metrics = key.replace(build_attr(template,
                                                        term) +
                                             '.', '')
                 if len(mixed_metrics.split('.')) == 1:
+                    # thresholds are kept with their native type, so that
+                    # evaluating a metric does not parse them again.
                     metrics[mixed_metrics] = {
-                        'value': attributes.get(key),
+                        'value': CODEC.typed_value(key, attributes.get(key)),
                         'limiter_type': attributes[
                             build_attr(template, term,
                                        mixed_metrics,
@@ -320,25 +354,40 @@ class RulesEngine(Intellect):
                             build_attr(template, term,
                                        mixed_metrics, 'limiter_type')
                         ]
-                        temp2 = attributes[build_attr(
+                        temp2_key = build_attr(
                             template, term, mixed_metrics, 'limiter_value')
-                        ]
+                        temp2 = CODEC.typed_value(temp2_key,
+                                                  attributes[temp2_key])
 
                         metrics[mixed_metrics] = {
-                            'value': attributes.get(key),
+                            'value': CODEC.typed_value(key,
+                                                       attributes.get(key)),
                             'limiter_type': temp1,
                             'limiter_value': temp2
                         }
 
+                    window_key = build_attr(template, term, mixed_metrics,
+                                            'window')
+                    if window_key in attributes:
+                        metrics[mixed_metrics]['window'] = \
+                            attributes[window_key]
+                    exit_key = build_attr(template, term, mixed_metrics,
+                                          'exit_value')
+                    if exit_key in attributes:
+                        metrics[mixed_metrics]['exit_value'] = \
+                            CODEC.typed_value(exit_key, attributes[exit_key])
+
         if metrics:
+            term_info = {'remedy': term_remedy, 'metrics': metrics}
+            if min_hold_key in attributes:
+                term_info['min_hold'] = CODEC.typed_value(
+                    min_hold_key, attributes[min_hold_key])
+
             # Subscribe term to Aggregator
             aggrator = aggregator.Aggregator()
-            aggrator.subscribe_term(term, agreement_id,
-                                    {'remedy': term_remedy,
-                                     'metrics': metrics},
-                                    device_ids)
+            aggrator.subscribe_term(term, agreement_id, term_info, device_ids)
 
-            return {'remedy': term_remedy, 'metrics': metrics}
+            return term_info
         else:
             return {}
 
@@ -387,6 +436,7 @@ class RulesEngine(Intellect):
             # Insert to Policies DB
             policy = {'agreement_id': agreement_id, 'policy':
                       str(self.active_policies[agreement_id]),
+                      'provider': getattr(agreement, 'provider', None),
                       'terms': terms_metrics,
                       'devices': device_ids,
                       'linked_agreements': linked_agreements}
@@ -401,6 +451,7 @@ class RulesEngine(Intellect):
                 temp.append(device)
             policy = {'agreement_id': agreement_id, 'policy':
                       str(self.active_policies[agreement_id]),
+                      'provider': getattr(agreement, 'provider', None),
                       'terms': terms_metrics,
                       'devices': temp,
                       'linked_agreements': linked_agreements}
@@ -488,6 +539,30 @@ class RulesEngine(Intellect):
 
         LOG.debug('Change term for {} to state {}'.format(term, state))
 
-        res = RulesEngine._registry.get_resource(agreement_id, None)
-        res.attributes[term] = state
-        RulesEngine._registry.resources.__setitem__(agreement_id, res)
+        if self._term_updates is not None:
+            self._term_updates.append((agreement_id, term, state))
+        else:
+            self.save_terms([(agreement_id, term, state)])
+
+    @staticmethod
+    def save_terms(updates):
+        """
+            Saves (agreement_id, term, state) updates and appends the ones
+            changing the state of a term to the term events.
+        """
+        resources = RulesEngine._registry.resources
+        transitions = []
+        states = {}
+        for agreement_id, term, state in updates:
+            agreement = resources.get(agreement_id)
+            if agreement is None:
+                continue
+            previous = states.get((agreement_id, term),
+                                  agreement.attributes.get(term))
+            states[(agreement_id, term)] = state
+            if previous != state:
+                transitions.append((agreement_id, agreement.provider,
+                                    term.replace(".term.state", ""), state))
+
+        resources.set_attributes(updates)
+        TERM_EVENTS.append(transitions)
@@ -20,17 +20,18 @@
 
 import logging
 import json
-from pymongo import MongoClient
+import threading
 import time
 import uuid
 import rulesengine
 import aggregator
 from api import occi_violation
 from api import occi_sla
+from utils import METRIC_TYPES, typed_metric_value
+from windows import WINDOWS, parse_window
+from context import LazyDatabase, LazyMetrics, current
 import arrow
 from occi import core_model
-import ConfigParser
-import pika
 
 LOG = logging.getLogger(__name__)
 fh = logging.FileHandler('logs/evaluation.log')
@@ -42,17 +43,58 @@ fh.setFormatter(formatter)
 # add the handlers to the logger
 LOG.addHandler(fh)
 
-METRICS = json.load(file("configs/metrics.json"))
-DB = MongoClient().sla
+METRICS = LazyMetrics()
+DB = LazyDatabase()
 
-config = ConfigParser.ConfigParser()
-config.read('configs/rabbit.cfg')
-RABBIT_MQ_HOST = config.get('rabbit', 'host')
-RABBIT_QUEUE = config.get('rabbit', 'queue')
-RABBIT_EXCHANGE = config.get('rabbit', 'exchange')
-RABBIT_USERNAME = config.get('rabbit', 'username')
-RABBIT_PASSWORD = config.get('rabbit', 'password')
-RABBIT_VIRTUAL_HOST = config.get('rabbit', 'virtual_host')
+# Seconds between pulling the metrics of a violated term.
+PULL_INTERVAL = 15
+
+
+class OpenViolations(object):
+    """
+        The violations being remedied, by (agreement_id, term, device_id),
+        so that a repeated violation updates the open one instead of
+        creating another.
+    """
+
+    def __init__(self):
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def open(self, key):
+        """
+            Opens a violation for key. Returns False if one is open already.
+        """
+        with self._lock:
+            if key in self._open:
+                return False
+            self._open[key] = None
+            return True
+
+    def attach(self, key, violation):
+        """
+            Sets the violation resource of an open violation.
+        """
+        with self._lock:
+            if key in self._open:
+                self._open[key] = violation
+
+    def violation(self, key):
+        """
+            Returns the violation resource open for key, None if not
+            created yet.
+        """
+        return self._open.get(key)
+
+    def close(self, key):
+        """
+            Closes the violation of key.
+        """
+        with self._lock:
+            self._open.pop(key, None)
+
+
+OPEN_VIOLATIONS = OpenViolations()
 
 
 class RulesEngineHelper(object):
@@ -146,9 +188,10 @@ class RulesEngineHelper(object):
         """
         self.agreement_id = value
 
-    def agreement_term_violated(self, agreement_id, term):
+    def agreement_term_violated(self, agreement_id, term, exiting=False):
         """
-            Method for the evaluation of a term violation.
+            Method for the evaluation of a term violation. When exiting a
+            violation, metrics are evaluated against their exit_value.
         """
         # LOG.debug("Inspect violation of agreement {} for term {}." \
         #          .format(agreement_id, term))
@@ -164,11 +207,22 @@ class RulesEngineHelper(object):
                 limiter_value = term_mtrc['limiter_value']
 
             slo_metric_value = term_mtrc['value']
+            if exiting and 'exit_value' in term_mtrc:
+                # hysteresis: the metric has to get back past the exit value
+                if limiter == 'margin':
+                    limiter_value = term_mtrc['exit_value']
+                else:
+                    slo_metric_value = term_mtrc['exit_value']
             metric_value = self._metrics[slo_metric]
-            
-            mtr_violated = self.__metric_violated(slo_metric,
-                                   slo_metric_value, metric_value, limiter,
-                                   limiter_value)
+
+            if 'window' in term_mtrc:
+                metric_value, mtr_violated = self.__window_violated(
+                    term, slo_metric, parse_window(term_mtrc['window']),
+                    slo_metric_value, limiter, limiter_value)
+            else:
+                mtr_violated = self.__metric_violated(slo_metric,
+                                       slo_metric_value, metric_value, limiter,
+                                       limiter_value)
             violation_flags.append(mtr_violated)
             if mtr_violated:
                 self._violated_metrics[slo_metric] = metric_value
@@ -189,12 +243,31 @@ class RulesEngineHelper(object):
         LOG.info("Enforcing remedy for agreement {} called for term {}."
                  .format(agreement_id, term))
 
+        key = (agreement_id, term, self.device_id)
+        if not OPEN_VIOLATIONS.open(key):
+            LOG.info("Violation of term {} on device {} is open already."
+                     .format(term, self.device_id))
+            self.__update_violation_metrics(OPEN_VIOLATIONS.violation(key))
+            return
+        try:
+            self.__remedy(agreement_id, term, key)
+        finally:
+            OPEN_VIOLATIONS.close(key)
+
+    def __remedy(self, agreement_id, term, open_key):
+        """
+            Reports the violation of a term and holds it open until the term
+            is fulfilled again, past the exit values of its metrics and for
+            at least min_hold seconds.
+        """
         myrulesengine = rulesengine.RulesEngine()
 
         myrulesengine.update_term(
             agreement_id, term + ".term.state", "violated")
 
         remedy = self._slo_terms_metrics[term]['remedy']
+        min_hold = self._slo_terms_metrics[term].get('min_hold', 0)
+        opened = time.time()
 
         # ToDo: interact with RCBaaS for charging the remedy
         self.__publish_to_rcb_queue(agreement_id, term, '', '', self.device_id, 
@@ -204,6 +277,8 @@ class RulesEngineHelper(object):
         violation = self.__create_violation_resource(term, '', '', self.device_id, 
                                                      self._violated_metrics, remedy, extras)
         link = self.__create_violation_link(agreement_id, violation, extras)
+        OPEN_VIOLATIONS.attach(open_key, violation)
+        reported = dict(self._violated_metrics)
 
         LOG.info('Wait for term to become valid.')
         aggrator = aggregator.Aggregator()
@@ -215,7 +290,11 @@ class RulesEngineHelper(object):
         for key, value in term_slo_metrics.iteritems():
             self._metrics[key] = value
 
-        while self.agreement_term_violated(agreement_id, term):
+        while self.agreement_term_violated(agreement_id, term, exiting=True) \
+                or time.time() - opened < min_hold:
+            if self._violated_metrics and self._violated_metrics != reported:
+                reported = dict(self._violated_metrics)
+                self.__update_violation_metrics(violation)
             term_slo_metrics = aggrator.pull_term(term,
                                                   agreement_id,
                                                   self._slo_terms_metrics[term]
@@ -224,7 +303,7 @@ class RulesEngineHelper(object):
 
             for key, value in term_slo_metrics.iteritems():
                 self._metrics[key] = value
-            time.sleep(15)
+            time.sleep(PULL_INTERVAL)
         LOG.info('SLO term {} became valid again.'.format(term))
         myrulesengine.update_term(
             agreement_id, term + ".term.state", "fulfilled")
@@ -234,6 +313,19 @@ class RulesEngineHelper(object):
         self.__delete_violation(violation, extras)
         self.__delete_violation_link(agreement_id, violation, link, extras)
 
+    def __update_violation_metrics(self, violation):
+        """
+           Sets the violated metrics of an open violation to their latest
+           values.
+        """
+        if violation is None:
+            # still being created
+            return
+        myrulesengine = rulesengine.RulesEngine()
+        myrulesengine._registry.resources.set_attribute(
+            violation.identifier, 'occi.violation.metrics',
+            json.dumps(self._violated_metrics))
+
     def __publish_to_rcb_queue(self, agreement_id, term, metric_name, metric_value, device_id, 
                                violation_metrics, remedy):
         """
@@ -246,14 +338,16 @@ class RulesEngineHelper(object):
         violation = {'agreement_id':agreement_id, 'timestamp':epoch_time, 'resource':device_id, 'term':term, 
                      'violation_metrics': json.dumps(violation_metrics), 'penalty':remedy}        
 
-        credentials = pika.PlainCredentials(RABBIT_USERNAME, RABBIT_PASSWORD)
-        parameters = pika.ConnectionParameters(host=RABBIT_MQ_HOST, port=5672, virtual_host=RABBIT_VIRTUAL_HOST, credentials=credentials)
         try:
+            import pika
+            rabbit = current().rabbit
+            credentials = pika.PlainCredentials(rabbit['username'], rabbit['password'])
+            parameters = pika.ConnectionParameters(host=rabbit['host'], port=5672, virtual_host=rabbit['virtual_host'], credentials=credentials)
             connection = pika.BlockingConnection(parameters)
             channel = connection.channel()
-            #channel.queue_declare(queue=RABBIT_QUEUE)
-            channel.basic_publish(exchange=RABBIT_EXCHANGE,
-                              routing_key=RABBIT_QUEUE,
+            #channel.queue_declare(queue=rabbit['queue'])
+            channel.basic_publish(exchange=rabbit['exchange'],
+                              routing_key=rabbit['queue'],
                               body=violation)
             connection.close()
         except:
@@ -305,12 +399,13 @@ class RulesEngineHelper(object):
         res.source = agreement
         res.target = violation.identifier
 
+        LOG.debug('Inserting violation link with ID: {}'.format(id))
+        resources = myrulesengine._registry.resources
+        resources.__setitem__(id, res)
+
         # Updating agreement resource with new link
         agreement.links.append(res)
-        myrulesengine._registry.resources.__setitem__(agreement_id, agreement)
-
-        LOG.debug('Inserting violation link with ID: {}'.format(id))
-        myrulesengine._registry.resources.__setitem__(id, res)
+        resources.attach_links({agreement_id: [id]})
         return res
 
     def __delete_violation_link(self, agreement_id, violation, violation_link, extras):
@@ -324,6 +419,8 @@ class RulesEngineHelper(object):
         agreement.identifier = agreement_id
         if violation_link in agreement.links:
             agreement.links.remove(violation_link)
+        myrulesengine._registry.resources.detach_links(
+            {agreement_id: [violation_link.identifier]})
 
     def __update_violation_end_time(self, violation, extras):
         """
@@ -365,6 +462,33 @@ class RulesEngineHelper(object):
                 extras = {"security": {provider: provider_pass}, "customer": customer}
                 return extras
 
+    def __window_violated(self, term, metric_name, window, slo_metric_value,
+                          limiter_type, limiter_value):
+        """
+           Check if metric is violated over its window. Returns the
+           aggregated value and whether it is violated. A window is not
+           judged until it is full.
+        """
+        function = window[0]
+        key = (self._agreement_id, term, self._device_id, metric_name)
+
+        if function == 'consecutive':
+            values = WINDOWS.values(key)
+            if values is None:
+                return None, False
+            violated = all(
+                self.__metric_violated(metric_name, slo_metric_value, value,
+                                       limiter_type, limiter_value)
+                for value in values)
+            return values[-1], violated
+
+        value = WINDOWS.aggregate(key, function)
+        if value is None:
+            return None, False
+        return value, self.__metric_violated(metric_name, slo_metric_value,
+                                             value, limiter_type,
+                                             limiter_value)
+
     def __metric_violated(self, metric_name, slo_metric_value,
                           metric_value, limiter_type, limiter_value):
         """
@@ -372,21 +496,20 @@ class RulesEngineHelper(object):
         """
 
         if (metric_name in METRICS) and metric_value:
-            if METRICS[metric_name]['value'] == 'integer':
-                slo_metric_value = int(slo_metric_value)
-                metric_value = int(metric_value)
-            elif METRICS[metric_name]['value'] == 'real':
-                slo_metric_value = float(slo_metric_value)
-                metric_value = float(metric_value)
-            elif METRICS[metric_name]['value'] == 'string':
-                pass
-            else:
+            value_type = METRICS[metric_name]['value']
+            if value_type not in METRIC_TYPES:
                 raise AttributeError
+            # Thresholds from the policy record are already typed, only
+            # values still held as strings get converted.
+            if value_type != 'string':
+                slo_metric_value = typed_metric_value(value_type,
+                                                      slo_metric_value)
+                metric_value = typed_metric_value(value_type, metric_value)
         else:
             return False
 
         if limiter_type == 'margin':
-            margin_percent = float(limiter_value) / 100.0
+            margin_percent = typed_metric_value('real', limiter_value) / 100.0
             low_margin = slo_metric_value - slo_metric_value * margin_percent
             high_margin = slo_metric_value + slo_metric_value * margin_percent
 
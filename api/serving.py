@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+    Pre-fork serving of the OCCI SLA API.
+
+    The listening socket is opened once, then every worker process builds its
+    own application and serves it with a threaded WSGI server. The Rules
+    Engine runs in a process of its own and only evaluates agreements while
+    it holds the Rules Engine lease, so a single engine is active across all
+    the processes using the same database. Changes to the resources are
+    exchanged through the ChangeLog, and the template lists loaded by any
+    process are registered by all of them through a TemplateWatcher. The
+    metric samples accepted by the workers are queued in the database for
+    the Rules Engine process to evaluate. Every process logs how saturated
+    its MongoDB connection pool is, and the footprint and hit rate of its
+    metric cache, every STATS_INTERVAL seconds.
+"""
+
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+import api
+import context
+import ingestion
+import metric_cache
+import rulesengine
+import templates
+from coordination import Lease
+
+LOG = logging.getLogger(__name__)
+# create console handler with a higher log level
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+# create formatter and add it to the handlers
+formatter = logging.Formatter('%(asctime)s - %(name)s - ' +
+                              '%(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+# add the handlers to the logger
+LOG.addHandler(ch)
+
+RULES_ENGINE_LEASE = "rulesengine"
+# Seconds between two logs of the statistics of a process.
+STATS_INTERVAL = 60
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """
+        WSGI server handling each request in a thread of its own.
+    """
+    daemon_threads = True
+
+
+def synced(application):
+    """
+        Wraps the application so that every request first picks up the
+        changes other processes made to the registry.
+    """
+    def synced_application(environ, start_response):
+        application.registry.sync()
+        return application(environ, start_response)
+    return synced_application
+
+
+def run_worker(listener, consume_metrics=False):
+    """
+        Builds the application and serves it on the inherited socket.
+    """
+    worker_server(listener, consume_metrics).serve_forever()
+
+
+def worker_server(listener, consume_metrics=False):
+    """
+        Builds the application of a worker and its server on the inherited
+        socket. Metric samples are handed to the Rules Engine process.
+    """
+    application = api.build(shared=True)
+    start_template_watcher(application)
+    start_stats_log()
+    ingestion.forward_samples()
+    if consume_metrics:
+        start_metrics_consumer()
+
+    server = ThreadingWSGIServer(listener.getsockname(), WSGIRequestHandler,
+                                 bind_and_activate=False)
+    server.socket = listener
+    host, port = listener.getsockname()[:2]
+    server.server_name = socket.getfqdn(host)
+    server.server_port = port
+    server.setup_environ()
+    server.set_app(synced(application))
+
+    LOG.info("Worker {0} serving on {1}:{2}".format(os.getpid(), host, port))
+    return server
+
+
+def process_stats():
+    """
+        Returns the statistics of the process, by what they are about.
+    """
+    return {"pool": context.current().pool.stats(),
+            "metric cache": metric_cache.CACHE.stats()}
+
+
+def log_stats():
+    """
+        Logs the statistics of the process.
+    """
+    for name, stats in sorted(process_stats().iteritems()):
+        LOG.info("{0} of {1}: {2}".format(
+            name, os.getpid(), ", ".join("{0}={1}".format(key, value)
+                                         for key, value
+                                         in sorted(stats.iteritems()))))
+
+
+def start_stats_log(interval=STATS_INTERVAL):
+    """
+        Logs the statistics of the process every interval seconds, from a
+        thread.
+    """
+    def log_periodically():
+        while True:
+            time.sleep(interval)
+            try:
+                log_stats()
+            except Exception as err:
+                LOG.error("Could not log the statistics: {0}".format(err))
+    logger = threading.Thread(target=log_periodically)
+    logger.daemon = True
+    logger.start()
+    return logger
+
+
+def start_template_watcher(application):
+    """
+        Registers the mixins of the template lists loaded by other processes
+        into application, from a thread.
+    """
+    watcher = templates.TemplateWatcher(
+        lambda diff: api.apply_template_diff(application, diff))
+    watcher.start()
+    return watcher
+
+
+def start_metrics_consumer():
+    """
+        Consumes the metric samples published to RabbitMQ in a thread.
+    """
+    consumer = threading.Thread(target=ingestion.consume)
+    consumer.daemon = True
+    consumer.start()
+    return consumer
+
+
+def start_sample_drain():
+    """
+        Evaluates the metric samples queued by the workers, from a thread.
+    """
+    drain = threading.Thread(target=ingestion.SampleQueue().run,
+                             args=(ingestion.INGESTOR,))
+    drain.daemon = True
+    drain.start()
+    return drain
+
+
+def run_rules_engine(refresh_period):
+    """
+        Runs the Rules Engine while holding its lease. Returns when the lease
+        is lost, so that the engine is restarted from a clean state.
+    """
+    lease = Lease(RULES_ENGINE_LEASE, ttl=3 * refresh_period)
+    engine = None
+    start_stats_log()
+    try:
+        while True:
+            if lease.acquire():
+                if engine is None:
+                    LOG.info("Rules Engine lease acquired by {0}"
+                             .format(lease.holder))
+                    registry = api.build(shared=True).registry
+                    engine = rulesengine.RulesEngine(registry)
+                    start_sample_drain()
+                engine.evaluate_agreements()
+            elif engine is not None:
+                LOG.warn("Rules Engine lease lost by {0}"
+                         .format(lease.holder))
+                return
+            time.sleep(refresh_period)
+    finally:
+        if engine is not None:
+            lease.release()
+
+
+def _raise_exit(signum, frame):
+    """
+        Turns SIGTERM into SystemExit so that clean up code runs.
+    """
+    raise SystemExit(0)
+
+
+def _spawn(children, target, *args):
+    """
+        Forks a child process running target(*args).
+    """
+    pid = os.fork()
+    if pid == 0:
+        context.current().after_fork()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, _raise_exit)
+        status = 1
+        try:
+            target(*args)
+            status = 0
+        except SystemExit:
+            status = 0
+        except Exception:
+            LOG.exception("Process {0} failed".format(os.getpid()))
+        finally:
+            # os._exit skips the EntityDictionary destructor, which would
+            # otherwise empty the entities collection shared by everyone.
+            os._exit(status)
+    children[pid] = (target, args)
+    return pid
+
+
+def serve(host='0.0.0.0', port=8888, workers=4, refresh_period=15,
+          consume_metrics=False):
+    """
+        Serves the API with the given number of worker processes plus a
+        Rules Engine process, restarting any of them that dies. With
+        consume_metrics every worker also consumes metric samples from
+        RabbitMQ.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+
+    children = {}
+    for _ in range(workers):
+        _spawn(children, run_worker, listener, consume_metrics)
+    _spawn(children, run_rules_engine, refresh_period)
+
+    signal.signal(signal.SIGTERM, _raise_exit)
+    try:
+        while True:
+            pid, status = os.wait()
+            target, args = children.pop(pid, (None, None))
+            if target is None:
+                continue
+            LOG.warn("Process {0} exited with status {1}, restarting"
+                     .format(pid, status))
+            time.sleep(1)
+            _spawn(children, target, *args)
+    except (KeyboardInterrupt, SystemExit):
+        LOG.info("Stopping {0} processes".format(len(children)))
+        for pid in children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children.keys():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
@@ -18,37 +18,277 @@
     Load and validate Provider template lists into the database
 """
 
-from pymongo import MongoClient
-import numbers
+import decimal
 import json
-DB = MongoClient().sla
-METRICS = json.load(file("configs/metrics.json"))
-
+import logging
+import numbers
+import threading
+import time
+from windows import window_spec
+from coordination import SequenceGaps
+from context import LazyDatabase, LazyMetrics, current
+from utils import authorised_provider, wsgi_reply
+LOG = logging.getLogger(__name__)
+# create console handler with a higher log level
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+# create formatter and add it to the handlers
+formatter = logging.Formatter('%(asctime)s - %(name)s - ' +
+                              '%(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+# add the handlers to the logger
+LOG.addHandler(ch)
+
+DB = LazyDatabase()
+METRICS = LazyMetrics()
+
+PATH = "/templates"
+# Seconds between two looks at the templates version by a TemplateWatcher.
+WATCH_INTERVAL = 2
+# Seconds a version not read is looked for again, as a writer takes its
+# version before it writes the list.
+VERSION_WAIT = 30
+
+# Python types of the metric values, by value type of the metrics catalogue.
+VALUE_TYPES = {"integer": numbers.Integral,
+               "real": numbers.Real,
+               "string": basestring}
+
+# (metrics catalogue, its MetricCheckers)
+_CHECKERS = (None, {})
+
+
+class TemplateDiff(object):
+    """
+        What loading a template list changed: the templates added, and for
+        the changed templates the terms added, changed and removed.
+    """
 
-def load_templates(templates):
+    def __init__(self, scheme, templates):
+        self.scheme = scheme
+        # the templates of the scheme once loaded
+        self.templates = templates
+        self.added = []
+        self.changed = {}
+
+    def __nonzero__(self):
+        return bool(self.added or self.changed)
+
+    @property
+    def updated(self):
+        """
+            Names of the templates added or changed.
+        """
+        return sorted(self.added + self.changed.keys())
+
+    def removed_terms(self):
+        """
+            Names of the terms removed from changed templates.
+        """
+        removed = set()
+        for _, _, terms in self.changed.itervalues():
+            removed.update(terms)
+        return removed
+
+    def summary(self):
+        """
+            Returns the diff as a JSON serialisable dict.
+        """
+        return {"scheme": self.scheme,
+                "added": sorted(self.added),
+                "changed": dict((name, {"added": added, "changed": changed,
+                                        "removed": removed})
+                                for name, (added, changed, removed)
+                                in self.changed.iteritems())}
+
+
+def diff_templates(scheme, stored, loaded):
+    """
+        Compares the stored templates of a scheme with loaded ones, which
+        are added to or replace the stored ones. Returns a TemplateDiff.
+    """
+    diff = TemplateDiff(scheme, dict(stored))
+    for name, template in loaded.iteritems():
+        old = stored.get(name)
+        if old is None:
+            diff.added.append(name)
+        elif old != template:
+            old_terms = old.get("terms", {})
+            new_terms = template.get("terms", {})
+            diff.changed[name] = (
+                sorted(term for term in new_terms if term not in old_terms),
+                sorted(term for term in new_terms if term in old_terms and
+                       old_terms[term] != new_terms[term]),
+                sorted(term for term in old_terms if term not in new_terms))
+        diff.templates[name] = template
+    return diff
+
+
+def load_templates(templates, validate=True, provider=None):
     """
         Takes a single list of templates for a provider and loads them into
-        the database
+        the database. Only the templates which differ from the stored ones
+        are validated, unless already validated, and written. Returns the
+        TemplateDiff.
+        A list loaded for a provider is owned by it, and only it can update
+        the scheme afterwards.
     """
-
-    validate_templates_3(templates)
+    if "scheme" not in templates:
+        raise AttributeError("Scheme must be specified")
+    if len(templates["templates"]) == 0:
+        raise AttributeError("No templates in template list")
 
     _id = {"_id": templates["scheme"]}
     templates.update(_id)
-
-    if DB.templates.find(_id).count() == 0:
+    templates.pop("version", None)
+    templates.pop("provider", None)
+
+    stored = DB.templates.find_one(_id)
+    if stored is None:
+        if validate:
+            validate_templates_3(templates)
+        if provider is not None:
+            templates["provider"] = provider
+        templates["version"] = next_version()
         DB.templates.insert(templates)
-    else:
-        current_temp = DB.templates.find(_id)[0]['templates']
-        for temp in templates['templates'].keys():
-            current_temp[temp] = templates['templates'][temp]
-        templates['templates'] = current_temp
-        DB.templates.update(_id, templates)
+        return diff_templates(templates["scheme"], {}, templates["templates"])
+    if provider is not None and stored.get("provider") != provider:
+        raise AttributeError("Provider Denied")
+
+    diff = diff_templates(templates["scheme"], stored["templates"],
+                          templates["templates"])
+    if diff and validate:
+        validate_templates_3({"scheme": templates["scheme"],
+                              "templates": dict(
+                                  (name, templates["templates"][name])
+                                  for name in diff.updated)})
+    updates = dict(("templates." + name, templates["templates"][name])
+                   for name in diff.updated)
+    for key, value in templates.iteritems():
+        if key not in ("_id", "templates") and stored.get(key) != value:
+            updates[key] = value
+    if updates:
+        updates["version"] = next_version()
+        DB.templates.update(_id, {"$set": updates})
+    return diff
+
+
+def next_version():
+    """
+        Takes the next version of the templates, which running servers
+        watch for changed template lists.
+    """
+    counter = DB.counters.find_and_modify(
+        {"_id": "templates"}, {"$inc": {"seq": 1}}, upsert=True, new=True)
+    return counter["seq"]
+
+
+class TemplateWatcher(threading.Thread):
+    """
+        Picks up the template lists other processes load into the database,
+        and passes what they changed to apply_diff as TemplateDiffs, so that
+        a running server registers their mixins without restarting.
+    """
+
+    def __init__(self, apply_diff, interval=WATCH_INTERVAL, db=None):
+        super(TemplateWatcher, self).__init__()
+        self.daemon = True
+        self.apply_diff = apply_diff
+        self.interval = interval
+        db = db if db is not None else DB
+        self.templates = db.templates
+        self.counters = db.counters
+        self.seen = self.latest()
+        self.gaps = SequenceGaps(VERSION_WAIT)
+        # the templates by scheme as last applied
+        self.known = dict((template_list["_id"], template_list["templates"])
+                          for template_list in self.templates.find())
+
+    def latest(self):
+        """
+            Returns the latest version of the templates.
+        """
+        counter = self.counters.find_one({"_id": "templates"})
+        return counter["seq"] if counter else 0
+
+    def poll(self):
+        """
+            Applies the template lists changed since the last poll. Returns
+            the TemplateDiffs applied.
+            Lists are only read when the version moved, or a version is
+            missing: taken by a writer, not read written yet. Missing ones
+            are looked for again for VERSION_WAIT seconds, so a list written
+            after a later one is not missed.
+        """
+        if self.latest() <= self.seen and not self.gaps:
+            return []
+
+        changed = list(self.templates.find(
+            self.gaps.query("version", self.seen)))
+        self.seen = self.gaps.update(
+            self.seen, set(template_list["version"]
+                           for template_list in changed))
+        diffs = []
+        for template_list in changed:
+            scheme = template_list["_id"]
+            diff = diff_templates(scheme, self.known.get(scheme, {}),
+                                  template_list["templates"])
+            if diff:
+                self.apply_diff(diff)
+                diffs.append(diff)
+            self.known[scheme] = diff.templates
+        return diffs
+
+    def run(self):
+        while True:
+            try:
+                for diff in self.poll():
+                    LOG.info("Applied templates {0}".format(diff.summary()))
+            except Exception as err:
+                LOG.error("Could not apply the loaded templates: {0}"
+                          .format(err))
+            time.sleep(self.interval)
+
+
+def serve(environ, response, apply_diff=None):
+    """
+    Loads a template list POSTed by a provider, as JSON, without restarting.
+    :param environ: Environment Dictionary of the request
+    :param response: WSGI start_response
+    :param apply_diff: Called with the TemplateDiff, to update the mixins
+    :return: Body
+    """
+    if environ.get("REQUEST_METHOD") != "POST":
+        return wsgi_reply(response, "405 Method Not Allowed", "text/plain",
+                          "Template lists are POSTed", [("Allow", "POST")])
+    provider = authorised_provider(environ, DB.providers)
+    if provider is None:
+        return wsgi_reply(response, "403 Forbidden", "text/plain",
+                          "Incorrect Provider Credentials")
+
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        templates = json.loads(environ["wsgi.input"].read(length))
+        if not isinstance(templates, dict) or \
+                not isinstance(templates.get("templates"), dict):
+            raise ValueError("Expected a template list")
+        diff = load_templates(templates, provider=provider)
+    except (ValueError, AttributeError, KeyError, TypeError) as err:
+        if str(err) == "Provider Denied":
+            return wsgi_reply(response, "403 Forbidden", "text/plain",
+                              "The scheme belongs to another provider")
+        return wsgi_reply(response, "400 Bad Request", "text/plain", str(err))
+
+    if diff and apply_diff is not None:
+        apply_diff(diff)
+    return wsgi_reply(response, "200 OK", "application/json",
+                      json.dumps(diff.summary()))
 
 
 def validate_templates_3(templates):
     """
-        Validates the template list. Throws an exception if invalid.
+        Validates the template list. Throws an exception if invalid, listing
+        all the errors found.
         This is a new version of the validation method based on the
         updated template format (e.g. term  type and conditions included)
     """
@@ -59,28 +299,215 @@ def validate_templates_3(templates):
     if len(templates["templates"]) == 0:
         raise AttributeError("No templates in template list")
 
+    errors = []
     for temp_key, template in templates["templates"].iteritems():
-        if len(template) > 0:
-            #if 'allowed_links' in template.keys():
-            #    allowed_links_schemas = template['allowed_links']
-                # validate allowed links
-            if "terms" not in template.keys():
-                raise AttributeError("Template {0} has no terms".format(temp_key))
+        errors.extend(template_errors(temp_key, template))
+    if errors:
+        raise AttributeError("; ".join(errors))
 
-            for term_k, term in template["terms"].iteritems():
-                if len(term) > 0:
-                    if term['type'] == 'SLO-TERM':
-                        for metric_k in term['metrics']:
-                            metric = term['metrics'][metric_k]
-                            if metric_k in METRICS:
-                                validate_metric2(metric_k, metric)
-                            else:
-                                raise AttributeError("{0} not a valid metric"
-                                                     .format(metric_k))
+
+def template_errors(temp_key, template):
+    """
+        Returns all the errors of a template, in the updated template format.
+    """
+    if len(template) == 0:
+        return ["{0} has no terms".format(temp_key)]
+    if "terms" not in template:
+        return ["Template {0} has no terms".format(temp_key)]
+
+    checkers = metric_checkers()
+    errors = []
+    for term_k, term in template["terms"].iteritems():
+        if len(term) == 0:
+            errors.append("{0} has no metrics".format(term_k))
+        elif term.get("type") == "SLO-TERM":
+            errors.extend(_slo_term_errors(term_k, term, checkers))
+    return errors
+
+
+def _slo_term_errors(term_k, term, checkers):
+    errors = []
+    if "min_hold" in term:
+        try:
+            validate_min_hold(term_k, term)
+        except AttributeError as err:
+            errors.append(str(err))
+    for metric_k, metric in term.get("metrics", {}).iteritems():
+        checker = checkers.get(metric_k)
+        if checker is None:
+            errors.append("{0} not a valid metric".format(metric_k))
+            continue
+        try:
+            checker.check(metric)
+        except AttributeError as err:
+            errors.append(str(err))
+        except KeyError as err:
+            errors.append("{0}: Missing {1}".format(metric_k, err))
+    return errors
+
+
+def validate_template_file(path):
+    """
+        Validates a template list file, template by template as it is read
+        when ijson is installed. Returns all the errors found.
+    """
+    errors = []
+    scheme = None
+    count = 0
+    with open(path, "rb") as stream:
+        try:
+            for key, value in _template_file_items(stream):
+                if key == "scheme":
+                    scheme = value
                 else:
-                    raise AttributeError("{0} has no metrics".format(term_k))
+                    count += 1
+                    errors.extend(template_errors(*value))
+        except ValueError as err:
+            errors.append("Invalid JSON: {0}".format(err))
+            return errors
+    if count == 0:
+        errors.insert(0, "No templates in template list")
+    if scheme is None:
+        errors.insert(0, "Scheme must be specified")
+    return errors
+
+
+def _template_file_items(stream):
+    """
+        Yields the ("scheme", scheme) and ("template", (name, template))
+        items of a template list file.
+    """
+    try:
+        import ijson
+    except ImportError:
+        template_list = json.load(stream)
+        if "scheme" in template_list:
+            yield "scheme", template_list["scheme"]
+        for item in template_list.get("templates", {}).iteritems():
+            yield "template", item
+        return
+
+    name, builder = None, None
+    try:
+        for prefix, event, value in ijson.parse(stream):
+            if prefix == "scheme":
+                yield "scheme", value
+            elif prefix == "templates" and event in ("map_key", "end_map"):
+                if builder is not None:
+                    yield "template", (name, builder.value)
+                name, builder = value, ijson.ObjectBuilder()
+            elif builder is not None and prefix.startswith("templates."):
+                if isinstance(value, decimal.Decimal):
+                    value = float(value)
+                builder.event(event, value)
+    except ijson.JSONError as err:
+        raise ValueError(str(err))
+
+
+def load_template_file(path):
+    """
+        Validates a template list file, reporting all its errors at once,
+        then loads it. Returns the TemplateDiff.
+    """
+    errors = validate_template_file(path)
+    if errors:
+        raise AttributeError("Invalid template list {0}: {1}"
+                             .format(path, "; ".join(errors)))
+    with open(path) as stream:
+        return load_templates(json.load(stream), validate=False)
+
+
+class MetricChecker(object):
+    """
+        Validates the SLO term metrics of one metric of the catalogue, its
+        value type and limiters being looked up once.
+    """
+
+    def __init__(self, key, definition):
+        self.key = key
+        self.value_type_name = definition["value"]
+        self.value_type = VALUE_TYPES.get(definition["value"])
+        self.numeric = definition["value"] in ("integer", "real")
+        self.limiters = frozenset(definition.get("limiters") or ())
+
+    def check(self, metric):
+        """
+            Raises an AttributeError at the first problem of the metric.
+        """
+        self.check_type(metric["value"])
+        self.check_limits(metric)
+        if metric["limiter_type"] == "margin":
+            validate_margin(self.key, metric)
+        if "window" in metric:
+            self.check_window(metric)
+        if "exit_value" in metric:
+            self.check_exit_value(metric)
+
+    def check_type(self, value):
+        """
+            Checks the value is of the value type of the metric.
+        """
+        if self.value_type is None or \
+                not isinstance(value, self.value_type):
+            raise AttributeError("{0} is not of type {1}"
+                                 .format(self.key, self.value_type_name))
+
+    def check_limits(self, metric):
+        """
+            Checks the limiter is one of those of the metric.
+        """
+        if metric["limiter_type"] not in self.limiters:
+            raise AttributeError("{0}: Incorrect Limits".format(self.key))
+
+    def check_window(self, metric):
+        """
+            Checks the window a metric is evaluated over. Only numeric
+            metrics can be aggregated.
+        """
+        if not self.numeric:
+            raise AttributeError("{0}: Only numeric metrics have windows"
+                                 .format(self.key))
+        try:
+            window_spec(metric["window"])
+        except AttributeError as err:
+            raise AttributeError("{0}: {1}".format(self.key, err))
+
+    def check_exit_value(self, metric):
+        """
+            Checks the threshold a violated metric has to cross back to end
+            the violation. It must be on the fulfilled side of the value, or
+            be a narrower margin.
+        """
+        limiter = metric["limiter_type"]
+        exit_value = metric["exit_value"]
+        if limiter == "margin":
+            validate_type(exit_value, "real", self.key)
+            if not 0 <= exit_value <= metric["limiter_value"]:
+                raise AttributeError("{0}: Exit margin must be "
+                                     "0-limiter_value".format(self.key))
+        elif limiter in ("min", "max"):
+            self.check_type(exit_value)
+            if limiter == "max" and exit_value > metric["value"] or \
+                    limiter == "min" and exit_value < metric["value"]:
+                raise AttributeError("{0}: Exit value must be within the "
+                                     "value".format(self.key))
         else:
-            raise AttributeError("{0} has no terms".format(temp_key))
+            raise AttributeError("{0}: Only min, max and margin limits have "
+                                 "an exit value".format(self.key))
+
+
+def metric_checkers():
+    """
+        Returns the MetricCheckers of the metrics catalogue of the current
+        context, by metric. They are compiled once per catalogue.
+    """
+    global _CHECKERS
+    metrics = current().metrics
+    if _CHECKERS[0] is not metrics:
+        _CHECKERS = (metrics, dict((key, MetricChecker(key, definition))
+                                   for key, definition
+                                   in metrics.iteritems()))
+    return _CHECKERS[1]
 
 
 def validate_templates_2(templates):
@@ -151,34 +578,41 @@ def validate_metric2(key, metric):
     """
         Takes a metric from a template and validates it
     """
-    validate_metric_value(key, metric['value'])
-    validate_correct_limits(key, metric)
+    metric_checkers()[key].check(metric)
 
-    if "max" in metric['limiter_type']:
-        # validate_max(key, metric)
-        pass
-    if "min" in metric['limiter_type']:
-        # validate_min(key, metric)
-        pass
-    if "margin" in metric['limiter_type']:
-        validate_margin(key, metric)
-    if "enum" in metric['limiter_type']:
-        # validate_enum(key, metric)
-        pass
+
+def validate_window(key, metric):
+    """
+        Validates the window a metric is evaluated over. Only numeric
+        metrics can be aggregated.
+    """
+    metric_checkers()[key].check_window(metric)
 
 
-def validate_correct_limits(key, metric):
+def validate_exit_value(key, metric):
     """
-        Ensures that the correct limits are for a given metric
+        Validates the threshold a violated metric has to cross back to end
+        the violation. It must be on the fulfilled side of the value, or be
+        a narrower margin.
     """
-    allowed_limits = []
-    if METRICS[key]["limiters"] is not None:
-        allowed_limits = set(METRICS[key]["limiters"])
+    metric_checkers()[key].check_exit_value(metric)
 
-    limits = metric['limiter_type']
 
-    if limits not in allowed_limits:
-        raise AttributeError("{0}: Incorrect Limits".format(key))
+def validate_min_hold(key, term):
+    """
+        Validates the seconds a violation of a term is held at least.
+    """
+    min_hold = term["min_hold"]
+    if not isinstance(min_hold, numbers.Real) or min_hold < 0:
+        raise AttributeError("{0}: min_hold must be a positive number"
+                             .format(key))
+
+
+def validate_correct_limits(key, metric):
+    """
+        Ensures that the correct limits are for a given metric
+    """
+    metric_checkers()[key].check_limits(metric)
 
 
 def validate_enum(key, metric):
@@ -239,8 +673,7 @@ def validate_metric_value(key, metric):
         Validates the current metric value against the value specified in the
         metric schema
     """
-    expctd_value_type = METRICS[key]["value"]
-    validate_type(metric, expctd_value_type, key)
+    metric_checkers()[key].check_type(metric)
 
 
 def validate_type(actual, expected, term):
@@ -249,12 +682,6 @@ def validate_type(actual, expected, term):
         Exception if not.
     """
 
-    value_type = None
-    if expected == "integer":
-        value_type = numbers.Integral
-    elif expected == "real":
-        value_type = numbers.Real
-    elif expected == "string":
-        value_type = basestring
-    if not isinstance(actual, value_type):
+    value_type = VALUE_TYPES.get(expected)
+    if value_type is None or not isinstance(actual, value_type):
         raise AttributeError("{0} is not of type {1}".format(term, expected))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Feed of the term state transitions (fulfilled, violated, undefined) made by
+the Rules Engine. Transitions are appended to a capped collection under an
+increasing sequence number, which clients pass back as resume token to the
+/term_events endpoint, either long-polling or as Server-Sent Events.
+"""
+
+import json
+import threading
+import time
+import urlparse
+
+import arrow
+from pymongo.errors import CollectionInvalid
+from context import LazyDatabase, current
+
+from utils import authorised_provider, wsgi_reply
+
+DB = LazyDatabase()
+
+PATH = "/term_events"
+
+# Size of the capped collection in bytes, the oldest events are dropped.
+CAPACITY = 8 * 1024 * 1024
+# Seconds between looking for events appended by other processes.
+POLL_INTERVAL = 1
+# Longest a request waits for events, in seconds.
+MAX_WAIT = 30
+# Most events returned at once.
+BATCH = 100
+# Seconds a missing sequence number is waited for, as its appender may still
+# be writing it, before the events after it are served anyway.
+GAP_WAIT = 5
+
+
+class TermEventLog(object):
+    """
+        Append-only log of term state transitions.
+    """
+
+    def __init__(self, db=None):
+        self.db = db if db is not None else DB
+        self._events = None
+        self._appended = threading.Condition()
+
+    @property
+    def events(self):
+        """
+            The capped collection of events, created on first use.
+        """
+        if self._events is None:
+            try:
+                self.db.create_collection("term_events", capped=True,
+                                          size=CAPACITY)
+            except CollectionInvalid:
+                pass  # already created
+            self._events = self.db.term_events
+        return self._events
+
+    @property
+    def counters(self):
+        """
+            The collection of the sequence counter.
+        """
+        return self.db.counters
+
+    def append(self, transitions):
+        """
+            Appends (agreement_id, provider, term, state) transitions and
+            returns the sequence number of the last one.
+        """
+        seq = None
+        for agreement_id, provider, term, state in transitions:
+            seq = self.counters.find_and_modify(
+                {"_id": "term_events"}, {"$inc": {"seq": 1}},
+                upsert=True, new=True)["seq"]
+            self.events.insert({"_id": seq,
+                                "agreement": agreement_id,
+                                "provider": provider,
+                                "term": term,
+                                "state": state,
+                                "time": arrow.utcnow().isoformat()})
+        if seq is not None:
+            with self._appended:
+                self._appended.notify_all()
+        return seq
+
+    def since(self, seq, provider=None, agreement=None, limit=BATCH):
+        """
+            Returns the events after the given sequence number, oldest first.
+            Events after a missing sequence number are held back, see
+            written_up_to, so that a reader resuming from them misses none.
+        """
+        query = {"_id": {"$gt": seq}}
+        if provider is not None:
+            query["provider"] = provider
+        if agreement is not None:
+            query["agreement"] = agreement
+        events = self.events.with_options(**current().options(reads="history"))
+        found = list(events.find(query).sort("_id", 1).limit(limit))
+        if not found:
+            return found
+        last = self.written_up_to(events, seq, found[-1]["_id"])
+        return [event for event in found if event["_id"] <= last]
+
+    @staticmethod
+    def written_up_to(events, seq, last):
+        """
+            Returns the sequence number up to which every event after seq is
+            written, at most last. Appenders take their number before they
+            insert the event, so a number can be missing for a moment. One
+            missing for GAP_WAIT seconds, or dropped from the capped
+            collection, is skipped.
+        """
+        query = {"_id": {"$gt": seq, "$lte": last}}
+        if events.find(query).count() == last - seq:
+            return last
+        expected = seq + 1
+        recent = time.time() - GAP_WAIT
+        for event in events.find(query, {"time": 1}).sort("_id", 1):
+            if event["_id"] != expected and \
+                    arrow.get(event["time"]).timestamp > recent:
+                return expected - 1
+            expected = event["_id"] + 1
+        return last
+
+    def latest(self):
+        """
+            Returns the sequence number of the latest event.
+        """
+        counter = self.counters.find_one({"_id": "term_events"})
+        return counter["seq"] if counter else 0
+
+    def wait(self, seq, timeout, provider=None, agreement=None):
+        """
+            Returns the events after the given sequence number, waiting up to
+            timeout seconds for some to be appended.
+        """
+        deadline = time.time() + timeout
+        while True:
+            events = self.since(seq, provider, agreement)
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                return events
+            with self._appended:
+                self._appended.wait(min(remaining, POLL_INTERVAL))
+
+
+TERM_EVENTS = TermEventLog()
+
+
+def serve(environ, response, log=None):
+    """
+    Serves the term events of the requesting provider. Query parameters are
+    since (resume token, defaults to the latest event), agreement and
+    timeout (seconds to wait for events). Clients accepting
+    text/event-stream get Server-Sent Events, others a JSON long-poll reply.
+    :param environ: Environment Dictionary of the request
+    :param response: WSGI start_response
+    :param log: TermEventLog to serve from
+    :return: Body
+    """
+    log = log or TERM_EVENTS
+    provider = authorised_provider(environ, DB.providers)
+    if provider is None:
+        return wsgi_reply(response, "403 Forbidden", "text/plain",
+                          "Incorrect Provider Credentials")
+
+    query = urlparse.parse_qs(environ.get("QUERY_STRING", ""))
+    try:
+        since = int(environ.get("HTTP_LAST_EVENT_ID") or
+                    query.get("since", [log.latest()])[0])
+        timeout = min(float(query.get("timeout", [MAX_WAIT])[0]), MAX_WAIT)
+    except ValueError:
+        return wsgi_reply(response, "400 Bad Request", "text/plain",
+                          "since and timeout must be numbers")
+    agreement = query.get("agreement", [None])[0]
+
+    if "text/event-stream" in environ.get("HTTP_ACCEPT", ""):
+        response("200 OK", [("Content-Type", "text/event-stream"),
+                            ("Cache-Control", "no-cache")])
+        return _stream(log, since, timeout, provider, agreement)
+
+    events = log.wait(since, timeout, provider, agreement)
+    next_seq = events[-1]["_id"] if events else since
+    body = json.dumps({"events": [_public(event) for event in events],
+                       "next": next_seq})
+    return wsgi_reply(response, "200 OK", "application/json", body)
+
+
+def _stream(log, since, timeout, provider, agreement):
+    """
+    Yields the events as Server-Sent Events until timeout, after which the
+    client reconnects with the Last-Event-ID header.
+    """
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        events = log.wait(since, remaining, provider, agreement)
+        for event in events:
+            since = event["_id"]
+            yield "id: {0}\nevent: term\ndata: {1}\n\n".format(
+                since, json.dumps(_public(event)))
+
+
+def _public(event):
+    """
+    Returns the event as shown to clients.
+    """
+    return {"seq": event["_id"],
+            "agreement": event["agreement"],
+            "term": event["term"],
+            "state": event["state"],
+            "time": event["time"]}
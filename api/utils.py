@@ -6,3 +6,41 @@ def build_attr(*args):
         Utility function for attribute fixing.
     '''
     return ".".join(args)
+
+
+# Python types of the metric value types declared in configs/metrics.json
+METRIC_TYPES = {'integer': int, 'real': float, 'string': str}
+
+
+def typed_metric_value(value_type, value):
+    '''
+        Returns the value as the native type of a metric value type. Values
+        which already have that type are returned as they are.
+    '''
+    python_type = METRIC_TYPES[value_type]
+    if isinstance(value, python_type):
+        return value
+    return python_type(value)
+
+
+def authorised_provider(environ, providers):
+    '''
+        Returns the provider of a WSGI request if its credentials are found
+        in the providers collection, None otherwise.
+    '''
+    provider = environ.get("HTTP_PROVIDER")
+    password = environ.get("HTTP_PROVIDER_PASS")
+    if provider is None or \
+            not providers.find_one({"username": provider,
+                                    "password": password}):
+        return None
+    return provider
+
+
+def wsgi_reply(response, status, content_type, body, headers=()):
+    '''
+        Starts a WSGI response with the whole body and returns the body.
+    '''
+    response(status, [("Content-Type", content_type),
+                      ("Content-Length", str(len(body)))] + list(headers))
+    return [body]
@@ -19,14 +19,15 @@
 """
 
 from occi.backend import ActionBackend, KindBackend, MixinBackend
-from pymongo import MongoClient
 from api import occi_sla
 import logging
 import arrow
 import copy
 import api
+from context import LazyDatabase
+from backends import attach_links, detach_links
 
-DB = MongoClient().sla
+DB = LazyDatabase()
 LOG = logging.getLogger(__name__)
 
 class Violation(KindBackend, ActionBackend):
@@ -167,15 +168,7 @@ class ViolationLink(KindBackend):
         if target_id == '':
             raise AttributeError('Target endpoint is empty!')
 
-        link_id = entity.identifier
-
-        db_agreements = DB.entities.find({'_id': agreement_id})
-        if db_agreements.count() > 0:
-            for agreement in db_agreements:
-                if agreement['kind'] == '/agreement/' and link_id \
-                        not in agreement['links']:
-                    agreement['links'].append(link_id)
-                    DB.entities.update({'_id': agreement_id}, agreement)
+        attach_links({agreement_id: [entity.identifier]})
 
         # Init Agreement
         entity.provider = Violation()._get_provider(extras)
@@ -190,15 +183,7 @@ class ViolationLink(KindBackend):
             raise AttributeError("Provider Denied")
 
         agreement_id = entity.attributes['occi.core.source']
-        link_id = entity.identifier
-
-        db_agreements = DB.entities.find({'_id': agreement_id})
-        if db_agreements.count() > 0:
-            for agreement in db_agreements:
-                if agreement['kind'] == '/agreement/' and link_id \
-                        in agreement['links']:
-                    agreement['links'].remove(link_id)
-                    DB.entities.update({'_id': agreement_id}, agreement)
+        detach_links({agreement_id: [entity.identifier]})
 
     def verify_provider(self, extras):
         """
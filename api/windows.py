@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Rolling windows of metric samples, for SLO metrics that are evaluated over
+a window instead of a single sample. A template metric declares its window
+as
+
+    "window": {"function": "p95", "samples": 60, "seconds": 300}
+
+where function is avg, min, max, a percentile pNN, or consecutive (every
+sample of the window violates the threshold). A window holds the last
+`samples` samples, none older than `seconds` when given, and is only judged
+once it holds all of them, so that a few early samples cannot open a
+violation. A window with `seconds` that gets fewer samples in that time is
+judged on those once it has been sampled for `seconds`, except for
+consecutive, which always takes `samples` samples. It keeps a running sum and a sorted copy of the samples: adding
+one costs a binary search and a shift of at most MAX_SAMPLES values.
+"""
+
+import bisect
+import collections
+import math
+import re
+import threading
+import time
+
+# Largest number of samples a window may hold.
+MAX_SAMPLES = 1000
+
+FUNCTIONS = ("avg", "min", "max", "consecutive")
+PERCENTILE = re.compile(r"^p([1-9][0-9]?)$")
+
+
+def window_spec(window):
+    """
+    Validates a window declared in a template and returns it as a
+    (function, samples, seconds) tuple; seconds is None when not given.
+    """
+    if not isinstance(window, dict):
+        raise AttributeError("Window must be an object")
+    function = window.get("function")
+    if function not in FUNCTIONS and \
+            not PERCENTILE.match(str(function)):
+        raise AttributeError("Window function must be one of {0} or pNN"
+                             .format(", ".join(FUNCTIONS)))
+    samples = window.get("samples")
+    if not isinstance(samples, int) or not 0 < samples <= MAX_SAMPLES:
+        raise AttributeError("Window samples must be 1-{0}"
+                             .format(MAX_SAMPLES))
+    seconds = window.get("seconds")
+    if seconds is not None and \
+            (not isinstance(seconds, (int, float)) or seconds <= 0):
+        raise AttributeError("Window seconds must be positive")
+    return function, samples, seconds
+
+
+def window_text(spec):
+    """
+    Returns a window spec as the text kept in agreement attributes,
+    e.g. p95:60:300 or avg:10.
+    """
+    function, samples, seconds = spec
+    if seconds is None:
+        return "{0}:{1}".format(function, samples)
+    return "{0}:{1}:{2}".format(function, samples, seconds)
+
+
+def parse_window(text):
+    """
+    Returns the spec of a window kept as text, see window_text.
+    """
+    parts = str(text).split(":")
+    seconds = float(parts[2]) if len(parts) > 2 else None
+    return parts[0], int(parts[1]), seconds
+
+
+class SampleWindow(object):
+    """
+        The last samples of a metric, with their sum and a sorted copy kept
+        up to date as samples come and go.
+    """
+
+    def __init__(self, size, seconds=None):
+        self.size = size
+        self.seconds = seconds
+        self._samples = collections.deque()  # (time, value)
+        self._since = None  # time of the first sample
+        self._sorted = []
+        self._sum = 0.0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, value, now=None):
+        """
+            Adds a sample, dropping the oldest one if the window is full.
+        """
+        value = float(value)
+        now = time.time() if now is None else now
+        self._expire(now)
+        if self._since is None:
+            self._since = now
+        if len(self._samples) == self.size:
+            self._drop()
+        self._samples.append((now, value))
+        bisect.insort(self._sorted, value)
+        self._sum += value
+
+    def aggregate(self, function, now=None):
+        """
+            Returns the avg, min, max or pNN of the samples in the window,
+            None if it is empty.
+        """
+        self._expire(time.time() if now is None else now)
+        if not self._samples:
+            return None
+        if function == "avg":
+            return self._sum / len(self._samples)
+        if function == "min":
+            return self._sorted[0]
+        if function == "max":
+            return self._sorted[-1]
+        # nearest-rank percentile
+        rank = int(math.ceil(float(function[1:]) / 100 * len(self._sorted)))
+        return self._sorted[max(rank, 1) - 1]
+
+    def values(self, now=None):
+        """
+            Returns the samples in the window, oldest first.
+        """
+        self._expire(time.time() if now is None else now)
+        return [value for _, value in self._samples]
+
+    def full(self, now=None):
+        """
+            Returns True if the window holds all its samples.
+        """
+        self._expire(time.time() if now is None else now)
+        return len(self._samples) == self.size
+
+    def ready(self, now=None):
+        """
+            Returns True if the aggregate of the window can be judged: it
+            is full, or it has samples and has been sampled for its seconds.
+        """
+        now = time.time() if now is None else now
+        if self.full(now):
+            return True
+        return self.seconds is not None and bool(self._samples) and \
+            now - self._since >= self.seconds
+
+    def _expire(self, now):
+        """
+            Drops the samples older than the window.
+        """
+        if self.seconds is None:
+            return
+        while self._samples and self._samples[0][0] < now - self.seconds:
+            self._drop()
+
+    def _drop(self):
+        """
+            Drops the oldest sample.
+        """
+        _, value = self._samples.popleft()
+        del self._sorted[bisect.bisect_left(self._sorted, value)]
+        self._sum -= value
+        if not self._samples:
+            self._sum = 0.0  # no drift from floating point sums
+
+
+class WindowStore(object):
+    """
+        The windows of the SLO metrics, by (agreement_id, term, device_id,
+        metric).
+    """
+
+    def __init__(self):
+        self._windows = {}
+        self._agreements = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, value, spec, now=None):
+        """
+            Adds a sample to the window of key, creating it as given by the
+            (function, samples, seconds) spec.
+        """
+        _, samples, seconds = spec
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or window.size != samples or \
+                    window.seconds != seconds:
+                window = self._windows[key] = SampleWindow(samples, seconds)
+                self._agreements.setdefault(key[0], set()).add(key)
+            window.add(value, now)
+
+    def aggregate(self, key, function, now=None):
+        """
+            Returns the avg, min, max or pNN of the window of key, None
+            unless the window is ready to be judged.
+        """
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or not window.ready(now):
+                return None
+            return window.aggregate(function, now)
+
+    def values(self, key, now=None):
+        """
+            Returns the samples of the window of key, oldest first, None
+            unless the window is full, as consecutive samples are judged.
+        """
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or not window.full(now):
+                return None
+            return window.values(now)
+
+    def discard(self, agreement_id):
+        """
+            Drops the windows of an agreement.
+        """
+        with self._lock:
+            for key in self._agreements.pop(agreement_id, ()):
+                self._windows.pop(key, None)
+
+
+WINDOWS = WindowStore()
@@ -17,18 +17,172 @@
 """
     Overriding wsgi Application to modify what is past on through extras
 """
+import StringIO
+
 import occi.wsgi
 
+import bulk
+import ingestion
+import templates
+import term_events
+from utils import wsgi_reply
+
+# Times a write is handled again when the entity was saved concurrently.
+WRITE_RETRIES = 3
+
 
 class Application(occi.wsgi.Application):
     """
         WSGI Application
     """
     def __call__(self, environ, response):
+        if environ.get("PATH_INFO") == term_events.PATH:
+            return term_events.serve(environ, response)
+        if environ.get("PATH_INFO") == ingestion.PATH:
+            return ingestion.serve(environ, response)
+        if environ.get("PATH_INFO") == templates.PATH:
+            return templates.serve(environ, response,
+                                   self._apply_template_diff)
+        if environ.get("PATH_INFO") in (bulk.PATH, bulk.LINKS_PATH):
+            return bulk.serve(environ, response, self.registry)
+
         cred = _get_prov_credentials(environ)
         cust = _get_customer(environ)
 
-        return self._call_occi(environ, response, security=cred, customer=cust)
+        resources = getattr(self.registry, "resources", None)
+        if not hasattr(resources, "version"):
+            return self._call_occi(environ, response, security=cred,
+                                   customer=cust)
+
+        method = environ.get("REQUEST_METHOD", "GET")
+        key = environ.get("PATH_INFO", "/")
+        if method in ("GET", "HEAD"):
+            return self._call_versioned(environ, response, cred, cust)
+
+        if method not in ("PUT", "POST") or key.endswith("/") or \
+                key not in resources:
+            return self._call_versioned(environ, response, cred, cust)
+
+        # The entity lock is only taken by compare_and_set, to save the
+        # entity: the backends write other entities (links, term states)
+        # under their own locks, which could otherwise be taken in the
+        # opposite order by another request.
+        if_match = environ.get("HTTP_IF_MATCH")
+        body = _buffer_body(environ)
+        for _ in range(WRITE_RETRIES):
+            version = resources.version(key)
+            if if_match is not None and not _etag_matches(if_match, version):
+                return _precondition_failed(response)
+            environ["wsgi.input"] = StringIO.StringIO(body)
+            # pyssf changes the entity it is handed in place, so it is
+            # handed a copy, which is swapped in once saved, unless someone
+            # else saved the entity since it was read
+            working = resources.working_copy(key)
+            status, headers, result = self._call_captured(
+                environ, cred, cust, working_copy=working)
+            if not status.startswith("200") or key not in resources:
+                break
+            if resources.commit(key, working, version):
+                headers.append(("ETag", _etag(resources.version(key))))
+                break
+            resources.reload(key)
+            if key not in resources:
+                # deleted meanwhile
+                environ["wsgi.input"] = StringIO.StringIO(body)
+                return self._call_versioned(environ, response, cred, cust)
+        else:
+            return _conflict(response)
+
+        response(status, headers)
+        return result
+
+    def _call_versioned(self, environ, response, cred, cust):
+        """
+            Handles the request, adding the ETag of the entity requested.
+        """
+        status, headers, result = self._call_captured(environ, cred, cust)
+        resources = self.registry.resources
+        key = environ.get("PATH_INFO", "/")
+        if status.startswith("20") and key in resources:
+            headers.append(("ETag", _etag(resources.version(key))))
+        response(status, headers)
+        return result
+
+    def _call_captured(self, environ, cred, cust, **extras):
+        """
+            Handles the request, returning the status and headers instead of
+            starting the response. Further extras are passed on to pyssf.
+        """
+        started = []
+
+        def capture(status, headers):
+            started.append((status, list(headers)))
+
+        result = self._call_occi(environ, capture, security=cred,
+                                 customer=cust, **extras)
+        status, headers = started[0]
+        return status, headers, result
+
+    def _apply_template_diff(self, diff):
+        """
+            Updates the template and term mixins after loading templates.
+            Imported here, as the API module builds this application.
+        """
+        import api
+        api.apply_template_diff(self, diff)
+
+
+def _etag(version):
+    """
+    Returns the ETag of an entity version.
+    :param version: Version of the entity's db record
+    :return: Quoted ETag
+    """
+    return '"{0}"'.format(version)
+
+
+def _etag_matches(if_match, version):
+    """
+    Returns True if the If-Match header matches the entity version.
+    :param if_match: Value of the If-Match header
+    :param version: Current version of the entity
+    :return: Boolean
+    """
+    tags = [tag.strip() for tag in if_match.split(",")]
+    return "*" in tags or _etag(version) in tags
+
+
+def _buffer_body(environ):
+    """
+    Reads the request body, so that the request can be handled again.
+    :param environ: Environment Dictionary of the request
+    :return: Body
+    """
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        return environ["wsgi.input"].read(length)
+    except (KeyError, ValueError):
+        return ""
+
+
+def _precondition_failed(response):
+    """
+    Responds that the entity changed since the version the client expected.
+    :param response: WSGI start_response
+    :return: Body
+    """
+    return wsgi_reply(response, "412 Precondition Failed", "text/plain",
+                      "The entity was changed")
+
+
+def _conflict(response):
+    """
+    Responds that the entity kept being changed while handling the request.
+    :param response: WSGI start_response
+    :return: Body
+    """
+    return wsgi_reply(response, "409 Conflict", "text/plain",
+                      "The entity is being changed concurrently")
 
 
 def _get_prov_credentials(environ):
@@ -15,7 +15,7 @@
 # limitations under the License.
 #
 from wsgiref.simple_server import make_server
-from pymongo import MongoClient
+import argparse
 import logging
 import json
 import threading
@@ -23,8 +23,11 @@ import sys
 from api import api
 import api.create_providers_credentials as provider_details
 from api import templates
+from api import indexes
 from api import rulesengine
+from api import serving
 import api.create_monitoring_records as monitoring_details
+from api.context import LazyDatabase
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
@@ -43,7 +46,7 @@ ch.setFormatter(formatter)
 LOG.addHandler(ch)
 #logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
-DB = MongoClient().sla.entities
+DB = LazyDatabase("entities")
 
 def clean_violation_from_db():
     """
@@ -70,21 +73,38 @@ def init_environment():
     """
     # Load Templates
     
-    temps_dss = json.load(file("configs/template_definition_DSS.json"))
-    templates.load_templates(temps_dss)
+    templates.load_template_file("configs/template_definition_DSS.json")
 
     #Add Providers login credentials
     provider_details.load_providers()
 
     #Add monitoring capabilities and Collectos's API
     monitoring_details.load_monitoring_capabilities()
+
+    # Indexes of the queries made on every request and notification
+    indexes.init_indexes()
     
     clean_violation_from_db()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OCCI SLA server")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve with this many worker processes and a "
+                             "separate Rules Engine process (default: a "
+                             "single process)")
+    parser.add_argument("--consume-metrics", action="store_true",
+                        help="also take metric samples from the RabbitMQ "
+                             "metrics queue")
+    args = parser.parse_args()
+
     try:
             LOG.info("Starting OCCI server")
             init_environment()
+            if args.workers > 0:
+                serving.serve('0.0.0.0', 8888, args.workers, 15,
+                              args.consume_metrics)
+                sys.exit(0)
+
             northbound_api = api.build()
 
             #start RulesEngine
@@ -93,6 +113,12 @@ if __name__ == "__main__":
             RE_thread.daemon = True
             RE_thread.start()
 
+            serving.start_template_watcher(northbound_api)
+            serving.start_stats_log()
+
+            if args.consume_metrics:
+                serving.start_metrics_consumer()
+
             httpd = make_server('0.0.0.0', 8888, northbound_api)
             httpd.serve_forever()
             #tmps = json.load(file("tests/sample_data/template_definition.json"))
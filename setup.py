@@ -26,5 +26,6 @@ setup(name='occi-sla',
       url='http://www.intel.com',
       license='Apache 2.0',
       packages=['api'],
-      install_requires=['pyssf', 'arrow', 'pymongo', 'Intellect', 'requests', 'httpretty', 'pika'],
+      install_requires=['pyssf', 'arrow', 'pymongo>=3.9,<4', 'Intellect', 'requests', 'httpretty', 'pika>=1.0'],
+      extras_require={'streaming': ['ijson>=2.3,<3']},
       zip_safe=False)
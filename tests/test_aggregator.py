@@ -1,5 +1,7 @@
-from api.aggregator import Aggregator
+from api.aggregator import Aggregator, NotificationBatcher
+from api.windows import WINDOWS
 import logging
+import threading
 import unittest
 from pymongo import MongoClient
 
@@ -137,3 +139,95 @@ class AggregatorOperation(unittest.TestCase):
         """
         gator = Aggregator()
         self.assertRaises(TypeError, gator.notification_event, "/compute/testing-device", "uptime", 80)
+
+
+class RecordingAggregator(Aggregator):
+    """
+        Aggregator recording what it would reason.
+    """
+    def __init__(self):
+        super(RecordingAggregator, self).__init__()
+        self.reasoned = []
+        self.notified = []
+        self.samples = []
+        self.flushed = threading.Event()
+
+    def _reason_device(self, policy, device_id, metric_values, missing):
+        self.reasoned.append((policy['agreement_id'], device_id,
+                              metric_values, missing))
+
+    def notification_events(self, device_id, metric_values, samples=None):
+        self.notified.append((device_id, metric_values))
+        self.samples.extend((device_id, metric, value)
+                            for metric, value, _ in samples or ())
+        self.flushed.set()
+        if device_id == "/compute/broken":
+            raise AttributeError("no policy")
+
+
+class NotificationBatching(unittest.TestCase):
+    def setUp(self):
+        DB.policies.insert({"_id": "batched-policy",
+                            "agreement_id": "/agreement/batched",
+                            "devices": ["/compute/batched"],
+                            "terms": {"availability": {"metrics": {
+                                "uptime": {}, "load": {}}},
+                                "latency": {"metrics": {"rtt": {}}}}})
+
+    def tearDown(self):
+        DB.policies.remove({"_id": "batched-policy"})
+
+    def test_agreement_is_reasoned_once_for_several_metrics(self):
+        gator = RecordingAggregator()
+        Aggregator.notification_events(gator, "/compute/batched",
+                                       {"uptime": 99, "rtt": 5, "other": 1})
+
+        self.assertEqual(gator.reasoned,
+                         [("/agreement/batched", "/compute/batched",
+                           {"uptime": 99, "rtt": 5}, set(["load"]))])
+        self.assertRaises(AttributeError, Aggregator.notification_events,
+                          gator, "/compute/batched", {"other": 1})
+
+    def test_every_notified_sample_is_windowed(self):
+        DB.policies.update({"_id": "batched-policy"},
+                           {"$set": {"terms.latency.metrics.rtt":
+                                     {"window": "max:2"}}})
+        gator = RecordingAggregator()
+        Aggregator.notification_events(gator, "/compute/batched", {"rtt": 5},
+                                       [("rtt", 9, 1000), ("rtt", 5, 1001),
+                                        ("uptime", 1, 1001)])
+        try:
+            self.assertEqual(WINDOWS.values(("/agreement/batched", "latency",
+                                             "/compute/batched", "rtt")),
+                             [9.0, 5.0])
+        finally:
+            WINDOWS.discard("/agreement/batched")
+
+    def test_batch_keeps_latest_values_per_device(self):
+        gator = RecordingAggregator()
+        batcher = NotificationBatcher(window=60, size=4, gator=gator)
+
+        batcher.add("/compute/broken", "uptime", 1)
+        batcher.add("/compute/a", "uptime", 1)
+        batcher.add("/compute/a", "rtt", 7)
+        self.assertEqual(gator.notified, [])
+        batcher.add("/compute/a", "uptime", 2)
+
+        self.assertEqual(sorted(gator.notified),
+                         [("/compute/a", {"uptime": 2, "rtt": 7}),
+                          ("/compute/broken", {"uptime": 1})])
+        # windows get every sample, not only the latest ones
+        self.assertEqual(sorted(gator.samples),
+                         [("/compute/a", "rtt", 7), ("/compute/a", "uptime", 1),
+                          ("/compute/a", "uptime", 2),
+                          ("/compute/broken", "uptime", 1)])
+        self.assertEqual(batcher.flush(), 0)
+
+    def test_batch_is_reasoned_after_window(self):
+        gator = RecordingAggregator()
+        batcher = NotificationBatcher(window=0.05, size=100, gator=gator)
+
+        batcher.add("/compute/a", "uptime", 1)
+
+        self.assertTrue(gator.flushed.wait(5))
+        self.assertEqual(gator.notified, [("/compute/a", {"uptime": 1})])
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import unittest
+from api.agreement_graph import AgreementGraph
+
+
+class TestAgreementGraph(unittest.TestCase):
+    """
+        Tests the graph of the links between agreements.
+    """
+
+    def setUp(self):
+        # a -> b -> c, d -> c
+        self.graph = AgreementGraph()
+        self.graph.add_link("/agreement_link/1", "a", "b")
+        self.graph.add_link("/agreement_link/2", "b", "c")
+        self.graph.add_link("/agreement_link/3", "d", "c")
+
+    def test_adjacency_follows_links(self):
+        self.graph.add_link("/agreement_link/4", "a", "b")
+        self.assertEqual(self.graph.linked("a"), {"b"})
+        self.assertEqual(self.graph.dependents("c"), {"b", "d"})
+
+        self.graph.remove_link("/agreement_link/1")
+        self.assertEqual(self.graph.linked("a"), {"b"})
+        self.graph.remove_link("/agreement_link/4")
+        self.assertEqual(self.graph.linked("a"), set())
+        self.assertEqual(self.graph.dependents("b"), set())
+        self.assertEqual(self.graph.affected(["c"]), {"b", "c", "d"})
+
+    def test_validity_is_transitive(self):
+        self.graph.update(["a", "b", "c", "d"])
+        self.assertTrue(all(self.graph.usable(key) for key in "abcd"))
+
+        affected = self.graph.update(["a", "b", "d"])
+
+        self.assertEqual(affected, {"a", "b", "c", "d"})
+        self.assertEqual([self.graph.usable(key) for key in "abcd"],
+                         [False, False, False, False])
+
+    def test_only_dependents_are_worked_out(self):
+        self.graph.add_link("/agreement_link/4", "e", "f")
+        self.graph.update(["a", "b", "c", "d", "e", "f"])
+
+        affected = self.graph.update(["a", "c", "d", "e", "f"])
+
+        self.assertEqual(affected, {"a", "b"})
+        self.assertFalse(self.graph.usable("a"))
+        self.assertTrue(self.graph.usable("d"))
+        self.assertTrue(self.graph.usable("e"))
+        self.assertEqual(self.graph.update(["a", "c", "d", "e", "f"]), set())
+
+    def test_cycles_are_not_usable(self):
+        self.graph.update(["a", "b", "c", "d"])
+        self.graph.add_link("/agreement_link/4", "c", "a")
+
+        self.graph.update(["a", "b", "c", "d"])
+
+        self.assertEqual(self.graph.cycles(), {"a", "b", "c"})
+        self.assertEqual([self.graph.usable(key) for key in "abcd"],
+                         [False, False, False, False])
+
+        self.graph.remove_link("/agreement_link/4")
+        self.graph.update(["a", "b", "c", "d"])
+        self.assertEqual(self.graph.cycles(), set())
+        self.assertTrue(all(self.graph.usable(key) for key in "abcd"))
+
+    def test_every_agreement_on_a_cycle_is_found(self):
+        graph = AgreementGraph()
+        for key, (source, target) in enumerate([("n3", "n2"), ("n1", "n2"),
+                                                 ("n1", "n3"), ("n2", "n1"),
+                                                 ("n4", "n1"), ("n5", "n5")]):
+            graph.add_link(key, source, target)
+
+        graph.update(["n1", "n2", "n3", "n4", "n5"])
+
+        self.assertEqual(graph.cycles(), {"n1", "n2", "n3", "n5"})
+        self.assertFalse(any(graph.usable(key)
+                             for key in ["n1", "n2", "n3", "n4", "n5"]))
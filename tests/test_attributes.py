@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import copy
+import sys
+import unittest
+from pymongo import MongoClient
+from api.attributes import CODEC, CompactAttributes
+from api.migrate_attributes import migrate_attributes
+
+
+def _agreement_attributes(number):
+    """
+        Attributes of an agreement as loaded from the DB, where every record
+        brings its own copy of the keys.
+    """
+    prefix = "dss_gold.connections_load.DSS number of active player data"
+    return {"occi.agreement.state": "accepted",
+            "occi.agreement.effectiveFrom": "2014-11-02T02:20:26+00:00",
+            "occi.agreement.effectiveUntil": "2114-11-02T02:20:27+00:00",
+            "occi.agreement.agreedAt": "2014-11-02T02:20:26+00:%02d" % (
+                number % 60),
+            "connections_load.term.desc": "This is the SLO term for DSS.",
+            "connections_load.term.type": "SLO-TERM",
+            "connections_load.term.state": "fulfilled",
+            "connections_load.term.remedy": "0.10",
+            prefix: str(number),
+            prefix + ".limiter_type": "max"}
+
+
+def _footprint(attributes):
+    """
+        Returns the bytes held by an attribute container and its keys.
+    """
+    size = sys.getsizeof(attributes)
+    if isinstance(attributes, CompactAttributes):
+        return size + sys.getsizeof(attributes._values)
+    return size + sum(sys.getsizeof(key) for key in attributes)
+
+
+class TestCompactAttributes(unittest.TestCase):
+    """
+        Tests that the compact attributes behave like a dictionary.
+    """
+
+    def setUp(self):
+        self.plain = _agreement_attributes(1)
+        self.attrs = CompactAttributes(self.plain)
+
+    def test_behaves_like_a_dictionary(self):
+        self.assertEqual(self.attrs, self.plain)
+        self.assertEqual(len(self.attrs), len(self.plain))
+        self.assertEqual(set(self.attrs.keys()), set(self.plain.keys()))
+        self.assertEqual(dict(self.attrs.iteritems()), self.plain)
+        self.assertTrue("connections_load.term.state" in self.attrs)
+        self.assertEqual(self.attrs.get("unknown", "default"), "default")
+        self.assertRaises(KeyError, self.attrs.__getitem__, "unknown")
+
+    def test_set_and_delete_attributes(self):
+        self.attrs["connections_load.term.state"] = "violated"
+        self.attrs["occi.core.id"] = "/agreement/1"
+        del self.attrs["occi.agreement.agreedAt"]
+
+        self.plain["connections_load.term.state"] = "violated"
+        self.plain["occi.core.id"] = "/agreement/1"
+        del self.plain["occi.agreement.agreedAt"]
+
+        self.assertEqual(self.attrs, self.plain)
+        self.assertEqual(self.attrs.pop("occi.core.id"), "/agreement/1")
+        self.assertEqual(self.attrs.pop("occi.core.id", None), None)
+
+    def test_layout_shared_between_agreements(self):
+        first = CompactAttributes(_agreement_attributes(1))
+        second = CompactAttributes(_agreement_attributes(2))
+        self.assertTrue(first._layout is second._layout)
+
+        first["occi.core.id"] = "/agreement/1"
+        second["occi.core.id"] = "/agreement/2"
+        self.assertTrue(first._layout is second._layout)
+
+    def test_copies_are_independent(self):
+        duplicate = copy.deepcopy(self.attrs)
+        duplicate["connections_load.term.state"] = "violated"
+
+        self.assertEqual(self.attrs["connections_load.term.state"],
+                         "fulfilled")
+        self.assertTrue(duplicate._layout is self.attrs._layout)
+
+    def test_memory_per_agreement_drops(self):
+        plain = [_agreement_attributes(num) for num in range(100)]
+        compact = [CompactAttributes(attrs) for attrs in plain]
+
+        plain_size = sum(_footprint(attrs) for attrs in plain)
+        compact_size = sum(_footprint(attrs) for attrs in compact)
+
+        self.assertLess(compact_size * 5, plain_size)
+
+
+class TestAttributeCodec(unittest.TestCase):
+    """
+        Tests the translation of attributes to and from the database.
+    """
+
+    def setUp(self):
+        self.entities = MongoClient().sla.entities
+
+    def tearDown(self):
+        self.entities.remove({})
+
+    def test_round_trip(self):
+        attributes = _agreement_attributes(1)
+        stored = CODEC.encode(attributes)
+
+        self.assertTrue({"k": "occi.agreement.state", "v": "accepted"}
+                        in stored)
+        self.assertEqual(CODEC.decode(stored), attributes)
+
+    def test_decodes_unicode_and_legacy_keys(self):
+        stored = [{"k": u"the.test.attr", "v": u"1"}]
+        legacy = {u"the^test^attr": u"1"}
+
+        for attributes in (CODEC.decode(stored), CODEC.decode(legacy)):
+            self.assertEqual(attributes, {"the.test.attr": "1"})
+            self.assertTrue(type(attributes.keys()[0]) is str)
+            self.assertTrue(type(attributes.values()[0]) is str)
+
+    def test_metric_values_stored_with_native_types(self):
+        metric = "dss_gold.connections_load.DSS number of active player data"
+        attributes = {metric: "100",
+                      "gold.availability.uptime.limiter_value": "2",
+                      "gold.efficiency.power": 98,
+                      "availability.term.min_hold": "30",
+                      "occi.compute.uptime": "not a number",
+                      "occi.agreement.uptime": "98",
+                      "gold.availability.uptime.window": "98"}
+        stored = dict((pair["k"], pair["v"])
+                      for pair in CODEC.encode(attributes))
+
+        self.assertTrue(type(stored[metric]) is int)
+        self.assertEqual(stored[metric], 100)
+        self.assertEqual(stored["gold.availability.uptime.limiter_value"],
+                         2.0)
+        self.assertTrue(type(stored["gold.efficiency.power"]) is float)
+        self.assertEqual(stored["availability.term.min_hold"], 30.0)
+        self.assertEqual(stored["occi.compute.uptime"], "not a number")
+        # only thresholds are typed
+        self.assertEqual(stored["occi.agreement.uptime"], "98")
+        self.assertEqual(stored["gold.availability.uptime.window"], "98")
+
+        # and keep their original text
+        self.assertTrue({"k": "gold.efficiency.power", "v": 98.0, "t": "98"}
+                        in CODEC.encode(attributes))
+        decoded = CODEC.decode(CODEC.encode(attributes))
+        self.assertEqual(decoded, dict((key, str(value)) for key, value
+                                       in attributes.iteritems()))
+
+    def test_migration_of_legacy_records(self):
+        self.entities.insert({"_id": "/agreement/legacy",
+                              "attributes": {"the^test^attr": "1"}})
+        self.entities.insert({"_id": "/agreement/current",
+                              "attributes": [{"k": "attr", "v": "2"}]})
+
+        self.assertEqual(migrate_attributes(self.entities), 1)
+        self.assertEqual(migrate_attributes(self.entities), 0)
+
+        record = self.entities.find_one("/agreement/legacy")
+        self.assertEqual(record["attributes"],
+                         [{"k": "the.test.attr", "v": "1"}])
@@ -513,3 +513,34 @@ class TestAgreementBackend(unittest.TestCase):
         # TODO:  Add test to ensure that ^ is not used as a key name for attributes
         # as it is used later to substitute '.' inkeynames which is refused by
         # mongo.
+
+
+class TestTemplateMixins(unittest.TestCase):
+    """
+        Tests building the mixins of a template list.
+    """
+
+    @staticmethod
+    def _template_list(desc):
+        term = {"type": "SLO-TERM", "desc": desc,
+                "metrics": {"vcpu": {"value": 1}}}
+        return {"scheme": "http://sla.mixins.org/agreements#",
+                "templates": {"gold": {"terms": {"cpu": term, "ram": term}},
+                              "silver": {"terms": {"cpu": term}}}}
+
+    def test_shared_terms_have_one_mixin(self):
+        temps, terms = api.build_template_lst_mixins(
+            self._template_list("shared"))
+        self.assertEqual(sorted(mixin.term for mixin in temps),
+                         ["gold", "silver"])
+        self.assertEqual(sorted(mixin.term for mixin in terms),
+                         ["cpu", "ram"])
+
+        _, again = api.build_template_lst_mixins(
+            self._template_list("shared"))
+        self.assertTrue(dict((m.term, m) for m in again)["cpu"] is
+                        dict((m.term, m) for m in terms)["cpu"])
+        _, changed = api.build_template_lst_mixins(
+            self._template_list("changed"))
+        self.assertFalse(dict((m.term, m) for m in changed)["cpu"] is
+                         dict((m.term, m) for m in terms)["cpu"])
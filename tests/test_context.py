@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pymongo import MongoClient, ReadPreference
+from api import context, templates
+from api.context import AppContext, LazyDatabase, LazyMetrics, PoolStats, \
+    mongo_settings
+
+MONGO_CFG = """
+[mongo]
+max_pool_size = 10
+socket_timeout_ms = 1000
+
+[reads]
+history = secondaryPreferred
+
+[writes]
+agreement = majority:5000
+"""
+
+Event = collections.namedtuple("Event", "reason")
+
+# Imports the whole API and prints what the application context loaded.
+IMPORT_API = """
+import json, time
+started = time.time()
+from api import api, rulesengine, serving
+from api.context import current
+print json.dumps({"loaded": current().loaded(),
+                  "seconds": time.time() - started})
+"""
+
+
+class TestAppContext(unittest.TestCase):
+    """
+        Tests the lazily initialised application context.
+    """
+
+    def test_importing_the_api_loads_nothing(self):
+        output = subprocess.check_output([sys.executable, "-c", IMPORT_API])
+        imported = json.loads(output.splitlines()[-1])
+        self.assertEqual(imported["loaded"], [])
+        self.assertTrue(imported["seconds"] < 10)
+
+    def test_context_can_be_installed(self):
+        client = MongoClient()
+        previous = context.install(AppContext(
+            client=client, metrics={"Speed": {"value": "real"}},
+            rabbit={"host": "broker"}))
+        try:
+            self.assertTrue(LazyDatabase("policies").database.client
+                            is client)
+            self.assertEqual(list(LazyMetrics()), ["Speed"])
+            self.assertTrue("Speed" in templates.METRICS)
+            self.assertEqual(context.current().rabbit["host"], "broker")
+        finally:
+            context.install(previous)
+        self.assertFalse("Speed" in templates.METRICS)
+
+    def test_configuration_is_read_once_used(self):
+        app = AppContext(client=MongoClient())
+        self.assertEqual(app.loaded(), ["client"])
+        self.assertTrue("System uptime" in app.metrics)
+        self.assertTrue("host" in app.rabbit)
+        self.assertEqual(app.loaded(), ["client", "metrics", "rabbit"])
+        app.after_fork()
+        self.assertEqual(app.loaded(), ["metrics", "rabbit"])
+
+
+class TestMongoSettings(unittest.TestCase):
+    """
+        Tests configuring the shared MongoDB client.
+    """
+
+    def setUp(self):
+        handle, self.config_file = tempfile.mkstemp()
+        os.write(handle, MONGO_CFG)
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.config_file)
+
+    def test_settings_are_read(self):
+        settings = mongo_settings(self.config_file)
+        self.assertEqual(settings["client"]["maxPoolSize"], 10)
+        self.assertEqual(settings["client"]["socketTimeoutMS"], 1000)
+        self.assertEqual(settings["client"]["connectTimeoutMS"], 5000)
+
+        app = AppContext(client=MongoClient(), mongo_file=self.config_file)
+        self.assertEqual(app.options(reads="history"),
+                         {"read_preference":
+                          ReadPreference.SECONDARY_PREFERRED})
+        concern = app.options(writes="agreement")["write_concern"]
+        self.assertEqual(concern.document, {"w": "majority",
+                                            "wtimeout": 5000})
+        self.assertEqual(app.options(reads="listing", writes="term_state"),
+                         {})
+        self.assertTrue(app.collection("entities", writes="agreement") is
+                        app.collection("entities", writes="agreement"))
+
+    def test_unknown_read_preference_is_refused(self):
+        with open(self.config_file, "w") as config:
+            config.write(MONGO_CFG.replace("secondaryPreferred", "anywhere"))
+        self.assertRaises(AttributeError, mongo_settings, self.config_file)
+
+    def test_pool_saturation(self):
+        pool = PoolStats(max_pool_size=4)
+        for _ in range(3):
+            pool.connection_check_out_started(None)
+        pool.connection_checked_out(None)
+        pool.connection_checked_out(None)
+        pool.connection_check_out_failed(Event(context.TIMEOUT))
+        pool.connection_checked_in(None)
+
+        stats = pool.stats()
+        self.assertEqual((stats["in_use"], stats["peak_in_use"],
+                          stats["waiting"], stats["timeouts"]), (1, 2, 0, 1))
+        self.assertEqual(stats["saturation"], 0.25)
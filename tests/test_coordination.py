@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import unittest
+from pymongo import MongoClient
+from occi import core_model
+from api.coordination import ChangeLog, Lease, SequenceGaps
+from api.registry import PersistentReg
+
+
+class TestLease(unittest.TestCase):
+    """
+        Tests that a lease is only held by one holder at a time.
+    """
+
+    def setUp(self):
+        self.leases = MongoClient().sla.leases
+
+    def tearDown(self):
+        self.leases.remove({})
+
+    def test_single_holder(self):
+        first = Lease("test", holder="first", leases=self.leases)
+        second = Lease("test", holder="second", leases=self.leases)
+
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        # renewing by the holder
+        self.assertTrue(first.acquire())
+
+    def test_expired_and_released_leases_are_taken_over(self):
+        first = Lease("test", ttl=-1, holder="first", leases=self.leases)
+        second = Lease("test", holder="second", leases=self.leases)
+
+        self.assertTrue(first.acquire())
+        self.assertTrue(second.acquire())
+
+        second.release()
+        self.assertTrue(Lease("test", holder="third",
+                              leases=self.leases).acquire())
+
+
+class TestSequenceGaps(unittest.TestCase):
+    """
+        Tests keeping track of the sequence numbers not read yet.
+    """
+
+    def test_missing_numbers_are_looked_for_until_found(self):
+        gaps = SequenceGaps(wait=10)
+        self.assertEqual(gaps.query("seq", 3), {"seq": {"$gt": 3}})
+
+        self.assertEqual(gaps.update(3, set([5, 7]), now=100), 7)
+        self.assertEqual(gaps.missing(), [4, 6])
+        self.assertEqual(gaps.query("seq", 7),
+                         {"$or": [{"seq": {"$gt": 7}},
+                                  {"seq": {"$in": [4, 6]}}]})
+
+        self.assertEqual(gaps.update(7, set([4]), now=105), 7)
+        self.assertEqual(gaps.missing(), [6])
+        # never written
+        self.assertEqual(gaps.update(7, set(), now=111), 7)
+        self.assertEqual(len(gaps), 0)
+
+
+class TestChangeLog(unittest.TestCase):
+    """
+        Tests that the changes made through one registry reach another one
+        sharing the same database.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+
+    def tearDown(self):
+        self.db.entities.remove({})
+        self.db.entity_changes.remove({})
+        self.db.counters.remove({})
+
+    def test_pending_changes_of_others(self):
+        mine = ChangeLog(self.db)
+        theirs = ChangeLog(self.db)
+
+        mine.record("/agreement/a")
+        theirs.record("/agreement/b", deleted=True)
+
+        self.assertEqual(mine.pending(), [("/agreement/b", True)])
+        self.assertEqual(mine.pending(), [])
+
+    def test_change_recorded_after_a_later_one(self):
+        reader = ChangeLog(self.db)
+        # a writer takes its sequence number, and is slow to record it
+        self.db.counters.find_and_modify(
+            {"_id": "entity_changes"}, {"$inc": {"seq": 1}}, upsert=True)
+        ChangeLog(self.db).record("/agreement/b")
+
+        self.assertEqual(reader.pending(), [("/agreement/b", False)])
+
+        self.db.entity_changes.insert({"_id": "/agreement/a", "seq": 1,
+                                       "deleted": False})
+        self.assertEqual(reader.pending(), [("/agreement/a", False)])
+        self.assertEqual(reader.pending(), [])
+
+    def test_change_recorded_after_many_later_ones(self):
+        reader = ChangeLog(self.db)
+        self.db.counters.find_and_modify(
+            {"_id": "entity_changes"}, {"$inc": {"seq": 1}}, upsert=True)
+        keys = ["/agreement/{0}".format(number) for number in range(40)]
+        ChangeLog(self.db).record_many(keys)
+        self.assertEqual(len(reader.pending()), 40)
+        self.assertEqual(reader.pending(), [])
+
+        self.db.entity_changes.insert({"_id": "/agreement/slow", "seq": 1,
+                                       "deleted": False})
+        self.assertEqual(reader.pending(), [("/agreement/slow", False)])
+
+    def test_bulk_of_changes(self):
+        mine = ChangeLog(self.db)
+        theirs = ChangeLog(self.db)
+
+        self.assertEqual(mine.record_many(["/agreement/a", "/agreement/b"]),
+                         2)
+        self.assertEqual(mine.pending(), [])
+        self.assertEqual(dict(theirs.pending()), {"/agreement/a": False,
+                                                  "/agreement/b": False})
+
+    def test_sync_between_dictionaries(self):
+        writer = PersistentReg(ChangeLog(self.db)).resources
+        reader = PersistentReg(ChangeLog(self.db)).resources
+
+        agreement = core_model.Resource("/agreement/a", None, [])
+        agreement.customer = "lola"
+        agreement.attributes = {"occi.agreement.state": "pending"}
+        writer["/agreement/a"] = agreement
+        reader.sync()
+
+        self.assertEqual(reader["/agreement/a"].attributes,
+                         {"occi.agreement.state": "pending"})
+
+        agreement.attributes["occi.agreement.state"] = "accepted"
+        writer["/agreement/a"] = agreement
+        writer["/agreement/b"] = core_model.Resource("/agreement/b", None, [])
+        reader.sync()
+
+        self.assertEqual(
+            reader["/agreement/a"].attributes["occi.agreement.state"],
+            "accepted")
+        self.assertTrue("/agreement/b" in reader)
+
+        del writer["/agreement/a"]
+        reader.sync()
+
+        self.assertFalse("/agreement/a" in reader)
+        self.assertEqual(reader.customer_index, {})
@@ -19,8 +19,10 @@ import json
 import requests
 import sample_data.server
 import logging
+import threading
 import tests.sample_data.the_test_data as test_data
 from api.entity_dictionary import EntityDictionary
+from api.registry import PersistentReg
 from api import api
 from pymongo import errors
 from pymongo import MongoClient
@@ -173,9 +175,10 @@ class AddingToDictionary(unittest.TestCase):
         resources = EntityDictionary(None)
         resources[res_id] = res
         persisted_res = self.db.entities.find_one(res_id)
-        pstd_res_attrs = persisted_res["attributes"]
+        pstd_res_attrs = dict((pair["k"], pair["v"])
+                              for pair in persisted_res["attributes"])
 
-        self.assertEqual(pstd_res_attrs["the^test^attr"],
+        self.assertEqual(pstd_res_attrs["the.test.attr"],
                          res_attr["the.test.attr"])
         self.assertEqual(pstd_res_attrs["attr-2"], res_attr["attr-2"])
         self.assertEqual(pstd_res_attrs["attr_3"], res_attr["attr_3"])
@@ -231,6 +234,417 @@ class TestResourceGeneral(unittest.TestCase):
         self.assertEqual(s1, s2)
 
 
+class IndexingDictionary(unittest.TestCase):
+    """
+        Tests that the provider, customer and kind indexes follow the
+        dictionary content.
+    """
+
+    def setUp(self):
+        self.db = self._get_db_connection()
+
+    def tearDown(self):
+        self.db.entities.remove({})
+
+    def _get_db_connection(self):
+        db_client = MongoClient()
+        db = db_client.sla
+        return db
+
+    def _resource(self, res_id, provider, customer, kind=occi_sla.AGREEMENT):
+        res = core_model.Resource(res_id, kind, [])
+        res.provider = provider
+        res.customer = customer
+        return res
+
+    def test_keys_for_provider_customer_and_kind(self):
+        resources = EntityDictionary(None)
+        resources["/agreement/a"] = self._resource("/agreement/a", "DSS", "lola")
+        resources["/agreement/b"] = self._resource("/agreement/b", "DSS", "larry")
+        resources["/agreement/c"] = self._resource("/agreement/c", "RAN", "lola")
+        resources["/other/d"] = self._resource("/other/d", "DSS", "lola",
+                                               kind=None)
+
+        self.assertEqual(set(resources.keys_for(provider="DSS")),
+                         {"/agreement/a", "/agreement/b", "/other/d"})
+        self.assertEqual(set(resources.keys_for(customer="lola")),
+                         {"/agreement/a", "/agreement/c", "/other/d"})
+        self.assertEqual(set(resources.keys_for(provider="DSS",
+                                                kind=occi_sla.AGREEMENT)),
+                         {"/agreement/a", "/agreement/b"})
+        self.assertEqual(resources.keys_for(provider="IMS"), [])
+
+    def test_indexes_follow_overwrite_and_delete(self):
+        resources = EntityDictionary(None)
+        resources["/agreement/a"] = self._resource("/agreement/a", "DSS", "lola")
+        resources["/agreement/a"] = self._resource("/agreement/a", "RAN", "lola")
+        resources["/agreement/b"] = self._resource("/agreement/b", "RAN", "lola")
+
+        self.assertEqual(resources.keys_for(provider="DSS"), [])
+
+        del resources["/agreement/a"]
+        resources.pop("/agreement/b")
+
+        self.assertEqual(resources.keys_for(provider="RAN"), [])
+        self.assertEqual(resources.provider_index, {})
+        self.assertEqual(resources.customer_index, {})
+        self.assertEqual(resources.kind_index, {})
+
+    def test_agreement_links_are_in_the_graph(self):
+        resources = EntityDictionary(None)
+        for key in ("/agreement/a", "/agreement/b"):
+            resources[key] = self._resource(key, "DSS", "lola")
+        compute = self._resource("/compute/1", "DSS", "lola", kind=None)
+        resources["/compute/1"] = compute
+        federation = core_model.Link("/agreement_link/1",
+                                     occi_sla.AGREEMENT_LINK, [],
+                                     resources["/agreement/a"],
+                                     "/agreement/b")
+        device = core_model.Link("/agreement_link/2", occi_sla.AGREEMENT_LINK,
+                                 [], resources["/agreement/a"], compute)
+        resources["/agreement_link/1"] = federation
+        resources["/agreement_link/2"] = device
+
+        self.assertEqual(resources.graph.linked("/agreement/a"),
+                         {"/agreement/b"})
+        self.assertEqual(resources.graph.dependents("/agreement/b"),
+                         {"/agreement/a"})
+
+        del resources["/agreement_link/1"]
+        self.assertEqual(resources.graph.linked("/agreement/a"), set())
+        self.assertEqual(len(resources.graph), 0)
+
+    def test_link_stored_before_its_agreement_is_in_the_graph(self):
+        resources = EntityDictionary(None)
+        resources["/agreement/a"] = self._resource("/agreement/a", "DSS",
+                                                   "lola")
+        for key, target in (("/agreement_link/1", "/agreement/b"),
+                            ("/agreement_link/2", "/agreement/c")):
+            resources[key] = core_model.Link(key, occi_sla.AGREEMENT_LINK,
+                                             [], resources["/agreement/a"],
+                                             target)
+        self.assertEqual(len(resources.graph), 0)
+        del resources["/agreement_link/2"]
+
+        for key in ("/agreement/b", "/agreement/c"):
+            resources[key] = self._resource(key, "DSS", "lola")
+
+        self.assertEqual(resources.graph.linked("/agreement/a"),
+                         {"/agreement/b"})
+        self.assertEqual(len(resources.graph), 1)
+
+    def test_registry_scopes_resources_to_provider(self):
+        registry = PersistentReg()
+        registry.resources["/agreement/a"] = \
+            self._resource("/agreement/a", "DSS", "lola")
+        registry.resources["/agreement/b"] = \
+            self._resource("/agreement/b", "RAN", "lola")
+        dss = {"security": {"DSS": "dss_pass"}, "customer": "lola"}
+
+        listed = registry.get_resources(dss)
+
+        self.assertEqual([res.identifier for res in listed], ["/agreement/a"])
+        self.assertEqual(len(registry.get_resources({"security": {None: None}})),
+                         2)
+        self.assertRaises(AttributeError, registry.get_resource,
+                          "/agreement/b", dss)
+        self.assertRaises(KeyError, registry.get_resource, "/agreement/c", dss)
+
+    def test_registry_scopes_resource_keys_alike(self):
+        registry = PersistentReg()
+        registry.resources["/agreement/a"] = \
+            self._resource("/agreement/a", "DSS", "lola")
+        registry.resources["/agreement/b"] = \
+            self._resource("/agreement/b", "RAN", "lola")
+        registry.resources["/agreement/c"] = \
+            self._resource("/agreement/c", None, "lola")
+        dss = {"security": {"DSS": "dss_pass"}, "customer": "lola"}
+
+        self.assertEqual(registry.get_resource_keys(dss), ["/agreement/a"])
+        self.assertEqual([res.identifier
+                          for res in registry.get_resources(dss)],
+                         ["/agreement/a"])
+        self.assertRaises(AttributeError, registry.get_resource,
+                          "/agreement/c", dss)
+        self.assertEqual(
+            len(registry.get_resource_keys({"security": {None: None}})), 3)
+
+
+class SerialisingEntities(unittest.TestCase):
+    """
+        Tests that entities are saved without copying their object graph.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+
+    def tearDown(self):
+        self.db.entities.remove({})
+
+    def _linked_agreement(self, num_links):
+        agreement = core_model.Resource("/agreement/graph", occi_sla.AGREEMENT,
+                                        [])
+        agreement.attributes = {"occi.agreement.state": "accepted"}
+        for num in range(num_links):
+            device = core_model.Resource("/device/%d" % num, None, [])
+            # Locks cannot be copied, so any deepcopy of the graph fails.
+            device.monitor = threading.Lock()
+            link = core_model.Link("/agreement_link/%d" % num,
+                                   occi_sla.AGREEMENT_LINK, [], agreement,
+                                   device)
+            agreement.links.append(link)
+        return agreement
+
+    def test_resource_document_is_built_without_copying_links(self):
+        agreement = self._linked_agreement(50)
+        resources = EntityDictionary(None)
+
+        resources["/agreement/graph"] = agreement
+        for link in agreement.links:
+            resources[link.identifier] = link
+
+        record = self.db.entities.find_one("/agreement/graph")
+        self.assertEqual(record["links"],
+                         ["/agreement_link/%d" % num for num in range(50)])
+        self.assertEqual(record["kind"], occi_sla.AGREEMENT.location)
+        self.assertEqual(record["attributes"],
+                         [{"k": "occi.agreement.state", "v": "accepted"}])
+
+        link_record = self.db.entities.find_one("/agreement_link/7")
+        self.assertEqual(link_record["source"], "/agreement/graph")
+        self.assertEqual(link_record["target"], "/device/7")
+
+    def test_persisting_leaves_entity_untouched(self):
+        agreement = self._linked_agreement(2)
+        links = list(agreement.links)
+
+        EntityDictionary._resource_document("/agreement/graph", agreement)
+
+        self.assertEqual(agreement.links, links)
+        self.assertEqual(agreement.kind, occi_sla.AGREEMENT)
+        self.assertEqual(agreement.attributes,
+                         {"occi.agreement.state": "accepted"})
+
+
+class VersioningEntities(unittest.TestCase):
+    """
+        Tests that concurrent changes to an entity are not lost.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.resources = PersistentReg().resources
+        agreement = core_model.Resource("/agreement/a", occi_sla.AGREEMENT, [])
+        agreement.attributes = {"counter": "0"}
+        self.resources["/agreement/a"] = agreement
+
+    def tearDown(self):
+        self.db.entities.remove({})
+
+    def test_version_is_incremented_on_save(self):
+        self.assertEqual(self.resources.version("/agreement/a"), 1)
+        self.resources["/agreement/a"] = self.resources["/agreement/a"]
+        self.assertEqual(self.resources.version("/agreement/a"), 2)
+        self.assertEqual(self.db.entities.find_one("/agreement/a")["version"],
+                         2)
+        self.assertFalse("version" in self.resources["/agreement/a"].__dict__)
+
+    def test_compare_and_set_rejects_stale_version(self):
+        agreement = self.resources["/agreement/a"]
+        # someone else saves the agreement in the meantime
+        self.db.entities.update({"_id": "/agreement/a"},
+                                {"$inc": {"version": 1}})
+
+        self.assertFalse(self.resources.compare_and_set("/agreement/a",
+                                                        agreement, 1))
+        self.assertTrue(self.resources.compare_and_set("/agreement/a",
+                                                       agreement, 2))
+        self.assertEqual(self.resources.version("/agreement/a"), 3)
+
+    def test_modify_retries_on_latest_version(self):
+        self.db.entities.update(
+            {"_id": "/agreement/a"},
+            {"$set": {"attributes": [{"k": "counter", "v": "0"},
+                                     {"k": "other", "v": "x"}]},
+             "$inc": {"version": 1}})
+
+        self.resources.modify("/agreement/a", lambda res:
+                              res.attributes.__setitem__("counter", "1"))
+
+        self.assertEqual(dict(self.resources["/agreement/a"].attributes),
+                         {"counter": "1", "other": "x"})
+        self.assertEqual(self.resources.version("/agreement/a"), 3)
+
+    def test_failed_modification_is_not_seen(self):
+        agreement = self.resources["/agreement/a"]
+        seen = []
+
+        def increment(res):
+            seen.append(dict(agreement.attributes))
+            res.attributes["counter"] = str(int(res.attributes["counter"]) + 1)
+            # someone else saves the agreement in the meantime, once
+            if len(seen) == 1:
+                self.db.entities.update({"_id": "/agreement/a"},
+                                        {"$inc": {"version": 1}})
+
+        self.resources.modify("/agreement/a", increment)
+
+        self.assertEqual(agreement.attributes["counter"], "0")
+        self.assertEqual(seen[0], {"counter": "0"})
+        self.assertEqual(self.resources["/agreement/a"].attributes["counter"],
+                         "1")
+
+    def test_concurrent_modifications_are_not_lost(self):
+        def increment(res):
+            res.attributes["counter"] = str(int(res.attributes["counter"]) + 1)
+
+        def worker():
+            for _ in range(10):
+                self.resources.modify("/agreement/a", increment)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.resources["/agreement/a"].attributes["counter"],
+                         "40")
+        self.assertEqual(self.resources.version("/agreement/a"), 41)
+
+
+class UpdatingAttributes(unittest.TestCase):
+    """
+        Tests that single attributes are updated without rewriting entities.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.resources = PersistentReg().resources
+        for key in ("/agreement/a", "/agreement/b"):
+            agreement = core_model.Resource(key, occi_sla.AGREEMENT, [])
+            agreement.attributes = {"gold.availability.term.state": "undefined"}
+            self.resources[key] = agreement
+
+    def tearDown(self):
+        self.db.entities.remove({})
+
+    def _attributes(self, key):
+        record = self.db.entities.find_one(key)
+        return dict((attr["k"], attr["v"]) for attr in record["attributes"])
+
+    def test_only_the_attribute_is_written(self):
+        # a field the in-memory entity doesn't know about survives the update
+        self.db.entities.update({"_id": "/agreement/a"},
+                                {"$set": {"marker": True}})
+
+        self.resources.set_attribute("/agreement/a",
+                                     "gold.availability.term.state",
+                                     "fulfilled")
+
+        record = self.db.entities.find_one("/agreement/a")
+        self.assertTrue(record["marker"])
+        self.assertEqual(record["version"], 2)
+        self.assertEqual(self._attributes("/agreement/a"),
+                         {"gold.availability.term.state": "fulfilled"})
+        self.assertEqual(self.resources["/agreement/a"].attributes,
+                         {"gold.availability.term.state": "fulfilled"})
+        self.assertEqual(self.resources.version("/agreement/a"), 2)
+
+    def test_repeated_attribute_takes_last_value(self):
+        self.resources.set_attributes([
+            ("/agreement/a", "gold.latency.term.state", "fulfilled"),
+            ("/agreement/a", "gold.latency.term.state", "violated"),
+            ("/agreement/a", "gold.availability.term.state", "violated"),
+            ("/agreement/a", "gold.availability.term.state", "fulfilled")])
+
+        self.assertEqual(self._attributes("/agreement/a"),
+                         {"gold.availability.term.state": "fulfilled",
+                          "gold.latency.term.state": "violated"})
+        self.assertEqual(self.db.entities.find_one("/agreement/a")["version"],
+                         3)
+
+    def test_updates_across_entities_in_one_batch(self):
+        self.resources.set_attributes([
+            ("/agreement/a", "gold.availability.term.state", "violated"),
+            ("/agreement/b", "gold.availability.term.state", "fulfilled"),
+            ("/agreement/b", "gold.latency.term.state", "fulfilled"),
+            ("/agreement/gone", "gold.availability.term.state", "fulfilled")])
+
+        self.assertEqual(self._attributes("/agreement/a"),
+                         {"gold.availability.term.state": "violated"})
+        self.assertEqual(self._attributes("/agreement/b"),
+                         {"gold.availability.term.state": "fulfilled",
+                          "gold.latency.term.state": "fulfilled"})
+        self.assertEqual(self.resources.version("/agreement/b"), 3)
+        self.assertEqual(self.db.entities.find_one("/agreement/b")["version"],
+                         3)
+        self.assertFalse("/agreement/gone" in self.resources)
+
+    def test_legacy_record_is_migrated(self):
+        self.db.entities.update({"_id": "/agreement/a"},
+                                {"$set": {"attributes": {
+                                    "gold^availability^term^state":
+                                        "undefined"}}})
+        self.resources.reload("/agreement/a")
+
+        self.resources.set_attributes([
+            ("/agreement/a", "gold.availability.term.state", "violated"),
+            ("/agreement/a", "gold.latency.term.state", "fulfilled")])
+
+        self.assertEqual(self._attributes("/agreement/a"),
+                         {"gold.availability.term.state": "violated",
+                          "gold.latency.term.state": "fulfilled"})
+        self.assertEqual(self.db.entities.find_one("/agreement/a")["version"],
+                         2)
+        self.assertEqual(self.resources.version("/agreement/a"), 2)
+        self.assertEqual(self.resources["/agreement/a"].attributes[
+            "gold.latency.term.state"], "fulfilled")
+
+    def test_unmatched_update_reloads_the_entity(self):
+        # another process removed the attribute since it was read
+        self.db.entities.update({"_id": "/agreement/a"},
+                                {"$set": {"attributes": []},
+                                 "$inc": {"version": 1}})
+
+        self.resources.set_attributes([
+            ("/agreement/a", "gold.availability.term.state", "violated"),
+            ("/agreement/b", "gold.availability.term.state", "violated")])
+
+        self.assertEqual(self._attributes("/agreement/a"), {})
+        self.assertEqual(self.resources["/agreement/a"].attributes, {})
+        self.assertEqual(self.resources.version("/agreement/a"), 2)
+        self.assertEqual(self._attributes("/agreement/b"),
+                         {"gold.availability.term.state": "violated"})
+        self.assertEqual(self.resources["/agreement/b"].attributes,
+                         {"gold.availability.term.state": "violated"})
+        self.assertEqual(self.resources.version("/agreement/b"), 2)
+
+
+    def test_links_are_attached_atomically(self):
+        # a field the in-memory entity doesn't know about survives
+        self.db.entities.update({"_id": "/agreement/a"},
+                                {"$set": {"marker": True}})
+
+        self.resources.attach_links({"/agreement/a": ["/agreement_link/1",
+                                                      "/agreement_link/2"],
+                                     "/agreement/b": ["/agreement_link/3"]})
+        self.resources.attach_links({"/agreement/a": ["/agreement_link/2"]})
+
+        record = self.db.entities.find_one("/agreement/a")
+        self.assertTrue(record["marker"])
+        self.assertEqual(record["links"], ["/agreement_link/1",
+                                           "/agreement_link/2"])
+        self.assertEqual(record["version"], 3)
+        self.assertEqual(self.resources.version("/agreement/a"), 3)
+
+        self.resources.detach_links({"/agreement/a": ["/agreement_link/1"]})
+        self.assertEqual(self.db.entities.find_one("/agreement/a")["links"],
+                         ["/agreement_link/2"])
+        self.assertEqual(self.db.entities.find_one("/agreement/b")["links"],
+                         ["/agreement_link/3"])
+
+
 class TestResourceFunctionality(unittest.TestCase):
     """
         Ensure that the resource dictionary behaves transparently.
@@ -553,6 +967,19 @@ class PopulatingDictionaryFromDB(unittest.TestCase):
 
         self.assertEqual(resources[res_id].attributes, res_attrs)
 
+    def test_populate_dictionary_with_legacy_attributes(self):
+        res_id = "/agreement/load_resource_w_legacy_attributes"
+        resources = EntityDictionary(self.api.registry)
+        record = resources._resource_document(
+            res_id, core_model.Resource(res_id, None, None))
+        record["attributes"] = {"the^test^attr": u"1", "attr-2": u"2"}
+        self.db.entities.insert(record)
+
+        resources.populate_from_db()
+
+        self.assertEqual(resources[res_id].attributes,
+                         {"the.test.attr": "1", "attr-2": "2"})
+
 
     def test_populate_dictionary_with_resource_containing_links(self):
         # Test entities - creating a resource with two links
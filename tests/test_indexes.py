@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import collections
+import unittest
+from pymongo import MongoClient
+from api import indexes
+from api import term_events
+from api.context import SlowQueries
+
+Event = collections.namedtuple("Event", "command_name command request_id "
+                                        "duration_micros")
+
+
+class RecordingDatabase(object):
+    """
+        Database recording the collections created explicitly.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.created = []
+
+    def create_collection(self, name, **options):
+        self.created.append((name, options))
+        return self.db.create_collection(name, **options)
+
+    def __getitem__(self, name):
+        return self.db[name]
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class TestIndexes(unittest.TestCase):
+    """
+        Tests provisioning the indexes of the hot queries.
+    """
+
+    def test_indexes_are_created_once(self):
+        db = MongoClient().sla
+        ensured = indexes.ensure_indexes(db)
+        self.assertTrue(("policies", "devices_1") in ensured)
+        self.assertTrue(("providers", "username_1_password_1") in ensured)
+        self.assertEqual(indexes.ensure_indexes(db), ensured)
+
+    def test_term_events_is_capped_before_indexed(self):
+        db = RecordingDatabase(MongoClient().sla_indexes)
+        try:
+            indexes.ensure_indexes(db)
+        finally:
+            MongoClient().drop_database("sla_indexes")
+        self.assertEqual(db.created[0],
+                         ("term_events", {"capped": True,
+                                          "size": term_events.CAPACITY}))
+
+    def test_collection_scans_are_found(self):
+        winning = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}
+        self.assertFalse(indexes.scans(winning))
+        self.assertTrue(indexes.scans({"stage": "SORT", "inputStage":
+                                       {"stage": "COLLSCAN"}}))
+        self.assertTrue(indexes.scans({"stage": "OR", "inputStages":
+                                       [winning, {"stage": "COLLSCAN"}]}))
+
+    def test_slow_queries_are_counted(self):
+        slow_queries = SlowQueries(slow_ms=50)
+        for request_id, micros in ((1, 2000), (2, 80000)):
+            slow_queries.started(Event("find", {"find": "policies",
+                                                "filter": {"devices": "a"}},
+                                       request_id, None))
+            slow_queries.succeeded(Event("find", None, request_id, micros))
+        self.assertEqual(slow_queries.slow, 1)
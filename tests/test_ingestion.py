@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import socket
+import threading
+import unittest
+import urllib2
+from StringIO import StringIO
+from pymongo import MongoClient
+from api import ingestion, serving
+from api.ingestion import MetricIngestor, SampleQueue, parse_samples
+
+POLICY = {"_id": "ingested-policy", "agreement_id": "/agreement/ingested",
+          "provider": "prov_123", "devices": ["/compute/a", "/compute/b"],
+          "terms": {}}
+
+BATCH = '{"device": "/compute/a", "metric": "System uptime", "value": 99}\n' \
+        '\n' \
+        '{"device": "/compute/b", "metric": "System uptime", "value": 12.5}\n'
+
+
+class TestParsingSamples(unittest.TestCase):
+    """
+        Tests parsing newline-delimited JSON samples.
+    """
+
+    def test_samples_are_parsed(self):
+        self.assertEqual(parse_samples(BATCH),
+                         [("/compute/a", "System uptime", 99),
+                          ("/compute/b", "System uptime", 12.5)])
+
+    def test_bad_lines_are_reported(self):
+        self.assertRaises(ValueError, parse_samples,
+                          BATCH + '{"device": "/compute/c"}')
+        self.assertRaises(ValueError, parse_samples, "not json")
+        self.assertRaises(ValueError, parse_samples,
+                          '{"device": "/compute/a", "metric": "nope", '
+                          '"value": 1}')
+
+
+class TestIngestor(unittest.TestCase):
+    """
+        Tests queueing samples for the Aggregator.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.db.providers.insert({"username": "prov_123", "password": "pass"})
+        self.db.policies.insert(dict(POLICY))
+        self.release = threading.Event()
+        self.notified = []
+        self.ingestor = MetricIngestor(self._notify, capacity=3)
+
+    def tearDown(self):
+        self.release.set()
+        self.db.providers.remove({"username": "prov_123"})
+        self.db.policies.remove({"_id": POLICY["_id"]})
+
+    def _notify(self, device_id, metric, value):
+        self.release.wait(5)
+        self.notified.append((device_id, metric, value))
+        if value == "bad":
+            raise AttributeError("no policy")
+
+    def _post(self, body, password="pass", provider="prov_123"):
+        environ = {"REQUEST_METHOD": "POST",
+                   "PATH_INFO": ingestion.PATH,
+                   "HTTP_PROVIDER": provider,
+                   "HTTP_PROVIDER_PASS": password,
+                   "CONTENT_LENGTH": str(len(body)),
+                   "wsgi.input": StringIO(body)}
+        started = []
+        body = ingestion.serve(environ, lambda status, headers:
+                               started.append((status, dict(headers))),
+                               self.ingestor)
+        return started[0][0], started[0][1], "".join(body)
+
+    def test_samples_reach_the_aggregator(self):
+        self.release.set()
+        self.ingestor.submit([("/compute/a", "m", "bad"),
+                              ("/compute/a", "m", 1)])
+        self.ingestor.samples.join()
+
+        # the failing sample does not stop the worker
+        self.assertEqual(self.notified, [("/compute/a", "m", "bad"),
+                                         ("/compute/a", "m", 1)])
+
+    def test_full_queue_refuses_whole_batches(self):
+        status, _, body = self._post(BATCH)
+        self.assertTrue(status.startswith("202"))
+        self.assertEqual(json.loads(body), {"accepted": 2})
+
+        # the first batch is still queued or being evaluated: no room for two
+        status, headers, _ = self._post(BATCH)
+        self.assertTrue(status.startswith("503"))
+        self.assertEqual(headers["Retry-After"], str(ingestion.RETRY_AFTER))
+
+        self.release.set()
+        self.ingestor.samples.join()
+        self.assertEqual(len(self.notified), 2)
+
+    def test_bad_requests_are_refused(self):
+        self.assertTrue(self._post("{")[0].startswith("400"))
+        self.assertTrue(self._post(BATCH, "wrong")[0].startswith("403"))
+        self.assertEqual(self.ingestor.samples.qsize(), 0)
+
+    def test_samples_of_other_devices_are_refused(self):
+        self.db.providers.insert({"username": "prov_456", "password": "pass"})
+        try:
+            status, _, body = self._post(
+                BATCH + '{"device": "/compute/c", "metric": "System uptime", '
+                        '"value": 1}')
+            self.assertTrue(status.startswith("403"))
+            self.assertTrue("/compute/c" in body)
+            # the devices are covered by agreements of prov_123 only
+            status, _, _ = self._post(BATCH, provider="prov_456")
+            self.assertTrue(status.startswith("403"))
+        finally:
+            self.db.providers.remove({"username": "prov_456"})
+        self.assertEqual(self.ingestor.samples.qsize(), 0)
+
+
+class TestWorkerIngestion(unittest.TestCase):
+    """
+        Tests that the samples accepted by a pre-forked worker reach the
+        process running the Rules Engine.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.db.providers.insert({"username": "prov_123", "password": "pass"})
+        self.db.policies.insert(dict(POLICY))
+        self.local = ingestion.INGESTOR
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.server = serving.worker_server(self.listener)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.listener.close()
+        ingestion.INGESTOR = self.local
+        self.db.providers.remove({"username": "prov_123"})
+        self.db.policies.remove({"_id": POLICY["_id"]})
+        self.db.metric_samples.remove({})
+
+    def test_samples_are_queued_for_the_rules_engine(self):
+        request = urllib2.Request(
+            "http://127.0.0.1:{0}{1}".format(self.listener.getsockname()[1],
+                                             ingestion.PATH),
+            BATCH, {"Provider": "prov_123", "Provider_pass": "pass"})
+        reply = urllib2.urlopen(request)
+
+        self.assertEqual(reply.getcode(), 202)
+        # nothing is evaluated in the worker
+        self.assertEqual(self.local.samples.qsize(), 0)
+        self.assertEqual(self.db.metric_samples.count(), 2)
+
+        notified = []
+        engine = MetricIngestor(lambda *sample: notified.append(sample))
+        self.assertEqual(SampleQueue().drain(engine), 2)
+        engine.samples.join()
+
+        self.assertEqual(notified, [("/compute/a", "System uptime", 99),
+                                    ("/compute/b", "System uptime", 12.5)])
+        self.assertEqual(self.db.metric_samples.count(), 0)
+
+    def test_full_shared_queue_refuses_samples(self):
+        queue = SampleQueue(self.db.metric_samples, capacity=3)
+        self.assertTrue(queue.submit(parse_samples(BATCH)))
+        self.assertFalse(queue.submit(parse_samples(BATCH)))
+
+        # an engine with no room leaves them queued
+        engine = MetricIngestor(lambda *sample: None, capacity=1)
+        self.assertEqual(queue.drain(engine), 0)
+        self.assertEqual(self.db.metric_samples.count(), 2)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import unittest
+from api.metric_cache import CACHE, MetricCache, SampleRing
+
+
+class TestSampleRing(unittest.TestCase):
+    """
+        Tests the ring buffer of samples.
+    """
+
+    def test_oldest_samples_are_overwritten(self):
+        ring = SampleRing(3)
+        self.assertEqual(ring.latest(), None)
+        for when in range(5):
+            ring.add(when, when * 10.0)
+
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.latest(), (4.0, 40.0))
+        self.assertEqual(ring.samples(), [(2.0, 20.0), (3.0, 30.0),
+                                          (4.0, 40.0)])
+        self.assertEqual(ring.footprint(), 48)
+
+
+class TestMetricCache(unittest.TestCase):
+    """
+        Tests serving recent samples from the cache.
+    """
+
+    def test_fresh_samples_are_served(self):
+        cache = MetricCache(history=4, max_age=30)
+        cache.record("/compute/a", "System uptime", 99.5, now=1000)
+        cache.record("/compute/a", "OS", "LINUX", now=1000)
+
+        self.assertEqual(cache.latest("/compute/a", "System uptime",
+                                      now=1010), 99.5)
+        self.assertEqual(cache.latest("/compute/a", "OS", now=1010), "LINUX")
+        # stale, or never sampled
+        self.assertEqual(cache.latest("/compute/a", "System uptime",
+                                      now=1031), None)
+        self.assertEqual(cache.latest("/compute/b", "OS", now=1010), None)
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+        self.assertEqual(stats["hit_rate"], 0.5)
+        self.assertEqual(stats["metrics"], 2)
+        self.assertEqual(stats["bytes"], 64)
+
+
+    def test_sample_type_is_kept(self):
+        cache = MetricCache()
+        cache.record("/compute/a", "Memory", 2048, now=1000)
+        cache.record("/compute/a", "Load", 0.5, now=1000)
+        cache.record("/compute/a", "Up", True, now=1000)
+
+        memory = cache.latest("/compute/a", "Memory", now=1000)
+        self.assertEqual((memory, type(memory)), (2048, int))
+        self.assertEqual(cache.history("/compute/a", "Memory"),
+                         [(1000.0, 2048)])
+        self.assertIs(cache.latest("/compute/a", "Up", now=1000), True)
+
+        # a float sample of the metric starts over its history
+        cache.record("/compute/a", "Memory", 2048.5, now=1001)
+        self.assertEqual(cache.history("/compute/a", "Memory"),
+                         [(1001.0, 2048.5)])
+
+    def test_notified_values_are_cached(self):
+        from api.aggregator import Aggregator
+        try:
+            Aggregator().notification_events("/compute/cached",
+                                             {"System uptime": 97})
+        except AttributeError:
+            pass  # no policy for the device
+        uptime = CACHE.latest("/compute/cached", "System uptime")
+        self.assertEqual((uptime, type(uptime)), (97, int))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import unittest
+from pymongo import MongoClient
+from occi import core_model
+from api import occi_violation
+from api.registry import PersistentReg
+from api.rulesengine import RulesEngine
+from api.rulesenginehelper import OPEN_VIOLATIONS, RulesEngineHelper
+
+TERMS = {"efficiency": {"remedy": "0.10", "metrics": {
+    "System uptime": {"limiter_type": "min", "value": 98.0,
+                      "exit_value": 99.0}}}}
+
+
+class TestHysteresis(unittest.TestCase):
+    """
+        Tests leaving a violation only past the exit values.
+    """
+
+    def _helper(self, value):
+        return RulesEngineHelper("/agreement/h", TERMS,
+                                 {"System uptime": value}, "/compute/a")
+
+    def test_exit_value_is_used_when_exiting(self):
+        helper = self._helper(98.5)
+        self.assertFalse(helper.agreement_term_violated("/agreement/h",
+                                                        "efficiency"))
+        # not yet back past the exit value: still violated
+        self.assertTrue(helper.agreement_term_violated(
+            "/agreement/h", "efficiency", exiting=True))
+        self.assertFalse(self._helper(99.5).agreement_term_violated(
+            "/agreement/h", "efficiency", exiting=True))
+
+    def test_exit_margin(self):
+        terms = {"efficiency": {"remedy": "0.10", "metrics": {
+            "System uptime": {"limiter_type": "margin", "value": 100.0,
+                              "limiter_value": 10.0, "exit_value": 5.0}}}}
+        helper = RulesEngineHelper("/agreement/h", terms,
+                                   {"System uptime": 93.0}, "/compute/a")
+        self.assertFalse(helper.agreement_term_violated("/agreement/h",
+                                                        "efficiency"))
+        self.assertTrue(helper.agreement_term_violated(
+            "/agreement/h", "efficiency", exiting=True))
+
+
+class TestOpenViolations(unittest.TestCase):
+    """
+        Tests coalescing repeated violations into the open one.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.registry = RulesEngine._registry
+        RulesEngine._registry = PersistentReg()
+        self.violation = core_model.Resource("/violation/v",
+                                             occi_violation.VIOLATION, [])
+        self.violation.attributes = {"occi.violation.metrics": "{}"}
+        RulesEngine._registry.resources["/violation/v"] = self.violation
+        self.key = ("/agreement/h", "efficiency", "/compute/a")
+
+    def tearDown(self):
+        OPEN_VIOLATIONS.close(self.key)
+        RulesEngine._registry = self.registry
+        self.db.entities.remove({})
+
+    def test_repeated_violation_updates_the_open_one(self):
+        self.assertTrue(OPEN_VIOLATIONS.open(self.key))
+        self.assertFalse(OPEN_VIOLATIONS.open(self.key))
+        OPEN_VIOLATIONS.attach(self.key, self.violation)
+
+        helper = RulesEngineHelper("/agreement/h", TERMS,
+                                   {"System uptime": 90.0}, "/compute/a")
+        self.assertTrue(helper.agreement_term_violated("/agreement/h",
+                                                       "efficiency"))
+        helper.agreement_term_apply_remedy("/agreement/h", "efficiency")
+
+        self.assertEqual(json.loads(self.violation.attributes[
+            "occi.violation.metrics"]), {"System uptime": 90.0})
+        self.assertEqual(
+            [key for key in RulesEngine._registry.resources.keys()
+             if key.startswith("/violation")], ["/violation/v"])
+
+    def test_closed_violation_can_be_opened_again(self):
+        self.assertTrue(OPEN_VIOLATIONS.open(self.key))
+        OPEN_VIOLATIONS.close(self.key)
+        self.assertTrue(OPEN_VIOLATIONS.open(self.key))
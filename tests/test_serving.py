@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import unittest
+from api import serving
+
+
+class RecordingHandler(logging.Handler):
+    """
+        Keeps the messages logged.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestStatsLog(unittest.TestCase):
+    """
+        Tests logging the statistics of a process.
+    """
+
+    def setUp(self):
+        self.handler = RecordingHandler()
+        serving.LOG.addHandler(self.handler)
+
+    def tearDown(self):
+        serving.LOG.removeHandler(self.handler)
+
+    def test_pool_saturation_is_logged(self):
+        serving.log_stats()
+        pool = [message for message in self.handler.messages
+                if message.startswith("pool of ")]
+        self.assertEqual(len(pool), 1)
+        self.assertTrue("saturation=" in pool[0])
+        self.assertTrue("waiting=" in pool[0])
+
+    def test_metric_cache_is_logged(self):
+        serving.log_stats()
+        self.assertEqual(len([message for message in self.handler.messages
+                              if message.startswith("metric cache of ") and
+                              "hit_rate=" in message and
+                              "bytes=" in message]), 1)
@@ -15,11 +15,18 @@
 # limitations under the License.
 #
 import json
+import os
+import tempfile
 import unittest
 import pdb
 from pymongo import MongoClient
 from api import templates
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 class PersistingTemplateDefintions(unittest.TestCase):
     def setUp(self):
@@ -62,6 +69,133 @@ class PersistingTemplateDefintions(unittest.TestCase):
         self.assertIn("fake_attr", db_record[0])
 
 
+def template_list(**terms):
+    """
+        Returns a list with a template per keyword, having the given terms.
+    """
+    return {"scheme": "http://sla.diff.org/agreements#",
+            "templates": dict(
+                (name, {"terms": dict(
+                    (term, {"type": "SERVICE-TERM", "desc": desc,
+                            "metrics": {"vcpu": {"value": 10}}})
+                    for term, desc in term_descs.iteritems())})
+                for name, term_descs in terms.iteritems())}
+
+
+class CountingDatabase(object):
+    """
+        Database counting the template lists queries.
+    """
+
+    def __init__(self, db):
+        self.counters = db.counters
+        self._templates = db.templates
+        self.finds = 0
+
+    @property
+    def templates(self):
+        return self
+
+    def find(self, *args, **kwargs):
+        self.finds += 1
+        return self._templates.find(*args, **kwargs)
+
+
+class LoadingTemplateChanges(unittest.TestCase):
+    """
+        Tests that loading templates only writes what changed.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+
+    def tearDown(self):
+        self.db.templates.remove()
+
+    def test_first_load_adds_every_template(self):
+        diff = templates.load_templates(template_list(gold={"cpu": ""},
+                                                      silver={"cpu": ""}))
+        self.assertEqual(diff.updated, ["gold", "silver"])
+        self.assertEqual(diff.changed, {})
+
+    def test_only_changed_templates_are_written(self):
+        templates.load_templates(template_list(gold={"cpu": "", "ram": ""},
+                                               silver={"cpu": ""}))
+        diff = templates.load_templates(template_list(
+            gold={"cpu": "fast", "disk": ""}, silver={"cpu": ""}))
+
+        self.assertEqual(diff.added, [])
+        self.assertEqual(diff.changed, {"gold": (["disk"], ["cpu"],
+                                                 ["ram"])})
+        self.assertEqual(diff.removed_terms(), set(["ram"]))
+        stored = self.db.templates.find_one(
+            "http://sla.diff.org/agreements#")["templates"]
+        self.assertEqual(sorted(stored["gold"]["terms"]), ["cpu", "disk"])
+        self.assertEqual(stored["gold"]["terms"]["cpu"]["desc"], "fast")
+
+        self.assertFalse(templates.load_templates(template_list(
+            silver={"cpu": ""})))
+
+    def test_invalid_change_is_not_written(self):
+        templates.load_templates(template_list(gold={"cpu": ""}))
+        invalid = template_list(gold={"cpu": ""})
+        invalid["templates"]["gold"]["terms"]["cpu"]["type"] = "SLO-TERM"
+        invalid["templates"]["gold"]["terms"]["cpu"]["metrics"] = {
+            "nope": {"value": 1}}
+        self.assertRaises(AttributeError, templates.load_templates, invalid)
+        stored = self.db.templates.find_one(
+            "http://sla.diff.org/agreements#")["templates"]
+        self.assertEqual(stored["gold"]["terms"]["cpu"]["type"],
+                         "SERVICE-TERM")
+
+    def test_watcher_applies_changes_loaded_elsewhere(self):
+        templates.load_templates(template_list(gold={"cpu": ""}))
+        applied = []
+        watcher = templates.TemplateWatcher(applied.append)
+        self.assertEqual(watcher.poll(), [])
+
+        templates.load_templates(template_list(gold={"cpu": "fast"},
+                                               silver={"cpu": ""}))
+        diffs = watcher.poll()
+        self.assertEqual(applied, diffs)
+        self.assertEqual(diffs[0].added, ["silver"])
+        self.assertEqual(diffs[0].changed, {"gold": ([], ["cpu"], [])})
+        # nothing new since
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(len(applied), 1)
+
+    def test_watcher_applies_list_written_after_a_later_one(self):
+        templates.load_templates(template_list(gold={"cpu": ""}))
+        watcher = templates.TemplateWatcher(lambda diff: None)
+        # a writer takes its version, another one writes first
+        version = templates.next_version()
+        other = template_list(gold={"cpu": ""})
+        other["scheme"] = "http://sla.other.org/agreements#"
+        templates.load_templates(other)
+        self.assertEqual(len(watcher.poll()), 1)
+
+        self.db.templates.update(
+            {"_id": "http://sla.diff.org/agreements#"},
+            {"$set": {"templates.silver": {"terms": {}},
+                      "version": version}})
+        diffs = watcher.poll()
+        self.assertEqual([diff.added for diff in diffs], [["silver"]])
+        self.assertEqual(watcher.gaps.missing(), [])
+
+    def test_watcher_reads_lists_only_when_versions_moved(self):
+        templates.load_templates(template_list(gold={"cpu": ""}))
+        db = CountingDatabase(self.db)
+        watcher = templates.TemplateWatcher(lambda diff: None, db=db)
+        db.finds = 0
+        for _ in range(3):
+            self.assertEqual(watcher.poll(), [])
+        self.assertEqual(db.finds, 0)
+
+        templates.load_templates(template_list(gold={"cpu": "fast"}))
+        self.assertEqual(len(watcher.poll()), 1)
+        self.assertEqual(db.finds, 1)
+
+
 class ValidatingTemplateDefinitions(unittest.TestCase):
     def setUp(self):
         samp_temp_addr = "tests/sample_data/testdata_template_definition.json"
@@ -209,3 +343,129 @@ class ValidatingTemplateDefinitions(unittest.TestCase):
                   "enum": ["WIN", "LINUX"],
                   "value": "Centos"}
         self.assertRaises(AttributeError, templates.validate_enum, "OS", metric)
+
+    def test_window_validation(self):
+        metric = {"value": 98.0, "limiter_type": "min",
+                  "window": {"function": "p95", "samples": 60,
+                             "seconds": 300}}
+        templates.validate_metric2("System uptime", metric)
+
+        metric["window"] = {"function": "median", "samples": 60}
+        self.assertRaises(AttributeError, templates.validate_metric2,
+                          "System uptime", metric)
+        metric["window"] = {"function": "avg", "samples": 0}
+        self.assertRaises(AttributeError, templates.validate_metric2,
+                          "System uptime", metric)
+
+    def test_hysteresis_validation(self):
+        metric = {"value": 98.0, "limiter_type": "min", "exit_value": 99.0}
+        templates.validate_metric2("System uptime", metric)
+
+        metric["exit_value"] = 97.0
+        self.assertRaises(AttributeError, templates.validate_metric2,
+                          "System uptime", metric)
+        metric = {"value": 98.0, "limiter_type": "margin",
+                  "limiter_value": 10.0, "exit_value": 20.0}
+        self.assertRaises(AttributeError, templates.validate_metric2,
+                          "System uptime", metric)
+        self.assertRaises(AttributeError, templates.validate_min_hold,
+                          "efficiency", {"min_hold": -1})
+
+
+def slo_template_list(**metrics):
+    """
+        Returns a list with a template per keyword, having an SLO term with
+        the given metric.
+    """
+    return {"scheme": "http://sla.check.org/agreements#",
+            "templates": dict(
+                (name, {"terms": {"efficiency": {
+                    "type": "SLO-TERM", "desc": "",
+                    "metrics": dict([metric])}}})
+                for name, metric in metrics.iteritems())}
+
+
+class CompiledTemplateValidation(unittest.TestCase):
+    """
+        Tests validating templates with the checkers compiled from the
+        metrics catalogue, and template files.
+    """
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _write(self, content):
+        with open(self.path, "w") as template_file:
+            template_file.write(content)
+
+    def test_checkers_are_compiled_once(self):
+        checkers = templates.metric_checkers()
+        self.assertTrue(templates.metric_checkers() is checkers)
+        self.assertEqual(checkers["System uptime"].limiters,
+                         frozenset(["margin", "max", "min"]))
+
+    def test_all_errors_are_reported(self):
+        invalid = slo_template_list(
+            gold=("System uptime", {"value": "high", "limiter_type": "max"}),
+            silver=("Number of processes", {"value": 10,
+                                            "limiter_type": "margin"}),
+            bronze=("Nope", {"value": 1, "limiter_type": "max"}))
+        try:
+            templates.validate_templates_3(invalid)
+            self.fail("Invalid templates were accepted")
+        except AttributeError as err:
+            errors = sorted(str(err).split("; "))
+        self.assertEqual(errors, ["Nope not a valid metric",
+                                  "Number of processes: Incorrect Limits",
+                                  "System uptime is not of type real"])
+
+    def test_template_file_is_validated(self):
+        self.assertEqual(templates.validate_template_file(
+            "configs/template_definition_DSS.json"), [])
+
+        self._write(json.dumps(slo_template_list(
+            gold=("System uptime", {"value": 99.5, "limiter_type": "max",
+                                    "exit_value": 99.9}),
+            silver=("System uptime", {"value": 99, "limiter_type": "enum"}))))
+        self.assertEqual(sorted(templates.validate_template_file(self.path)),
+                         ["System uptime: Exit value must be within the "
+                          "value", "System uptime: Incorrect Limits"])
+
+        self._write('{"templates": {}}')
+        self.assertEqual(templates.validate_template_file(self.path),
+                         ["Scheme must be specified",
+                          "No templates in template list"])
+        self._write('{"scheme": "http://sla.check.org/agreements#", ')
+        self.assertEqual(len(templates.validate_template_file(self.path)), 1)
+
+    @unittest.skipIf(ijson is None, "ijson is not installed")
+    def test_template_file_is_streamed(self):
+        gold = slo_template_list(gold=("System uptime", {
+            "value": 99.5, "limiter_type": "max", "exit_value": 99.9}))
+        self._write(json.dumps(gold, sort_keys=True))
+        with open(self.path, "rb") as stream:
+            items = list(templates._template_file_items(stream))
+        self.assertEqual(items, [("scheme", gold["scheme"]),
+                                 ("template",
+                                  ("gold", gold["templates"]["gold"]))])
+        self.assertEqual(templates.validate_template_file(self.path),
+                         ["System uptime: Exit value must be within the "
+                          "value"])
+
+        # templates before a syntax error are read already
+        self._write(json.dumps(gold, sort_keys=True)[:-2] +
+                    ', "silver": {"terms": ')
+        items = []
+        with open(self.path, "rb") as stream:
+            try:
+                for item in templates._template_file_items(stream):
+                    items.append(item)
+                self.fail("Invalid JSON was accepted")
+            except ValueError:
+                pass
+        self.assertEqual([key for key, _ in items], ["scheme", "template"])
+        self.assertEqual(len(templates.validate_template_file(self.path)), 2)
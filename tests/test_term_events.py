@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import threading
+import time
+import unittest
+from pymongo import MongoClient
+from occi import core_model
+from api import occi_sla
+from api import rulesengine
+from api import term_events
+from api.registry import PersistentReg
+from api.term_events import TermEventLog
+
+
+class TestTermEventLog(unittest.TestCase):
+    """
+        Tests appending and reading term state transitions.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.log = TermEventLog(self.db)
+
+    def tearDown(self):
+        self.db.term_events.remove({})
+        self.db.counters.remove({})
+
+    def test_events_after_resume_token(self):
+        first = self.log.append([("/agreement/a", "DSS", "gold", "fulfilled")])
+        self.log.append([("/agreement/a", "DSS", "gold", "violated"),
+                         ("/agreement/b", "IMS", "gold", "fulfilled")])
+
+        events = self.log.since(first)
+        self.assertEqual([event["state"] for event in events],
+                         ["violated", "fulfilled"])
+        self.assertEqual(self.log.since(first, provider="DSS")[0]["state"],
+                         "violated")
+        self.assertEqual(self.log.since(0, agreement="/agreement/b")[0]
+                         ["provider"], "IMS")
+        self.assertEqual(self.log.latest(), first + 2)
+
+    def test_events_after_a_missing_one_are_held_back(self):
+        first = self.log.append([("/agreement/a", "DSS", "gold", "fulfilled")])
+        # an appender took first + 1 and has not inserted it yet
+        self.db.counters.update({"_id": "term_events"}, {"$inc": {"seq": 1}})
+        self.log.append([("/agreement/a", "DSS", "gold", "violated")])
+
+        self.assertEqual([event["_id"] for event in self.log.since(0)],
+                         [first])
+        self.assertEqual(self.log.since(first, provider="DSS"), [])
+
+        self.db.term_events.insert({"_id": first + 1,
+                                    "agreement": "/agreement/b",
+                                    "provider": "IMS", "term": "gold",
+                                    "state": "violated", "time": "x"})
+        self.assertEqual([event["_id"]
+                          for event in self.log.since(first, provider="DSS")],
+                         [first + 2])
+
+    def test_long_missing_event_is_skipped(self):
+        self.db.term_events.insert({"_id": 2, "agreement": "/agreement/a",
+                                    "provider": "DSS", "term": "gold",
+                                    "state": "violated",
+                                    "time": "2015-11-02T02:20:26+00:00"})
+
+        self.assertEqual([event["_id"] for event in self.log.since(0)], [2])
+
+    def test_wait_returns_appended_events(self):
+        self.assertEqual(self.log.wait(0, 0), [])
+
+        def append():
+            time.sleep(0.1)
+            self.log.append([("/agreement/a", "DSS", "gold", "violated")])
+        threading.Thread(target=append).start()
+
+        events = self.log.wait(0, 5)
+        self.assertEqual([event["state"] for event in events], ["violated"])
+
+
+class TestTermEventsEndpoint(unittest.TestCase):
+    """
+        Tests serving the term events to providers.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.db.providers.insert({"username": "prov_123", "password": "pass"})
+        self.log = TermEventLog(self.db)
+        self.log.append([("/agreement/a", "prov_123", "gold", "fulfilled"),
+                         ("/agreement/b", "other", "gold", "violated"),
+                         ("/agreement/a", "prov_123", "gold", "violated")])
+
+    def tearDown(self):
+        self.db.providers.remove({"username": "prov_123"})
+        self.db.term_events.remove({})
+        self.db.counters.remove({})
+
+    def _get(self, query, **headers):
+        environ = {"PATH_INFO": term_events.PATH,
+                   "QUERY_STRING": query,
+                   "HTTP_PROVIDER": "prov_123",
+                   "HTTP_PROVIDER_PASS": "pass"}
+        environ.update(headers)
+        started = []
+        body = term_events.serve(environ, lambda status, headers:
+                                 started.append(status), self.log)
+        return started[0], "".join(body)
+
+    def test_long_poll_returns_own_events(self):
+        status, body = self._get("since=0&timeout=0")
+
+        self.assertTrue(status.startswith("200"))
+        reply = json.loads(body)
+        self.assertEqual([(event["agreement"], event["state"])
+                          for event in reply["events"]],
+                         [("/agreement/a", "fulfilled"),
+                          ("/agreement/a", "violated")])
+        self.assertEqual(reply["next"], 3)
+
+    def test_server_sent_events_resume_from_last_event(self):
+        status, body = self._get("timeout=0", HTTP_ACCEPT="text/event-stream",
+                                 HTTP_LAST_EVENT_ID="1")
+
+        self.assertTrue(status.startswith("200"))
+        self.assertEqual(body, "")
+
+        status, body = self._get("timeout=0.2",
+                                 HTTP_ACCEPT="text/event-stream",
+                                 HTTP_LAST_EVENT_ID="1")
+        self.assertTrue(body.startswith("id: 3\nevent: term\ndata: "))
+        self.assertEqual(body.count("id: "), 1)
+
+    def test_wrong_credentials_are_refused(self):
+        status, _ = self._get("since=0", HTTP_PROVIDER_PASS="wrong")
+        self.assertTrue(status.startswith("403"))
+
+
+class TestTermTransitions(unittest.TestCase):
+    """
+        Tests that the Rules Engine logs the changes of term states.
+    """
+
+    def setUp(self):
+        self.db = MongoClient().sla
+        rulesengine.RulesEngine._registry = PersistentReg()
+        agreement = core_model.Resource("/agreement/a", occi_sla.AGREEMENT, [])
+        agreement.provider = "DSS"
+        agreement.attributes = {"gold.term.state": "undefined"}
+        rulesengine.RulesEngine._registry.resources["/agreement/a"] = agreement
+        self.seq = term_events.TERM_EVENTS.latest()
+
+    def tearDown(self):
+        self.db.entities.remove({})
+        self.db.term_events.remove({})
+        self.db.counters.remove({})
+
+    def test_only_changes_are_logged(self):
+        rulesengine.RulesEngine.save_terms([
+            ("/agreement/a", "gold.term.state", "fulfilled"),
+            ("/agreement/a", "gold.term.state", "fulfilled"),
+            ("/agreement/a", "gold.term.state", "violated")])
+
+        events = term_events.TERM_EVENTS.since(self.seq)
+        self.assertEqual([(event["term"], event["state"], event["provider"])
+                          for event in events],
+                         [("gold", "fulfilled", "DSS"),
+                          ("gold", "violated", "DSS")])
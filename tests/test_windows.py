@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Intel Innovation and Research Ireland Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import time
+import unittest
+from api.aggregator import Aggregator
+from api.rulesenginehelper import RulesEngineHelper
+from api.windows import SampleWindow, WINDOWS, parse_window, window_spec, \
+    window_text
+
+
+class TestSampleWindow(unittest.TestCase):
+    """
+        Tests the rolling aggregates of a window.
+    """
+
+    def test_aggregates_of_the_last_samples(self):
+        window = SampleWindow(4)
+        for value in [50, 10, 20, 30, 40]:
+            window.add(value)
+
+        self.assertEqual(window.values(), [10.0, 20.0, 30.0, 40.0])
+        self.assertEqual(window.aggregate("avg"), 25.0)
+        self.assertEqual(window.aggregate("min"), 10.0)
+        self.assertEqual(window.aggregate("max"), 40.0)
+        self.assertEqual(window.aggregate("p50"), 20.0)
+        self.assertEqual(window.aggregate("p95"), 40.0)
+
+    def test_old_samples_expire(self):
+        window = SampleWindow(10, seconds=60)
+        window.add(100, now=1000)
+        window.add(10, now=1050)
+
+        self.assertEqual(window.aggregate("max", now=1055), 100.0)
+        self.assertEqual(window.aggregate("max", now=1070), 10.0)
+        self.assertEqual(window.aggregate("avg", now=1200), None)
+        self.assertEqual(len(window), 0)
+
+    def test_time_window_is_judged_once_covered(self):
+        window = SampleWindow(60, seconds=300)
+        window.add(100, now=1000)
+        window.add(90, now=1200)
+
+        self.assertFalse(window.ready(now=1250))
+        self.assertTrue(window.ready(now=1300))
+        self.assertFalse(SampleWindow(2).ready(now=5000))
+
+    def test_spec_round_trip(self):
+        spec = window_spec({"function": "p95", "samples": 60, "seconds": 300})
+        self.assertEqual(parse_window(window_text(spec)), ("p95", 60, 300.0))
+        self.assertEqual(parse_window(window_text(window_spec(
+            {"function": "avg", "samples": 5}))), ("avg", 5, None))
+        self.assertRaises(AttributeError, window_spec,
+                          {"function": "p100", "samples": 5})
+
+
+class TestWindowedTerms(unittest.TestCase):
+    """
+        Tests evaluating SLO terms over windows of samples.
+    """
+
+    def tearDown(self):
+        WINDOWS.discard("/agreement/windowed")
+
+    def _violated(self, window, value):
+        terms = {"efficiency": {"remedy": "0.10", "metrics": {
+            "System uptime": {"limiter_type": "min", "value": 98.0,
+                              "window": window}}}}
+        Aggregator().observe_windows(
+            {"agreement_id": "/agreement/windowed", "terms": terms},
+            "/compute/a", [("System uptime", value, time.time())])
+        helper = RulesEngineHelper("/agreement/windowed", terms,
+                                   {"System uptime": value}, "/compute/a")
+        return helper.agreement_term_violated("/agreement/windowed",
+                                              "efficiency")
+
+    def test_single_noisy_sample_is_averaged_out(self):
+        self.assertFalse(self._violated("avg:4", 99.0))
+        self.assertFalse(self._violated("avg:4", 99.5))
+        self.assertFalse(self._violated("avg:4", 96.0))
+        self.assertTrue(self._violated("avg:4", 90.0))
+
+    def test_consecutive_violations(self):
+        self.assertFalse(self._violated("consecutive:2", 50.0))
+        self.assertTrue(self._violated("consecutive:2", 50.0))
+        self.assertFalse(self._violated("consecutive:2", 99.0))
+
+    def test_window_is_judged_once_full(self):
+        for function in ("avg", "min", "max", "p95"):
+            WINDOWS.discard("/agreement/windowed")
+            self.assertFalse(self._violated(function + ":3", 10.0))
+            self.assertFalse(self._violated(function + ":3", 10.0))
+            self.assertTrue(self._violated(function + ":3", 10.0))
+
+    def test_evaluation_does_not_add_samples(self):
+        terms = {"efficiency": {"remedy": "0.10", "metrics": {
+            "System uptime": {"limiter_type": "min", "value": 98.0,
+                              "window": "consecutive:2"}}}}
+        self.assertFalse(self._violated("consecutive:2", 50.0))
+        for _ in range(2):
+            helper = RulesEngineHelper("/agreement/windowed", terms,
+                                       {"System uptime": 50.0}, "/compute/a")
+            self.assertFalse(helper.agreement_term_violated(
+                "/agreement/windowed", "efficiency"))
+
+    def test_expired_samples_empty_the_window(self):
+        key = ("/agreement/windowed", "efficiency", "/compute/a", "m")
+        WINDOWS.observe(key, 10, ("max", 2, 60), now=1000)
+        WINDOWS.observe(key, 20, ("max", 2, 60), now=1010)
+
+        self.assertEqual(WINDOWS.aggregate(key, "max", now=1020), 20.0)
+        self.assertEqual(WINDOWS.values(key, now=1065), None)
+        # sampled for its 60 seconds, the sample left is judged
+        self.assertEqual(WINDOWS.aggregate(key, "max", now=1065), 20.0)
+        self.assertEqual(WINDOWS.aggregate(key, "max", now=1075), None)
@@ -14,7 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 import unittest
+from StringIO import StringIO
+from pymongo import MongoClient
+from occi import core_model
+from api import api
+from api import occi_sla
+from api import templates
 from api import wsgi
 
 class TestWsgi(unittest.TestCase):
@@ -42,6 +49,279 @@ class TestWsgi(unittest.TestCase):
         self.assertEqual(auth["security"], {"IMS": "ims_pass"})
 
 
+class TestConditionalRequests(unittest.TestCase):
+    """
+    Tests the ETag and If-Match handling of agreement changes
+    """
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.db.providers.insert({"username": "prov_123", "password": "pass"})
+        self.app = api.build()
+        self.resources = self.app.registry.resources
+
+        agreement = core_model.Resource("/agreement/a", occi_sla.AGREEMENT,
+                                        [])
+        agreement.provider = "prov_123"
+        agreement.customer = "cust"
+        agreement.attributes = {"occi.agreement.state": "pending"}
+        self.resources["/agreement/a"] = agreement
+
+    def tearDown(self):
+        self.db.providers.remove({"username": "prov_123"})
+        self.db.entities.remove({})
+
+    def _request(self, method, if_match=None):
+        environ = {"REQUEST_METHOD": method,
+                   "PATH_INFO": "/agreement/a",
+                   "HTTP_HOST": "localhost",
+                   "CONTENT_TYPE": "text/occi",
+                   "HTTP_PROVIDER": "prov_123",
+                   "HTTP_PROVIDER_PASS": "pass",
+                   "wsgi.input": StringIO("")}
+        if method == "POST":
+            environ["QUERY_STRING"] = "action=reject"
+            environ["HTTP_CATEGORY"] = 'reject; ' \
+                'scheme="http://schemas.ogf.org/occi/sla#"; class="action"'
+        if if_match is not None:
+            environ["HTTP_IF_MATCH"] = if_match
+
+        started = []
+        self.app(environ, lambda status, headers:
+                 started.append((status, dict(headers))))
+        return started[0]
+
+    def _state(self):
+        record = self.db.entities.find_one("/agreement/a")
+        return dict((attr["k"], attr["v"])
+                    for attr in record["attributes"])["occi.agreement.state"]
+
+    def test_etag_is_the_version(self):
+        status, headers = self._request("GET")
+        self.assertTrue(status.startswith("200"))
+        self.assertEqual(headers["ETag"], '"1"')
+
+    def test_action_is_saved_with_new_etag(self):
+        status, headers = self._request("POST", if_match='"1"')
+
+        self.assertTrue(status.startswith("200"))
+        self.assertEqual(headers["ETag"], '"2"')
+        self.assertEqual(self._state(), "rejected")
+
+    def test_stale_if_match_is_refused(self):
+        status, _ = self._request("POST", if_match='"7"')
+
+        self.assertTrue(status.startswith("412"))
+        self.assertEqual(self._state(), "pending")
+        self.assertEqual(self.resources.version("/agreement/a"), 1)
+
+    def test_unconditional_action_is_redone_on_latest_version(self):
+        # another process changes the agreement after it was loaded here
+        self.db.entities.update({"_id": "/agreement/a"},
+                                {"$push": {"attributes": {"k": "other",
+                                                          "v": "x"}},
+                                 "$inc": {"version": 1}})
+
+        status, headers = self._request("POST")
+
+        self.assertTrue(status.startswith("200"))
+        self.assertEqual(headers["ETag"], '"3"')
+        self.assertEqual(self._state(), "rejected")
+        self.assertEqual(self.resources["/agreement/a"].attributes["other"],
+                         "x")
+
+    def test_unsaved_changes_are_not_seen(self):
+        seen = []
+
+        def losing_commit(key, changed, version):
+            seen.append((self.resources[key].attributes[
+                "occi.agreement.state"],
+                changed.attributes["occi.agreement.state"]))
+            return False
+        self.resources.commit = losing_commit
+
+        status, _ = self._request("POST")
+
+        self.assertTrue(status.startswith("409"))
+        self.assertEqual(seen, [("pending", "rejected")] * wsgi.WRITE_RETRIES)
+        self.assertEqual(self.resources["/agreement/a"].attributes[
+            "occi.agreement.state"], "pending")
+        self.assertEqual(self._state(), "pending")
+
+
+class TestTemplateLoading(unittest.TestCase):
+    """
+    Tests loading templates on a running API
+    """
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.db.providers.insert({"username": "prov_123", "password": "pass"})
+        self.db.providers.insert({"username": "prov_456", "password": "pass"})
+        self.app = api.build()
+
+    def tearDown(self):
+        self.db.providers.remove({"username": {"$in": ["prov_123",
+                                                       "prov_456"]}})
+        self.db.templates.remove({"_id": "http://sla.live.org/agreements#"})
+
+    def _post(self, terms, provider="prov_123"):
+        body = json.dumps({"scheme": "http://sla.live.org/agreements#",
+                           "templates": {"gold": {"terms": dict(
+                               (term, {"type": "SERVICE-TERM", "desc": "",
+                                       "metrics": {"vcpu": {"value": 1}}})
+                               for term in terms)}}})
+        environ = {"REQUEST_METHOD": "POST",
+                   "PATH_INFO": "/templates",
+                   "HTTP_PROVIDER": provider,
+                   "HTTP_PROVIDER_PASS": "pass",
+                   "CONTENT_LENGTH": str(len(body)),
+                   "wsgi.input": StringIO(body)}
+        started = []
+        result = "".join(self.app(environ, lambda status, headers:
+                                  started.append(status)))
+        if not started[0].startswith("200"):
+            return started[0], result
+        return started[0], json.loads(result)
+
+    def _mixins(self):
+        return sorted(category.scheme + category.term
+                      for category in self.app.registry.backends
+                      if "sla.live.org" in category.scheme)
+
+    def test_mixins_follow_loaded_templates(self):
+        status, diff = self._post(["cpu", "ram"])
+        self.assertTrue(status.startswith("200"))
+        self.assertEqual(diff["added"], ["gold"])
+        self.assertEqual(self._mixins(),
+                         ["http://sla.live.org/agreements#gold",
+                          "http://sla.live.org/agreements/terms#cpu",
+                          "http://sla.live.org/agreements/terms#ram"])
+
+        status, diff = self._post(["cpu"])
+        self.assertEqual(diff["changed"]["gold"]["removed"], ["ram"])
+        self.assertEqual(self._mixins(),
+                         ["http://sla.live.org/agreements#gold",
+                          "http://sla.live.org/agreements/terms#cpu"])
+
+    def test_only_the_owner_updates_a_scheme(self):
+        status, _ = self._post(["cpu"])
+        self.assertTrue(status.startswith("200"))
+        self.assertEqual(self.db.templates.find_one(
+            {"_id": "http://sla.live.org/agreements#"})["provider"],
+            "prov_123")
+
+        status, _ = self._post(["ram"], provider="prov_456")
+        self.assertTrue(status.startswith("403"))
+        self.assertEqual(self._mixins(),
+                         ["http://sla.live.org/agreements#gold",
+                          "http://sla.live.org/agreements/terms#cpu"])
+
+    def test_templates_loaded_by_another_process_are_registered(self):
+        watcher = templates.TemplateWatcher(
+            lambda diff: api.apply_template_diff(self.app, diff))
+        templates.load_templates(
+            {"scheme": "http://sla.live.org/agreements#",
+             "templates": {"silver": {"terms": {"disk": {
+                 "type": "SERVICE-TERM", "desc": "",
+                 "metrics": {"vcpu": {"value": 1}}}}}}})
+        self.assertEqual(self._mixins(), [])
+
+        self.assertEqual(len(watcher.poll()), 1)
+        self.assertEqual(self._mixins(),
+                         ["http://sla.live.org/agreements#silver",
+                          "http://sla.live.org/agreements/terms#disk"])
+
+
+class TestBulkAgreements(unittest.TestCase):
+    """
+    Tests creating agreements in bulk
+    """
+    def setUp(self):
+        self.db = MongoClient().sla
+        self.db.providers.insert({"username": "prov_bulk", "password": "pass"})
+        templates.load_templates(json.load(
+            file("tests/sample_data/template_definition_v2.json")))
+        self.app = api.build()
+
+    def tearDown(self):
+        self.db.providers.remove({"username": "prov_bulk"})
+        self.db.templates.remove({})
+        self.db.entities.remove({})
+
+    def _post(self, batch, password="pass", path="/bulk/agreements"):
+        body = json.dumps(batch)
+        environ = {"REQUEST_METHOD": "POST",
+                   "PATH_INFO": path,
+                   "HTTP_PROVIDER": "prov_bulk",
+                   "HTTP_PROVIDER_PASS": password,
+                   "HTTP_CUSTOMER": "larry",
+                   "CONTENT_LENGTH": str(len(body)),
+                   "wsgi.input": StringIO(body)}
+        started = []
+        result = self.app(environ, lambda status, headers:
+                          started.append(status))
+        return started[0], "".join(result)
+
+    def test_batch_is_created_with_links(self):
+        period = {"occi.agreement.effectiveFrom": "2014-11-02T02:17:26Z",
+                  "occi.agreement.effectiveUntil": "2114-11-02T02:17:29Z"}
+        status, body = self._post({"accept": True, "agreements": [
+            {"templates": ["http://sla.ran.org/agreements#gold"],
+             "attributes": period, "links": ["/compute/a", "/compute/b"]},
+            {"templates": ["http://sla.ran.org/agreements#bronze"],
+             "attributes": period},
+            {"templates": ["http://sla.ran.org/agreements#silver"],
+             "attributes": period}]})
+        self.assertTrue(status.startswith("200"))
+        results = json.loads(body)["results"]
+
+        self.assertEqual([result["index"] for result in results], [0, 1, 2])
+        self.assertTrue("Unknown template" in results[1]["error"])
+        self.assertEqual(results[0]["state"], "accepted")
+        self.assertEqual(len(results[0]["links"]), 2)
+
+        resources = self.app.registry.resources
+        agreement = resources[results[0]["location"]]
+        self.assertEqual(agreement.provider, "prov_bulk")
+        self.assertEqual(sorted(link.target for link in agreement.links),
+                         ["/compute/a", "/compute/b"])
+        record = self.db.entities.find_one(results[0]["location"])
+        self.assertEqual(record["links"], results[0]["links"])
+        self.assertEqual(record["version"], 1)
+        self.assertEqual(self.db.entities.find_one(
+            results[0]["links"][0])["source"], results[0]["location"])
+        self.assertTrue(results[2]["location"] in resources)
+
+    def test_existing_agreements_are_linked(self):
+        _, body = self._post({"agreements": [
+            {"templates": ["http://sla.ran.org/agreements#gold"],
+             "attributes": {
+                 "occi.agreement.effectiveFrom": "2014-11-02T02:17:26Z",
+                 "occi.agreement.effectiveUntil": "2114-11-02T02:17:29Z"},
+             "links": ["/compute/a"]}]})
+        location = json.loads(body)["results"][0]["location"]
+
+        status, body = self._post({"links": [
+            {"agreement": location, "devices": ["/compute/b", "/compute/c"]},
+            {"agreement": "/agreement/unknown", "devices": ["/compute/d"]}]},
+            path="/bulk/links")
+        self.assertTrue(status.startswith("200"))
+        results = json.loads(body)["results"]
+        self.assertEqual(len(results[0]["links"]), 2)
+        self.assertTrue("Unknown agreement" in results[1]["error"])
+
+        agreement = self.app.registry.resources[location]
+        self.assertEqual(sorted(link.target for link in agreement.links),
+                         ["/compute/a", "/compute/b", "/compute/c"])
+        record = self.db.entities.find_one(location)
+        self.assertEqual(len(record["links"]), 3)
+        self.assertEqual(record["version"], 2)
+        self.assertEqual(self.app.registry.resources.version(location), 2)
+
+    def test_bad_credentials_are_refused(self):
+        status, _ = self._post({"agreements": []}, password="wrong")
+        self.assertTrue(status.startswith("403"))
+
+
 class TestApplication(wsgi.Application):
     def _call_occi(self, *args, **kwargs):
         return kwargs